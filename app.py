@@ -1,200 +1,604 @@
-import pandas as pd
 import os
+import time
 import logging
-from flask import Flask,jsonify
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from flask import Flask,jsonify,request,Response
 from dotenv import load_dotenv
-from mosyle_api import get_token,create_users,list_users,delete_users
-from vc_api import get_students,get_access_token,get_staff_faculty
 
-
-app = Flask(__name__)
+# Before the project imports: several modules read their settings from the
+# environment when imported, so .env has to be loaded first (and only once).
 load_dotenv()
-
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+
+from mosyle_api import create_users,list_roster,delete_users,stream_users,replay_elements,fetch_user_pages
+from vc_api import iter_student_rows,iter_staff_rows,student_roster,staff_roster,VeracrossError
+from snapshot_store import page_checksum
+from plan_store import PlanStore
+from journal import open_journal, Recorders, StreamedRun
+from roster import Roster, plan_rosters
+from jobs import job_queue, MIN_RUN_INTERVAL
+from metrics import REGISTRY, span
+from fetch_cache import fetch_cache
+from response_cache import open_response_cache, bypassed
+from tenants import load_tenants
+
+
+app = Flask(__name__)
 logger = logging.getLogger("Mosyle Integration")
 
-VC_CLIENT_ID = os.getenv("VC_CLIENT_ID")
-VC_CLIENT_SECRET = os.getenv("VC_CLIENT_SECRET")
-VC_TOKEN_URL = "https://accounts.veracross.com/acsad/oauth/token"
-VC_STAFF_URL = "https://api.veracross.com/ACSAD/v3/staff_faculty"
-VC_STUDENTS_URL = "https://api.veracross.com/ACSAD/v3/students"
+# Schools to sync (see tenants.load_tenants); routes take ?tenant=<key>, and
+# the first tenant is the default.
+TENANTS = load_tenants()
+DEFAULT_TENANT = next(iter(TENANTS.values()))
+# Tenants synced at once by /cleanup_all and the scheduler.
+TENANT_PARALLELISM = int(os.getenv("TENANT_PARALLELISM", "4"))
+# Seconds between scheduled /cleanup_all and /sync_all_tenants runs (0 = only on request).
+CLEANUP_SCHEDULE_SECONDS = float(os.getenv("CLEANUP_SCHEDULE_SECONDS", "0"))
+SYNC_ALL_SCHEDULE_SECONDS = float(os.getenv("SYNC_ALL_SCHEDULE_SECONDS", "0"))
 
+# Delta sync (enabled by a tenant's SNAPSHOT_DB): hours between full reconciles, and the
+# Veracross filter used to fetch only records changed since the last sync.
+FULL_RECONCILE_HOURS = float(os.getenv("FULL_RECONCILE_HOURS", "24"))
+VC_UPDATED_SINCE_PARAM = os.getenv("VC_UPDATED_SINCE_PARAM", "on_or_after_last_modified_date")
 
-MOSYLE_EMAIL = os.getenv("MOSYLE_EMAIL")
-MOSYLE_PASSWORD = os.getenv("MOSYLE_PASSWORD")
-MOSYLE_TOKEN = os.getenv("MOSYLE_ACCESS_TOKEN")
-MOSYLE_AUTH_URL = "https://managerapi.mosyle.com/v2/login?"
-MOSYLE_USERS_URL = "https://managerapi.mosyle.com/v2/users"
-MOSYLE_LIST_USERS_URL = "https://managerapi.mosyle.com/v2/listusers"
+# With SNAPSHOT_DB, full reconciles diff against the Mosyle mirror when it was
+# verified against listusers within MIRROR_MAX_AGE seconds (else it is
+# refreshed first); MIRROR_REFRESH_SECONDS > 0 also refreshes it in the background.
+MIRROR_MAX_AGE = float(os.getenv("MIRROR_MAX_AGE", "3600"))
+MIRROR_REFRESH_SECONDS = float(os.getenv("MIRROR_REFRESH_SECONDS", "0"))
 
+# Stream Veracross pages straight into Mosyle writes on the create routes
+# (also enabled per request with ?stream=1).
+STREAM_WRITES = os.getenv("STREAM_WRITES", "0") == "1"
 
+# Apply /cleanup's update, add and delete phases concurrently on the asyncio engine.
+ASYNC_ENGINE = os.getenv("ASYNC_ENGINE", "0") == "1"
 
-@app.route("/create_new_students")
-def create_students():
-    try:
-        vc_access_token = get_access_token(url=VC_TOKEN_URL,vc_client_id=VC_CLIENT_ID,vc_client_secret=VC_CLIENT_SECRET)
-        mosyle_jwt = get_token(AUTH_URL=MOSYLE_AUTH_URL,EMAIL=MOSYLE_EMAIL,PASSWORD=MOSYLE_PASSWORD,TOKEN=MOSYLE_TOKEN)
-        students = get_students(access_token=vc_access_token,students_url=VC_STUDENTS_URL,params_required=True)
-        students["type"] = "S"
+# Run the sync routes as background jobs (poll /jobs/<id>) instead of inside
+# the request. Off by default: Cloud Run throttles the CPU once the 202 is
+# sent and may scale the instance to zero mid-job, so only enable it where CPU
+# stays allocated (--no-cpu-throttling, with --min-instances 1 for the
+# schedules below, which run on the same background runner). ?wait=1 always
+# runs inline.
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "0") == "1"
 
 
-        result = create_users(MOSYLE_USERS_URL = MOSYLE_USERS_URL,accessToken=MOSYLE_TOKEN,jwt_token=mosyle_jwt,users = students,operation="save")
-        # create_user = {}
-        # return create_user
-        # result = create_students() 
-        code = 200 if result["status"] in ("OK", "partial") else 500
 
-        return jsonify(result), code
-    except Exception as e:
-        logger.exception("Job failed")
-        return jsonify({"status": "error", "message": str(e)}), 500
-    
+def streaming_requested():
+    return STREAM_WRITES or request.args.get("stream") == "1"
 
-@app.route("/create_new_staff_teacher")
-def create_staffs():
-    try:
-        vc_access_token = get_access_token(url=VC_TOKEN_URL,vc_client_id=VC_CLIENT_ID,vc_client_secret=VC_CLIENT_SECRET)
-        mosyle_jwt = get_token(AUTH_URL=MOSYLE_AUTH_URL,EMAIL=MOSYLE_EMAIL,PASSWORD=MOSYLE_PASSWORD,TOKEN=MOSYLE_TOKEN)
-        staff_df,teacher_df = get_staff_faculty(access_token=vc_access_token,VC_STAFF_URL=VC_STAFF_URL,params_required=True)
 
-        staff_df["type"] = "STAFF"
-        teacher_df["type"] = "T"
+def sync_new_students(stream=False, tenant=DEFAULT_TENANT):
+    """Create Mosyle accounts for students starting soon; returns (result, http code)."""
+    vc_access_token = tenant.vc_auth()
+    mosyle_jwt = tenant.mosyle_jwt()
+    if stream:
+        pages = iter_student_rows(access_token=vc_access_token,students_url=tenant.vc_students_url,params_required=True)
+        result = stream_journaled("create_new_students", mosyle_jwt, pages, tenant=tenant)
+        return result, 200 if result["status"] in ("OK", "partial") else 500
 
-        
-        result_staff = create_users(MOSYLE_USERS_URL = MOSYLE_USERS_URL,accessToken=MOSYLE_TOKEN,jwt_token=mosyle_jwt,users = staff_df,operation="save")
-        result_teacher = create_users(MOSYLE_USERS_URL = MOSYLE_USERS_URL,accessToken=MOSYLE_TOKEN,jwt_token=mosyle_jwt,users = teacher_df,operation="save")
+    # A Roster, like /cleanup's: the create routes never load pandas.
+    students = student_roster(access_token=vc_access_token,students_url=tenant.vc_students_url,params_required=True)
 
+    result = apply_journaled("create_new_students", "create", mosyle_jwt, students, Roster(), Roster(), mirror=tenant.snapshot(), tenant=tenant)
+    code = 200 if result["status"] in ("OK", "partial") else 500
 
-        combined_result = {
-            "status": "OK" if result_staff["status"] == "OK" and result_teacher["status"] == "OK" else "partial",
-            "updated": result_staff.get("updated", 0) + result_teacher.get("updated", 0),
-            "failed": result_staff.get("failed", 0) + result_teacher.get("failed", 0),
-            "failures": result_staff.get("failures", []) + result_teacher.get("failures", [])
-        }
+    return result, code
 
-        code = 200 if combined_result["status"] in ("OK", "partial") else 500
 
-        return jsonify(combined_result), code
-    except Exception as e:
-        logger.exception("Job failed")
-        return jsonify({"status": "error", "message": str(e)}), 500
+def sync_new_staff(stream=False, tenant=DEFAULT_TENANT):
+    """Create Mosyle accounts for staff and teachers hired soon; returns (result, http code)."""
+    vc_access_token = tenant.vc_auth()
+    mosyle_jwt = tenant.mosyle_jwt()
+    if stream:
+        # One stream carries both staff and teachers; rows are typed per entry.
+        pages = iter_staff_rows(access_token=vc_access_token,VC_STAFF_URL=tenant.vc_staff_url,params_required=True)
+        result = stream_journaled("create_new_staff_teacher", mosyle_jwt, pages, tenant=tenant)
+        return result, 200 if result["status"] in ("OK", "partial") else 500
 
-@app.route("/cleanup")
-def cleanup():
+    # One Roster of staff and teachers, each typed per row (STAFF or T).
+    staff = staff_roster(access_token=vc_access_token,VC_STAFF_URL=tenant.vc_staff_url,params_required=True)
+
+    result = apply_journaled("create_new_staff_teacher", "create", mosyle_jwt, staff, Roster(), Roster(), mirror=tenant.snapshot(), tenant=tenant)
+    code = 200 if result["status"] in ("OK", "partial") else 500
+
+    return result, code
+
+def fetch_vc_users(vc_access_token, extra_params=None, tenant=DEFAULT_TENANT):
+    """Fetch students, staff and teachers with a school address from Veracross as one Roster."""
+    where = [("email_1", "contains", tenant.email_domain)]
+    students = student_roster(access_token=vc_access_token,students_url=tenant.vc_students_url,params_required=False,extra_params=extra_params,where=where)
+    staff = staff_roster(access_token=vc_access_token,VC_STAFF_URL=tenant.vc_staff_url,params_required=False,extra_params=extra_params,where=where)
+    return students + staff
+
+
+def plan_changes(vc_users, mosyle_users, include_deletes=True):
+    """Diff Veracross users against Mosyle users (Rosters); returns (to_add, to_update, to_delete)."""
+    with span("diff"):
+        to_add, to_update, to_delete = plan_rosters(vc_users, mosyle_users, include_deletes=include_deletes)
+    logger.info("to_add=%d", len(to_add))
+    logger.info("to_delete=%d", len(to_delete))
+    logger.info("to_update=%d", len(to_update))
+    return to_add, to_update, to_delete
+
+
+def apply_changes(mosyle_jwt, to_add, to_update, to_delete, recorder=None, tenant=DEFAULT_TENANT):
+    """Send the planned updates, adds and deletes (Rosters or DataFrames) to Mosyle and combine their results."""
+    if ASYNC_ENGINE:
+        import async_engine
+        return async_engine.apply_changes(tenant.mosyle_users_url,tenant.mosyle_token,mosyle_jwt,to_add,to_update,to_delete,refresh_jwt=tenant.refresh_mosyle_jwt,recorder=recorder,location=tenant.location,limiter=tenant.limiter)
+
+    result_updated = create_users(MOSYLE_USERS_URL = tenant.mosyle_users_url,accessToken=tenant.mosyle_token,jwt_token=mosyle_jwt,refresh_jwt=tenant.refresh_mosyle_jwt,users = to_update,operation="update",limiter=tenant.limiter,recorder=recorder,location=tenant.location)
+    result_added = create_users(MOSYLE_USERS_URL = tenant.mosyle_users_url,accessToken=tenant.mosyle_token,jwt_token=mosyle_jwt,refresh_jwt=tenant.refresh_mosyle_jwt,users = to_add,operation="save",limiter=tenant.limiter,recorder=recorder,location=tenant.location)
+    result_deleted = delete_users(MOSYLE_USERS_URL = tenant.mosyle_users_url,accessToken=tenant.mosyle_token,jwt_token=mosyle_jwt,refresh_jwt=tenant.refresh_mosyle_jwt,users = to_delete,limiter=tenant.limiter,recorder=recorder)
+
+    # print(result_updated)
+
+
+
+
+   
+    return {
+        "status": "OK" if result_updated["status"] == "OK" and result_added["status"] == "OK" and result_deleted["status"] == "OK" else "partial",
+        "updated": result_updated.get("updated", 0) + result_added.get("updated", 0) ,
+        "deleted": result_deleted.get("deleted", 0),
+        "failed": result_updated.get("failed", 0) + result_added.get("failed", 0) + result_deleted.get("failed", 0),
+        "failures": result_updated.get("failures", []) + result_added.get("failures", []) + result_deleted.get("failures", [])
+    }
+
+
+def apply_journaled(name, mode, mosyle_jwt, to_add, to_update, to_delete, run_id=None, mirror=None, tenant=DEFAULT_TENANT):
+    """apply_changes with the whole plan journaled first (when JOURNAL_DB is set).
+
+    Acknowledged writes also go through to mirror (a SnapshotStore). The
+    result carries the journal run_id and, when some elements were not
+    acknowledged, a resume_url that resends only those.
+    """
+    journal = open_journal()
+    if journal is None or to_add.empty and to_update.empty and to_delete.empty:
+        return apply_changes(mosyle_jwt, to_add, to_update, to_delete, recorder=mirror, tenant=tenant)
+
+    run = journal.start(name, mode=mode, run_id=run_id, tenant=tenant.key)
+    run.plan(to_add, to_update, to_delete, location=tenant.location)
     try:
-        vc_access_token = get_access_token(url=VC_TOKEN_URL,vc_client_id=VC_CLIENT_ID,vc_client_secret=VC_CLIENT_SECRET)
-        mosyle_jwt = get_token(AUTH_URL=MOSYLE_AUTH_URL,EMAIL=MOSYLE_EMAIL,PASSWORD=MOSYLE_PASSWORD,TOKEN=MOSYLE_TOKEN)
-        staff_df,teacher_df = get_staff_faculty(access_token=vc_access_token,VC_STAFF_URL=VC_STAFF_URL,params_required=False)
-        students = get_students(access_token=vc_access_token,students_url=VC_STUDENTS_URL,params_required=False)
-        if not mosyle_jwt:
-            return jsonify({"status":"error","message":"Mosyle JWT is missing"}), 500
-        mosyle_users = list_users(MOSYLE_LIST_USERS_URL=MOSYLE_LIST_USERS_URL,accessToken=MOSYLE_TOKEN,jwt_token=mosyle_jwt)
+        combined_result = apply_changes(mosyle_jwt, to_add, to_update, to_delete, recorder=Recorders(run, mirror), tenant=tenant)
+    finally:
+        status = run.finish()
+    combined_result["run_id"] = run.run_id
+    if status != "done":
+        combined_result["resume_url"] = f"/journal/{run.run_id}/resume"
+    return combined_result
+
+
+def stream_journaled(name, mosyle_jwt, pages, tenant=DEFAULT_TENANT):
+    """stream_users (saves) with each batch journaled as it returns (when JOURNAL_DB is set).
+
+    Like apply_journaled, the result carries the run_id and, when some
+    elements were not acknowledged, a resume_url that resends only those.
+    """
+    journal = open_journal()
+    run = journal.start(name, mode="stream", tenant=tenant.key) if journal else None
+    try:
+        result = stream_users(MOSYLE_USERS_URL = tenant.mosyle_users_url,accessToken=tenant.mosyle_token,jwt_token=mosyle_jwt,refresh_jwt=tenant.refresh_mosyle_jwt,pages = pages,operation="save",limiter=tenant.limiter,
+                              recorder=Recorders(run and StreamedRun(run), tenant.snapshot()),location=tenant.location)
+    finally:
+        status = run.finish() if run else None
+    if run:
+        result["run_id"] = run.run_id
+        if status != "done":
+            result["resume_url"] = f"/journal/{run.run_id}/resume"
+    return result
+
+
+def refresh_mirror(snapshot=None, mosyle_jwt=None, tenant=DEFAULT_TENANT):
+    """Verify the tenant's Mosyle mirror against a full listusers listing; returns (result, http code).
+
+    Unchanged pages (same checksum as last time) are not rewritten. If any
+    page fails after its retries the mirror is left as it was.
+    """
+    snapshot = snapshot or tenant.snapshot()
+    if snapshot is None:
+        return {"status": "error", "message": "SNAPSHOT_DB is not set"}, 400
+    mosyle_jwt = mosyle_jwt or tenant.mosyle_jwt()
+    if not mosyle_jwt:
+        return {"status":"error","message":"Mosyle JWT is missing"}, 500
+
+    started = time.time()
+    with span("mirror_refresh"):
+        pages = fetch_user_pages(tenant.mosyle_list_users_url,tenant.mosyle_token,mosyle_jwt,refresh_jwt=tenant.refresh_mosyle_jwt,
+                                 limiter=tenant.limiter,transform=lambda users: (page_checksum(users), users))
+        if pages is None:
+            return {"status": "error", "message": "listusers failed; mirror not refreshed"}, 500
+        stats = snapshot.refresh(pages, verified_at=started)
+    logger.info("Mosyle mirror refreshed: %s", stats)
+    return {"status": "OK", **stats}, 200
+
+
+def mirrored_users(snapshot, mosyle_jwt, tenant=DEFAULT_TENANT):
+    """The mirror's users, refreshed first when older than MIRROR_MAX_AGE (an empty Roster if that fails)."""
+    if snapshot.mirror_age() >= MIRROR_MAX_AGE:
+        _, code = refresh_mirror(snapshot, mosyle_jwt, tenant=tenant)
+        if code != 200:
+            return Roster()
+    return snapshot.load()
+
+
+def sync_cleanup(dry_run=False, tenant=DEFAULT_TENANT):
+    """Reconcile Mosyle against Veracross (full or delta); returns (result, http code).
+
+    With dry_run the plan is stored (see apply_plan) and summarized instead of
+    applied, and nothing is written to Mosyle or the mirror.
+    """
+    run_started = time.time()
+    snapshot = tenant.snapshot()
+    full_reconcile = snapshot is None or snapshot.last_sync() is None or snapshot.full_reconcile_due(FULL_RECONCILE_HOURS)
+
+    vc_access_token = tenant.vc_auth()
+    mosyle_jwt = tenant.mosyle_jwt()
+    if not mosyle_jwt:
+        return {"status":"error","message":"Mosyle JWT is missing"}, 500
+
+    if full_reconcile:
+        with span("fetch_veracross"):
+            vc_users = fetch_vc_users(vc_access_token, tenant=tenant)
+        with span("fetch_mosyle"):
+            if snapshot:
+                mosyle_users = mirrored_users(snapshot, mosyle_jwt, tenant=tenant)
+            else:
+                mosyle_users = list_roster(MOSYLE_LIST_USERS_URL=tenant.mosyle_list_users_url,accessToken=tenant.mosyle_token,jwt_token=mosyle_jwt,refresh_jwt=tenant.refresh_mosyle_jwt,limiter=tenant.limiter)
         print("got mosyle users!")
-
-        staff_df["type"] = "STAFF"
-        teacher_df["type"] = "T"
-        students["type"] = "S"
-        staff_df["grade_level"] = None
-        teacher_df["grade_level"] = None
-        staff_df = staff_df.drop(columns=["faculty_type"])
-        teacher_df = teacher_df.drop(columns=["faculty_type"])
-
-        vc_users_df = pd.concat([students, staff_df, teacher_df], ignore_index=True)
-        vc_users_df = vc_users_df[vc_users_df["email_1"].str.contains("@acs.sch.ae", na=False)]
-        if vc_users_df.empty or mosyle_users.empty:
+        if vc_users.empty or mosyle_users.empty:
             return {
             "status": "EMPTY DATA FRAME",
             "updated": 0,
             "failed": 1,
             "failures": [{"error": "One or both DataFrames are empty"}]
-        }
+        }, 200
+    else:
+        # Delta run: only records Veracross changed since the last sync (date
+        # granularity, so the last sync day is refetched), diffed against the
+        # snapshot. Deletes wait for the next full reconcile. last_sync only
+        # moves once the fetch succeeded (an empty answer is then real).
+        since = datetime.fromtimestamp(snapshot.last_sync()).date()
+        with span("fetch_veracross"):
+            try:
+                vc_users = fetch_vc_users(vc_access_token, extra_params={VC_UPDATED_SINCE_PARAM: since}, tenant=tenant)
+            except VeracrossError as e:
+                # last_sync stays put, so the next run asks for the same changes again.
+                logger.error("delta sync: Veracross fetch failed (is %s accepted?): %s", VC_UPDATED_SINCE_PARAM, e)
+                return {"status": "error", "mode": "delta", "message": str(e)}, 500
+        mosyle_users = snapshot.load()
+        logger.info("delta sync: %d Veracross users changed since %s", len(vc_users), since)
+        if vc_users.empty and not dry_run:
+            snapshot.set_meta("last_sync", run_started)
+            return {"status": "OK", "mode": "delta", "updated": 0, "deleted": 0, "failed": 0, "failures": []}, 200
+
+    to_add, to_update, to_delete = plan_changes(vc_users, mosyle_users, include_deletes=full_reconcile)
+    if dry_run:
+        plan = PlanStore().save(to_add, to_update, to_delete, mode="full" if full_reconcile else "delta", tenant=tenant.key)
+        return {"status": "planned", **plan}, 200
+
+    mode = "full" if full_reconcile else "delta"
+    with span("apply"):
+        combined_result = apply_journaled("cleanup", mode, mosyle_jwt, to_add, to_update, to_delete, mirror=snapshot, tenant=tenant)
+    combined_result["mode"] = mode
+
+    if snapshot and combined_result["status"] == "OK":
+        snapshot.set_meta("last_sync", run_started)
+        if full_reconcile:
+            snapshot.set_meta("last_full", run_started)
+
+    code = 200 if combined_result["status"] in ("OK", "partial") else 500
+
+    return combined_result, code
+
+
+def sync_all(tenant=DEFAULT_TENANT):
+    """/cleanup, /create_new_students and /create_new_staff_teacher as one run; returns (result, http code).
+
+    Veracross fetches are pinned in fetch_cache for the whole run, so the
+    create steps filter their new users out of the cleanup's full listing
+    instead of downloading it again; only the future-student and future-staff
+    role passes are fetched for them. Tokens come from the token cache, so
+    each system is logged into once. Each step is claimed under its route's
+    job name, so it never overlaps that route running for the tenant on its
+    own (it attaches to that run instead).
+    """
+    results = {}
+    steps = (("cleanup", "cleanup", sync_cleanup), ("new_students", "create_new_students", sync_new_students),
+             ("new_staff_teacher", "create_new_staff_teacher", sync_new_staff))
+    with fetch_cache.pinned(), span("sync_all"):
+        for step, name, fn in steps:
+            record = job_queue.run_attached(f"{name}:{tenant.key}", partial(fn, tenant=tenant))
+            results[step] = record["result"] or {"status": "error", "message": record["error"] or "Job failed"}
+
+    failed = [step for step, result in results.items() if result.get("status") not in ("OK", "partial")]
+    status = "OK" if not failed else "partial" if len(failed) < len(results) else "error"
+    return {"status": status, **results}, 500 if status == "error" else 200
+
+
+def tenant_for(key):
+    """The tenant a stored plan or journal run was made for (runs from before tenants used the default)."""
+    return TENANTS.get(key) or DEFAULT_TENANT
+
+
+def apply_plan(plan_id):
+    """Apply a plan stored by /cleanup?dry_run=1 without re-fetching either system; returns (result, http code).
+
+    The plan is claimed before any write, so it is applied at most once; after
+    a partial failure, resume its journal run. Acknowledged writes go through
+    to the mirror, but last_sync is not advanced: the plan may predate the last sync.
+    """
+    try:
+        plan, to_add, to_update, to_delete = PlanStore().claim(plan_id)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 409
+    tenant = tenant_for(plan["tenant"])
+    mosyle_jwt = tenant.mosyle_jwt()
+    if not mosyle_jwt:
+        return {"status":"error","message":"Mosyle JWT is missing"}, 500
+
+    with span("apply"), tenant.activate():
+        # The plan id doubles as the journal run id.
+        combined_result = apply_journaled("cleanup_plan", plan["mode"], mosyle_jwt, to_add, to_update, to_delete,
+                                          run_id=plan_id, mirror=tenant.snapshot(), tenant=tenant)
+    combined_result["mode"] = plan["mode"]
+    combined_result["plan_id"] = plan_id
+
+    code = 200 if combined_result["status"] in ("OK", "partial") else 500
+    return combined_result, code
+
+
+def resume_run(run_id):
+    """Resend a journaled run's unacknowledged elements, without re-fetching or re-planning; returns (result, http code).
+
+    Acknowledged writes go through to the mirror; last_sync is not advanced.
+    """
+    journal = open_journal()
+    try:
+        run = journal.claim(run_id)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 409
+    try:
+        tenant = tenant_for(journal.summary(run_id)["tenant"])
+        mosyle_jwt = tenant.mosyle_jwt()
+        if not mosyle_jwt:
+            return {"status":"error","message":"Mosyle JWT is missing"}, 500
+        with span("apply"), tenant.activate():
+            result = replay_elements(tenant.mosyle_users_url,tenant.mosyle_token,mosyle_jwt,run.pending(),Recorders(run, tenant.snapshot()),
+                                     refresh_jwt=tenant.refresh_mosyle_jwt,limiter=tenant.limiter)
+    finally:
+        status = run.finish()
+    result["run_id"] = run_id
+    result["journal"] = status
+
+    code = 200 if result["status"] in ("OK", "partial") else 500
+    return result, code
+
 
-        mosyle_users = mosyle_users.rename(columns={
-                "name": "full_name",
-                "email": "email_1",
-                "grade": "grade_level"
-            })
+def in_tenant(fn, tenant):
+    """fn bound to tenant, run inside the tenant's connection pool."""
+    def job():
+        with tenant.activate():
+            return fn(tenant=tenant)
+    return job
 
 
+def sync_all_tenants(fn=sync_cleanup, name="cleanup", tenants=None):
+    """Run fn for every tenant, TENANT_PARALLELISM at a time; returns (result, http code).
 
-        #normalize type of id
-        vc_users_df["id"] = vc_users_df["id"].astype(str)
-        mosyle_users["id"] = mosyle_users["id"].astype(str)
-        vc_users_df = vc_users_df.fillna("")
-        mosyle_users = mosyle_users.fillna("")
+    Each tenant's run is claimed under its own job name (f"{name}:{key}"), so
+    it never overlaps a /cleanup?tenant=<key> already running in any worker,
+    and one tenant's failure does not stop the others.
+    """
+    tenants = list(tenants or TENANTS.values())
 
+    def run(tenant):
+        record = job_queue.run_attached(f"{name}:{tenant.key}", in_tenant(fn, tenant))
+        return record["result"] or {"status": "error", "message": record["error"] or "Job failed"}
 
+    with span(f"{name}_all"), ThreadPoolExecutor(max_workers=max(1, min(TENANT_PARALLELISM, len(tenants)))) as pool:
+        # Copies of this context, so each tenant's run counts toward the calling job.
+        futures = [pool.submit(contextvars.copy_context().run, run, tenant) for tenant in tenants]
+        results = {tenant.key: future.result() for tenant, future in zip(tenants, futures)}
 
-        to_add_df =  vc_users_df[~vc_users_df["id"].isin(mosyle_users["id"])]
-        # print(to_add_df,"add")
-        # to_add_df.to_csv("add.csv", index=False)
+    failed = [key for key, result in results.items() if result.get("status") not in ("OK", "partial")]
+    status = "OK" if not failed else "partial" if len(failed) < len(results) else "error"
+    return {"status": status, "tenants": results}, 500 if status == "error" else 200
 
-        to_delete_df = mosyle_users[~mosyle_users["id"].isin(vc_users_df["id"])]
-        to_delete_df = to_delete_df[to_delete_df["type"].str.upper() != "ADMIN"]
 
-        # print(to_delete_df,"delete")
-        # to_delete_df.to_csv("delete.csv", index=False)
+def schedule(name, job, every):
+    """Queue job every `every` seconds from this process.
 
-        # Merge VC and Mosyle on id
-        merged = vc_users_df.merge(mosyle_users, on="id", suffixes=("_vc", "_mosyle"))
+    Every gunicorn worker runs the timer; the job store coalesces their
+    submissions onto one run per period.
+    """
+    def loop():
+        while True:
+            time.sleep(every)
+            try:
+                job_queue.submit(name, job, min_interval=every / 2)
+            except Exception:
+                logger.exception(f"Could not queue {name}")
 
-        # Find rows where any field differs
-        update_mask = (
-            (merged["full_name_vc"] != merged["full_name_mosyle"]) |
-            (merged["email_1_vc"] != merged["email_1_mosyle"]) |
-            (merged["grade_level_vc"] != merged["grade_level_mosyle"]) |
-            (merged["type_vc"] != merged["type_mosyle"])
-        )
+    threading.Thread(target=loop, name=f"schedule-{name}", daemon=True).start()
 
-        to_update = merged[update_mask]
-        to_update = to_update[to_update["type_mosyle"].str.upper() != "ADMIN"]
-        # to_update.to_csv("update_mask.csv", index=False)
 
+if MIRROR_REFRESH_SECONDS > 0:
+    for _tenant in TENANTS.values():
+        if _tenant.snapshot_db:
+            schedule(f"mirror_refresh:{_tenant.key}", in_tenant(refresh_mirror, _tenant), MIRROR_REFRESH_SECONDS)
+if CLEANUP_SCHEDULE_SECONDS > 0:
+    schedule("cleanup_all", sync_all_tenants, CLEANUP_SCHEDULE_SECONDS)
+if SYNC_ALL_SCHEDULE_SECONDS > 0:
+    schedule("sync_all_tenants", partial(sync_all_tenants, sync_all, "sync_all"), SYNC_ALL_SCHEDULE_SECONDS)
 
-        # Keep only VC columns for update
-        to_update = to_update[['id', 'full_name_vc', 'email_1_vc', 'grade_level_vc', 'type_vc']]
 
-        # Optional: rename back to VC names
-        to_update = to_update.rename(columns={
-            "full_name_vc": "full_name",
-            "email_1_vc": "email_1",
-            "grade_level_vc": "grade_level",
-            "type_vc": "type"
-        })
-        logger.info("to_add=%d", len(to_add_df))
-        logger.info("to_delete=%d", len(to_delete_df))
-        logger.info("to_update=%d", len(to_update))
+def requested_tenant():
+    """The tenant named by ?tenant= (the default tenant without it), or None if unknown."""
+    key = request.args.get("tenant")
+    return TENANTS.get(key) if key else DEFAULT_TENANT
 
-        # to_update = to_update[vc_users_df.columns]
-        # print(to_update,"update")
-        # to_update = to_update[to_update["type"].str.upper() != "ADMIN"]
 
-        # to_update.to_csv("update.csv", index=False)
+def unknown_tenant():
+    return jsonify({"status": "error", "message": "Unknown tenant"}), 404
 
-        result_updated = create_users(MOSYLE_USERS_URL = MOSYLE_USERS_URL,accessToken=MOSYLE_TOKEN,jwt_token=mosyle_jwt,users = to_update,operation="update")
-        result_added = create_users(MOSYLE_USERS_URL = MOSYLE_USERS_URL,accessToken=MOSYLE_TOKEN,jwt_token=mosyle_jwt,users = to_add_df,operation="save")
-        result_deleted = delete_users(MOSYLE_USERS_URL = MOSYLE_USERS_URL,accessToken=MOSYLE_TOKEN,jwt_token=mosyle_jwt,users = to_delete_df)
 
-        # print(result_updated)
+def run_bypassing_cache(job):
+    with bypassed():
+        return job()
 
 
+def dispatch(name, job, min_interval=MIN_RUN_INTERVAL):
+    """Run job inline, or with BACKGROUND_JOBS (and no ?wait=1) queue it on the background runner and return its id.
 
+    Requests that overlap an active run of the same job (from any worker)
+    attach to that run instead of starting another. ?bypass_cache=1 fetches
+    every Veracross page again instead of using the response or fetch cache.
+    """
+    if request.args.get("bypass_cache") == "1":
+        job = partial(run_bypassing_cache, job)
+    if not BACKGROUND_JOBS or request.args.get("wait") == "1":
+        record = job_queue.run_inline(name, job, min_interval)
+        if record["result"] is None:
+            return jsonify({"status": "error", "message": record["error"] or "Job failed"}), 500
+        return jsonify(record["result"]), 200 if record["status"] == "done" else 500
 
-       
-        combined_result = {
-            "status": "OK" if result_updated["status"] == "OK" and result_added["status"] == "OK" and result_deleted["status"] == "OK" else "partial",
-            "updated": result_updated.get("updated", 0) + result_added.get("updated", 0) ,
-            "deleted": result_deleted.get("deleted", 0),
-            "failed": result_updated.get("failed", 0) + result_added.get("failed", 0) + result_deleted.get("failed", 0),
-            "failures": result_updated.get("failures", []) + result_added.get("failures", []) + result_deleted.get("failures", [])
-        }
+    job_id, created = job_queue.submit(name, job, min_interval)
+    return jsonify({"status": "queued" if created else "attached", "job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
 
-        code = 200 if combined_result["status"] in ("OK", "partial") else 500
 
-        return jsonify(combined_result), code
-    except Exception as e:
-        logger.exception("Job failed")
-        return jsonify({"status": "error", "message": str(e)}), 500
+def dispatch_writes(route, tenant, job):
+    """dispatch a stored plan's apply or a journal resume as the tenant's f"{route}:{key}" run.
+
+    It then never overlaps that route (or a /sync_all step, plan or resume)
+    running for the tenant. While one is active it is refused, not attached
+    to: that run's result would not be this job's.
+    """
+    name = f"{route}:{tenant.key}"
+    if job_queue.store.active(name):
+        return jsonify({"status": "error", "message": f"A {route} run is already active for this tenant"}), 409
+    return dispatch(name, job, min_interval=0)
+
+
+@app.route("/create_new_students")
+def create_students():
+    tenant = requested_tenant()
+    if tenant is None:
+        return unknown_tenant()
+    return dispatch(f"create_new_students:{tenant.key}", in_tenant(partial(sync_new_students, stream=streaming_requested()), tenant))
+
+
+@app.route("/create_new_staff_teacher")
+def create_staffs():
+    tenant = requested_tenant()
+    if tenant is None:
+        return unknown_tenant()
+    return dispatch(f"create_new_staff_teacher:{tenant.key}", in_tenant(partial(sync_new_staff, stream=streaming_requested()), tenant))
+
+
+@app.route("/cleanup")
+def cleanup():
+    # ?dry_run=1 stores and summarizes the plan; ?plan_id=<id> applies a stored one.
+    plan_id = request.args.get("plan_id")
+    if plan_id:
+        plans = PlanStore()
+        found = plans.get(plan_id)
+        if found is None:
+            return jsonify({"status": "error", "message": "Unknown plan id"}), 404
+        problem = plans.unusable(found[0])
+        if problem:
+            return jsonify({"status": "error", "message": problem}), 409
+        return dispatch_writes("cleanup", tenant_for(found[0]["tenant"]), partial(apply_plan, plan_id))
+    tenant = requested_tenant()
+    if tenant is None:
+        return unknown_tenant()
+    if request.args.get("dry_run") == "1":
+        return dispatch(f"cleanup_dry_run:{tenant.key}", in_tenant(partial(sync_cleanup, dry_run=True), tenant))
+    return dispatch(f"cleanup:{tenant.key}", in_tenant(sync_cleanup, tenant))
+
+
+@app.route("/cleanup_all")
+def cleanup_all():
+    # One /cleanup per tenant; the result is keyed by tenant.
+    return dispatch("cleanup_all", sync_all_tenants)
+
+
+@app.route("/sync_all")
+def sync_all_route():
+    # Cleanup plus both create routes from one fetch of each source.
+    tenant = requested_tenant()
+    if tenant is None:
+        return unknown_tenant()
+    return dispatch(f"sync_all:{tenant.key}", in_tenant(sync_all, tenant))
+
+
+@app.route("/sync_all_tenants")
+def sync_all_tenants_route():
+    return dispatch("sync_all_tenants", partial(sync_all_tenants, sync_all, "sync_all"))
+
+
+@app.route("/mirror/refresh")
+def mirror_refresh():
+    tenant = requested_tenant()
+    if tenant is None:
+        return unknown_tenant()
+    return dispatch(f"mirror_refresh:{tenant.key}", in_tenant(refresh_mirror, tenant))
+
+
+@app.route("/tenants")
+def tenants():
+    return jsonify([tenant.describe() for tenant in TENANTS.values()]), 200
+
+
+@app.route("/cache/stats")
+def cache_stats():
+    # Hit, miss and revalidation counts are in /metrics (sync_response_cache_total).
+    cache = open_response_cache()
+    if cache is None:
+        return jsonify({"status": "error", "message": "VC_RESPONSE_CACHE_DB is not set"}), 404
+    return jsonify(cache.stats()), 200
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job id"}), 404
+    return jsonify(job), 200
+
+
+@app.route("/journal/<run_id>")
+def journal_status(run_id):
+    journal = open_journal()
+    summary = journal.summary(run_id) if journal else None
+    if summary is None:
+        return jsonify({"status": "error", "message": "Unknown run id"}), 404
+    return jsonify(summary), 200
+
+
+@app.route("/journal/<run_id>/resume")
+def resume(run_id):
+    journal = open_journal()
+    summary = journal.summary(run_id) if journal else None
+    if summary is None:
+        return jsonify({"status": "error", "message": "Unknown run id"}), 404
+    problem = journal.unusable(summary)
+    if problem:
+        return jsonify({"status": "error", "message": problem}), 409
+    # cleanup and cleanup_plan runs resume as /cleanup, create runs as their route.
+    route = "cleanup" if summary["name"].startswith("cleanup") else summary["name"]
+    return dispatch_writes(route, tenant_for(summary["tenant"]), partial(resume_run, run_id))
+
+
+@app.route("/metrics")
+def metrics():
+    # Counters are per process; scrape each gunicorn worker (or run one) for totals.
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import httpx
+from mosyle_api import frame_elements, delete_elements, batch_statuses, tally, DEFAULT_LOCATION, SPLIT_ATTEMPTS, SPLIT_STATUSES, THROTTLED_RETRIES
+from rate_limit import mosyle_limiter
+from http_session import outbound_slot
+from jobs import count_progress
+from metrics import span, observe_response, RETRIES, BATCH_SPLITS
+from request_body import RequestBody
+
+logger = logging.getLogger("Mosyle Integration")
+
+# Requests in flight across the update, add and delete phases together.
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", "5"))
+
+
+class AsyncMosyle:
+    """One httpx.AsyncClient and one concurrency budget shared by every phase of a sync.
+
+    Every request also goes through the tenant's AdaptiveLimiter (as the
+    threaded writers' do) and takes an OUTBOUND_MAX_CONCURRENCY slot, so a
+    429 pauses this engine and any other caller of the same Mosyle account,
+    and batch sizes follow the limiter's probing and 413 ceiling. A 401
+    refreshes the JWT once per stale token via the synchronous refresh_jwt.
+    """
+
+    def __init__(self, MOSYLE_USERS_URL, accessToken, jwt_token, refresh_jwt=None,
+                 max_concurrency=ASYNC_MAX_CONCURRENCY, client=None, limiter=None):
+        self.url = MOSYLE_USERS_URL
+        self.accessToken = accessToken
+        self.jwt_token = jwt_token
+        self.refresh_jwt = refresh_jwt
+        self.limiter = limiter or mosyle_limiter
+        self.max_concurrency = max_concurrency
+        self.budget = asyncio.Semaphore(max_concurrency)
+        self.client = client or httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            timeout=15,
+        )
+        self._refresh_lock = asyncio.Lock()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _refresh(self, stale_token):
+        if self.refresh_jwt is None:
+            return False
+        async with self._refresh_lock:
+            if self.jwt_token == stale_token:
+                new_token = await asyncio.to_thread(self.refresh_jwt, stale_token)
+                if not new_token:
+                    return False
+                self.jwt_token = new_token
+        return True
+
+    async def post_elements(self, elements_list, attempts=5):
+        """Async counterpart of mosyle_api.post_elements, with the same result shape."""
+        body = headers = None
+        refreshed = False
+        last_error = "429 Too Many Requests"
+        status_code = None
+        operation = elements_list[0].get("operation", "") if elements_list else ""
+        attempt = throttled = 0
+        with span("mosyle_batch", operation=operation):
+            while attempt < attempts:
+                if attempt or throttled:
+                    RETRIES.inc(operation=operation)
+                attempt += 1
+                try:
+                    async with self.budget:
+                        if body is None:
+                            # Encoded once a slot is free, not when the batch is queued: the
+                            # pending batches' bodies are not all held at once, and a gzip
+                            # refusal seen meanwhile is already known.
+                            body = RequestBody(self.url, {"accessToken": self.accessToken, "elements": elements_list})
+                            headers = {"Authorization": self.jwt_token, **body.headers}
+                        async with outbound_slot():
+                            resp = await self.limiter.call_async(
+                                lambda: self.client.post(self.url, content=body.data, headers=headers),
+                                timeouts=(httpx.TimeoutException,))
+                    body.sent()
+                    observe_response("mosyle", resp)
+                    if resp.status_code == 401 and not refreshed and await self._refresh(headers["Authorization"]):
+                        refreshed = True
+                        headers = {"Authorization": self.jwt_token, **body.headers}
+                        continue
+                    if resp.status_code == 429:
+                        # The limiter pauses every caller for Retry-After.
+                        if throttled < THROTTLED_RETRIES:
+                            throttled += 1
+                            attempt -= 1
+                        continue
+                    if body.refused(resp.status_code):
+                        headers = {"Authorization": self.jwt_token, **body.headers}
+                        continue
+                    status_code = resp.status_code
+                    if resp.status_code == 413:
+                        self.limiter.too_large(len(elements_list))
+                    if 400 <= resp.status_code < 500 and resp.status_code != 401:
+                        last_error = f"{resp.status_code} {resp.reason_phrase}: {resp.text[:200]}"
+                        break
+                    resp.raise_for_status()
+                    body.accepted()
+                    try:
+                        resp_json = resp.json()
+                    except ValueError:
+                        resp_json = {}
+                    count_progress("batches_sent")
+                    return {"success": True, "response": resp_json}
+                except Exception as e:
+                    last_error = str(e)
+                    await asyncio.sleep(self.limiter.backoff(attempt - 1))
+        count_progress("failures")
+        return {"success": False, "error": last_error, "status_code": status_code}
+
+    async def send_elements(self, elements_list, attempts=5):
+        """Async counterpart of mosyle_api.send_elements: statuses per element, splitting rejected batches."""
+        result = await self.post_elements(elements_list, attempts)
+        if result["success"] or result["status_code"] not in SPLIT_STATUSES or len(elements_list) == 1:
+            return batch_statuses(elements_list, result)
+        BATCH_SPLITS.inc(operation=elements_list[0].get("operation", ""))
+        middle = len(elements_list) // 2
+        first, second = await asyncio.gather(self.send_elements(elements_list[:middle], SPLIT_ATTEMPTS),
+                                             self.send_elements(elements_list[middle:], SPLIT_ATTEMPTS))
+        return first + second
+
+    async def post_recorded(self, elements_list, recorder=None):
+        """send_elements, then pass the batch's per-element statuses to recorder (if any); returns tally()."""
+        statuses = await self.send_elements(elements_list)
+        if recorder:
+            await asyncio.to_thread(recorder.record, elements_list, statuses)
+        return tally(elements_list, statuses)
+
+    async def run_batches(self, elements, recorder=None, batch_size=None):
+        """post_recorded over elements cut into batches as max_concurrency workers free up; returns every tally().
+
+        Like mosyle_api.run_batches, each batch is sized by the limiter's
+        current batch_size (at most batch_size).
+        """
+        cursor = 0
+
+        async def worker():
+            nonlocal cursor
+            results = []
+            while cursor < len(elements):
+                start = cursor
+                cursor += self.limiter.batch_size(batch_size)
+                results.append(await self.post_recorded(elements[start:cursor], recorder))
+            return results
+
+        per_worker = await asyncio.gather(*(worker() for _ in range(self.max_concurrency)))
+        return [result for results in per_worker for result in results]
+
+    async def save(self, users, operation, batch_size=None, recorder=None, location=DEFAULT_LOCATION):
+        """create_users over the shared client; returns the same result dict."""
+        if users.empty:
+            return {"message": "No users are available to add", "status": "OK"}
+        results = await self.run_batches(frame_elements(users, operation, location), recorder, batch_size)
+        updated = sum(acknowledged for acknowledged, _ in results)
+        failures = [failure for _, batch_failures in results for failure in batch_failures]
+        logger.info("%s done for %d users", operation, updated)
+        return {"status": "OK" if not failures else "partial", "updated": updated,
+                "failed": len(failures), "failures": failures[:20]}
+
+    async def delete(self, users, batch_size=None, recorder=None):
+        """delete_users over the shared client; returns the same result dict."""
+        if users.empty:
+            return {"message": "No users to delete", "status": "OK"}
+        results = await self.run_batches(delete_elements(users), recorder, batch_size)
+        deleted = sum(acknowledged for acknowledged, _ in results)
+        failures = [failure for _, batch_failures in results for failure in batch_failures]
+        return {"status": "OK" if not failures else "partial", "deleted": deleted,
+                "failed": len(failures), "failures": failures[:20]}
+
+
+async def apply_changes_async(MOSYLE_USERS_URL, accessToken, jwt_token, to_add_df, to_update, to_delete_df,
+                              refresh_jwt=None, max_concurrency=ASYNC_MAX_CONCURRENCY, batch_size=None, client=None,
+                              recorder=None, location=DEFAULT_LOCATION, limiter=None):
+    """Run the update, add and delete phases concurrently; returns app.apply_changes' result dict."""
+    mosyle = AsyncMosyle(MOSYLE_USERS_URL, accessToken, jwt_token, refresh_jwt=refresh_jwt,
+                         max_concurrency=max_concurrency, client=client, limiter=limiter)
+    try:
+        result_updated, result_added, result_deleted = await asyncio.gather(
+            mosyle.save(to_update, "update", batch_size, recorder, location),
+            mosyle.save(to_add_df, "save", batch_size, recorder, location),
+            mosyle.delete(to_delete_df, batch_size, recorder),
+        )
+    finally:
+        if client is None:
+            await mosyle.aclose()
+
+    return {
+        "status": "OK" if result_updated["status"] == "OK" and result_added["status"] == "OK" and result_deleted["status"] == "OK" else "partial",
+        "updated": result_updated.get("updated", 0) + result_added.get("updated", 0),
+        "deleted": result_deleted.get("deleted", 0),
+        "failed": result_updated.get("failed", 0) + result_added.get("failed", 0) + result_deleted.get("failed", 0),
+        "failures": result_updated.get("failures", []) + result_added.get("failures", []) + result_deleted.get("failures", [])
+    }
+
+
+def apply_changes(*args, **kwargs):
+    """Synchronous entry point: runs apply_changes_async on a fresh event loop."""
+    return asyncio.run(apply_changes_async(*args, **kwargs))
@@ -0,0 +1,72 @@
+"""Per-user cost of building Mosyle save payloads: iterrows batches vs mosyle_api.frame_elements.
+
+    python benchmarks/bench_payload.py                # 1k, 10k, 100k users
+    python benchmarks/bench_payload.py --sizes 50000
+"""
+import argparse
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mosyle_api import frame_elements  # noqa: E402
+
+
+def legacy_elements(users, operation, batch_size=20):
+    """The iloc-slice + iterrows builder create_users used before frame_elements."""
+    batches = [users.iloc[i:i+batch_size] for i in range(0, len(users), batch_size)]
+    out = []
+    for batch_df in batches:
+        elements_list = []
+        for _, user_row in batch_df.iterrows():
+            element = {
+                "operation": operation,
+                "id": user_row["id"],
+                "name": user_row["full_name"],
+                "type": user_row["type"],
+                "email": user_row["email_1"],
+                "welcome_email": 0
+            }
+            if user_row["type"] == "S":
+                element["locations"] = [{"name": "ACS Abu Dhabi", "grade_level": user_row["grade_level"]}]
+            else:
+                element["locations"] = [{"name": "ACS Abu Dhabi"}]
+            elements_list.append(element)
+        out.append(elements_list)
+    return out
+
+
+def chunked_elements(users, operation, batch_size=20):
+    elements = frame_elements(users, operation)
+    return [elements[i:i+batch_size] for i in range(0, len(elements), batch_size)]
+
+
+def synthetic(n):
+    return pd.DataFrame({
+        "id": range(n),
+        "full_name": [f"First{i} Last{i}" for i in range(n)],
+        "email_1": [f"user{i}@acs.sch.ae" for i in range(n)],
+        "grade_level": [f"Grade {i % 12 + 1}" for i in range(n)],
+        "type": ["S" if i % 10 else "T" for i in range(n)],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    args = parser.parse_args()
+
+    print(f"{'users':>8} {'builder':>9} {'seconds':>8} {'us/user':>8}")
+    for n in args.sizes:
+        users = synthetic(n)
+        for name, fn in (("iterrows", legacy_elements), ("columnar", chunked_elements)):
+            start = time.perf_counter()
+            batches = fn(users, "save")
+            elapsed = time.perf_counter() - start
+            assert sum(map(len, batches)) == n
+            print(f"{n:>8} {name:>9} {elapsed:>8.3f} {elapsed / n * 1e6:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
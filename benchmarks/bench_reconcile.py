@@ -0,0 +1,113 @@
+"""Compare roster.plan_rosters with the previous merge/mask reconcile from cleanup().
+
+    python benchmarks/bench_reconcile.py                 # 10k, 100k, 1M users
+    python benchmarks/bench_reconcile.py --sizes 10000
+
+Synthetic rosters: Mosyle holds every Veracross user except 1% (adds), 1% of
+users have a changed field (updates) and 1% extra Mosyle users are stale
+(deletes), plus a handful of ADMIN accounts. Both engines plan from sides
+already built (frames for pandas, Rosters for plan_rosters).
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from roster import Roster, plan_rosters  # noqa: E402
+
+
+def legacy_plan(vc_users_df, mosyle_users):
+    """The pandas isin/merge/mask reconcile cleanup() used before reconcile.py."""
+    vc_users_df = vc_users_df.copy()
+    mosyle_users = mosyle_users.copy()
+    vc_users_df["id"] = vc_users_df["id"].astype(str)
+    mosyle_users["id"] = mosyle_users["id"].astype(str)
+    vc_users_df = vc_users_df.fillna("")
+    mosyle_users = mosyle_users.fillna("")
+    to_add_df = vc_users_df[~vc_users_df["id"].isin(mosyle_users["id"])]
+    to_delete_df = mosyle_users[~mosyle_users["id"].isin(vc_users_df["id"])]
+    to_delete_df = to_delete_df[to_delete_df["type"].str.upper() != "ADMIN"]
+    merged = vc_users_df.merge(mosyle_users, on="id", suffixes=("_vc", "_mosyle"))
+    update_mask = (
+        (merged["full_name_vc"] != merged["full_name_mosyle"]) |
+        (merged["email_1_vc"] != merged["email_1_mosyle"]) |
+        (merged["grade_level_vc"] != merged["grade_level_mosyle"]) |
+        (merged["type_vc"] != merged["type_mosyle"])
+    )
+    to_update = merged[update_mask]
+    to_update = to_update[to_update["type_mosyle"].str.upper() != "ADMIN"]
+    to_update = to_update[["id", "full_name_vc", "email_1_vc", "grade_level_vc", "type_vc"]]
+    to_update = to_update.rename(columns={
+        "full_name_vc": "full_name",
+        "email_1_vc": "email_1",
+        "grade_level_vc": "grade_level",
+        "type_vc": "type"
+    })
+    return to_add_df, to_update, to_delete_df
+
+
+def synthetic(n):
+    ids = range(n)
+    vc = pd.DataFrame({
+        "id": list(ids),
+        "full_name": [f"First{i} Last{i}" for i in ids],
+        "email_1": [f"user{i}@acs.sch.ae" for i in ids],
+        "grade_level": [f"Grade {i % 12 + 1}" if i % 5 else None for i in ids],
+        "type": ["S" if i % 5 else ("T" if i % 2 else "STAFF") for i in ids],
+    })
+    step = 100
+    mosyle = vc[vc["id"] % step != 0].copy()
+    changed = mosyle["id"] % step == 1
+    mosyle.loc[changed, "full_name"] = mosyle.loc[changed, "full_name"] + " Jr"
+    extra = pd.DataFrame({
+        "id": [f"{n + i}" for i in range(n // step)],
+        "full_name": "Stale User",
+        "email_1": "stale@acs.sch.ae",
+        "grade_level": None,
+        "type": ["ADMIN" if i < 5 else "S" for i in range(n // step)],
+    })
+    mosyle["id"] = mosyle["id"].astype(str)
+    return vc, pd.concat([mosyle, extra], ignore_index=True)
+
+
+def ids(part):
+    return frozenset(map(str, part.ids() if isinstance(part, Roster) else part["id"]))
+
+
+def measure(fn, vc, mosyle):
+    # Time and memory are measured in separate runs: tracemalloc slows
+    # Python-level allocation far more than numpy's, which would skew timings.
+    start = time.perf_counter()
+    to_add, to_update, to_delete = fn(vc, mosyle)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn(vc, mosyle)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, tuple(ids(part) for part in (to_add, to_update, to_delete))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"{'users':>9} {'engine':>8} {'seconds':>8} {'peak MB':>8}  add/update/delete")
+    for n in args.sizes:
+        vc, mosyle = synthetic(n)
+        sides = {"pandas": (vc, mosyle),
+                 "roster": (Roster.from_rows(vc.to_dict("records")), Roster.from_rows(mosyle.to_dict("records")))}
+        plans = []
+        for name, fn in (("pandas", legacy_plan), ("roster", plan_rosters)):
+            elapsed, peak, plan_ids = measure(fn, *sides[name])
+            plans.append(plan_ids)
+            print(f"{n:>9} {name:>8} {elapsed:>8.2f} {peak / 2**20:>8.1f}  {tuple(map(len, plan_ids))}")
+        if plans[0] != plans[1]:
+            sys.exit(f"plans differ at {n} users")
+
+
+if __name__ == "__main__":
+    main()
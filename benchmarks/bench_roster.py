@@ -0,0 +1,114 @@
+"""Memory and time of /cleanup's in-memory rosters: DataFrames + the old pandas reconcile vs Rosters + plan_rosters.
+
+    python benchmarks/bench_roster.py                 # 10k, 100k, 500k users
+    python benchmarks/bench_roster.py --sizes 200000
+
+Both pipelines consume Mosyle-shaped row dicts page by page, as the fetch
+layer produces them, build the Veracross and Mosyle sides and plan the
+sync. The frame pipeline collects every row dict before building its frame
+(as get_students and list_users did); the roster pipeline turns each page
+into User records as it arrives. "held MB" is what the two built sides keep
+alive, "peak MB" the high-water mark of the whole pipeline. Same synthetic
+drift as bench_reconcile.py: 1% adds, 1% updates, 1% stale Mosyle users.
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_reconcile import legacy_plan  # noqa: E402
+from roster import Roster, plan_rosters  # noqa: E402
+
+
+PAGE_SIZE = 1000
+
+
+def vc_pages(n):
+    """Veracross-side rows as the fetch layer yields them: fresh dicts, one page at a time."""
+    grades = [f"Grade {g}" for g in range(1, 13)]
+    for first in range(0, n, PAGE_SIZE):
+        yield [{"id": i, "full_name": f"First{i} Last{i}", "email_1": f"user{i}@acs.sch.ae",
+                "grade_level": grades[i % 12] if i % 5 else None, "type": "S" if i % 5 else "T"}
+               for i in range(first, min(first + PAGE_SIZE, n))]
+
+
+def mosyle_pages(n):
+    """Mosyle-side rows: every Veracross user but 1%, 1% renamed, plus 1% stale accounts."""
+    for page in vc_pages(n):
+        rows = []
+        for row in page:
+            if row["id"] % 100:
+                row["id"] = str(row["id"])
+                # Parsed from JSON, so every grade is its own str object.
+                row["grade_level"] = "".join(row["grade_level"]) if row["grade_level"] else None
+                if int(row["id"]) % 100 == 1:
+                    row["full_name"] += " Jr"
+                rows.append(row)
+        yield rows
+    yield [{"id": f"{n + i}", "full_name": "Stale User", "email_1": "stale@acs.sch.ae",
+            "grade_level": None, "type": "S"} for i in range(n // 100)]
+
+
+def collect(pages):
+    rows = []
+    for page in pages:
+        rows.extend(page)
+    return rows
+
+
+def frame_pipeline(n):
+    # As the removed get_students() and list_users() + the cleanup() rename did: collect
+    # every row dict, build the frame, then select, dedupe and rename.
+    vc = pd.DataFrame(collect(vc_pages(n)))[["id", "full_name", "email_1", "grade_level", "type"]].drop_duplicates()
+    mosyle = pd.DataFrame(collect(mosyle_pages(n))).rename(columns={"name": "full_name"})
+    return (vc, mosyle), legacy_plan(vc, mosyle)
+
+
+def roster_pipeline(n):
+    vc = Roster.concat(Roster.from_rows(page) for page in vc_pages(n)).unique()
+    mosyle = Roster.concat(Roster.from_rows(page) for page in mosyle_pages(n))
+    return (vc, mosyle), plan_rosters(vc, mosyle)
+
+
+def measure(fn, n):
+    # Timed without tracemalloc, which slows Python-level allocation.
+    start = time.perf_counter()
+    sides, plan = fn(n)
+    elapsed = time.perf_counter() - start
+    counts = tuple(len(part) for part in plan)
+    del sides, plan
+    gc.collect()
+
+    tracemalloc.start()
+    sides, plan = fn(n)
+    peak = tracemalloc.get_traced_memory()[1]
+    del plan
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sides
+    return elapsed, peak, held, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 500_000])
+    args = parser.parse_args()
+
+    print(f"{'users':>9} {'engine':>8} {'seconds':>8} {'peak MB':>8} {'held MB':>8}  add/update/delete")
+    for n in args.sizes:
+        counts = []
+        for name, fn in (("frames", frame_pipeline), ("roster", roster_pipeline)):
+            elapsed, peak, held, plan_counts = measure(fn, n)
+            counts.append(plan_counts)
+            print(f"{n:>9} {name:>8} {elapsed:>8.2f} {peak / 2**20:>8.1f} {held / 2**20:>8.1f}  {plan_counts}")
+        if counts[0] != counts[1]:
+            sys.exit(f"plans differ at {n} users")
+
+
+if __name__ == "__main__":
+    main()
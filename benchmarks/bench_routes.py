@@ -0,0 +1,186 @@
+"""End-to-end route benchmarks against the local fake Veracross/Mosyle servers.
+
+    python benchmarks/bench_routes.py                              # 1k and 10k students
+    python benchmarks/bench_routes.py --sizes 1000 100000 500000 --out after.json
+    python benchmarks/bench_routes.py --latency 0.05 --throttle-every 25 --compare before.json
+    python benchmarks/bench_routes.py --routes "/cleanup" "/create_new_students?stream=1"
+
+For each roster size a fresh benchmarks/fake_services.py server is started;
+before each route it is reset to the seeded roster. Every route runs inline
+(?wait=1) in its own Python process, so the peak RSS reported is the app's
+alone. Reported per route: wall time, peak RSS, requests the fakes received,
+requests/sec and the bytes of Mosyle write bodies on the wire. Results are
+written as JSON; --compare prints the ratio of wall time and peak RSS
+against an earlier results file.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SERVICES = os.path.join(ROOT, "benchmarks", "fake_services.py")
+ROUTES = ["/create_new_students", "/create_new_staff_teacher", "/cleanup"]
+RESULT_PREFIX = "BENCH_RESULT "
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def call_fake(base, path, method="GET"):
+    request = urllib.request.Request(base + path, method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(request, timeout=600) as response:
+        return json.loads(response.read())
+
+
+def start_fake(port, students, args):
+    command = [sys.executable, FAKE_SERVICES, "--port", str(port), "--students", str(students),
+               "--latency", str(args.latency), "--throttle-every", str(args.throttle_every),
+               "--max-rps", str(args.fake_max_rps), "--max-batch", str(args.max_batch),
+               "--reject-every", str(args.reject_every)]
+    if args.refuse_gzip:
+        command.append("--refuse-gzip")
+    if args.staff is not None:
+        command += ["--staff", str(args.staff)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(600):
+        try:
+            call_fake(base, "/_stats")
+            return process, base
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("fake services did not start")
+
+
+def run_route(route, base):
+    """Child process: import the app against the fakes and run one route inline."""
+    sys.path.insert(0, ROOT)
+    # Every tenant's hosts point at the fakes (see tenants.load_tenants).
+    for name in ("VC_ACCOUNTS_URL", "VC_API_URL", "MOSYLE_API_URL"):
+        os.environ[name] = base
+    import app
+
+    client = app.app.test_client()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    response = client.get(route + ("&" if "?" in route else "?") + "wait=1")
+    wall = time.perf_counter() - start
+    body = response.get_json(silent=True) or {}
+    print(RESULT_PREFIX + json.dumps({
+        "http_status": response.status_code,
+        "wall_seconds": round(wall, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "import_rss_mb": round(baseline_rss / 1024, 1),
+        "result": {key: body.get(key) for key in ("status", "mode", "updated", "deleted", "failed")},
+    }), flush=True)
+
+
+def bench_route(route, base, args):
+    call_fake(base, "/_reset", method="POST")
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   VC_CLIENT_ID="bench", VC_CLIENT_SECRET="bench", MOSYLE_EMAIL="bench",
+                   MOSYLE_PASSWORD="bench", MOSYLE_ACCESS_TOKEN="bench",
+                   BACKGROUND_JOBS="0", JOBS_DB=os.path.join(tmp, "jobs.db"),
+                   SNAPSHOT_DB="", TOKEN_CACHE_FILE="", LOG_LEVEL="WARNING",
+                   MOSYLE_MAX_RPS=str(args.mosyle_max_rps))
+        child = subprocess.run([sys.executable, __file__, "--child", route, "--base", base],
+                               env=env, capture_output=True, text=True)
+    lines = [line for line in child.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if child.returncode or not lines:
+        raise RuntimeError(f"{route} failed:\n{child.stderr[-2000:]}")
+    result = json.loads(lines[-1][len(RESULT_PREFIX):])
+    stats = call_fake(base, "/_stats")
+    result["requests"] = stats["requests"]
+    result["throttled"] = stats["throttled"]
+    result["write_bytes"] = stats["write_bytes"]
+    result["requests_per_second"] = round(stats["requests"] / result["wall_seconds"], 1) if result["wall_seconds"] else None
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["students"], r["route"]): r for r in json.load(f)["results"]}
+    print(f"\nvs {baseline_path}:")
+    for r in results:
+        before = baseline.get((r["students"], r["route"]))
+        if before is None:
+            continue
+        print(f"{r['route']:<36} {r['students']:>8,}  wall x{r['wall_seconds'] / max(before['wall_seconds'], 1e-9):.2f}"
+              f"  rss x{r['peak_rss_mb'] / max(before['peak_rss_mb'], 1e-9):.2f}"
+              f"  requests {before['requests']} -> {r['requests']}"
+              f"  write bytes {before.get('write_bytes', '?')} -> {r['write_bytes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000], help="student roster sizes")
+    parser.add_argument("--staff", type=int, help="staff roster size (default: students / 10)")
+    parser.add_argument("--routes", nargs="+", default=ROUTES)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fakes add to every request")
+    parser.add_argument("--throttle-every", type=int, default=0, help="429 every Nth Mosyle write")
+    parser.add_argument("--fake-max-rps", type=float, default=0.0, help="429 Mosyle writes beyond this rate")
+    parser.add_argument("--max-batch", type=int, default=0, help="413 Mosyle writes with more elements")
+    parser.add_argument("--reject-every", type=int, default=0, help="400 Mosyle writes holding an id divisible by this")
+    parser.add_argument("--refuse-gzip", action="store_true", help="415 gzip-encoded Mosyle writes")
+    parser.add_argument("--mosyle-max-rps", type=float, default=100.0,
+                        help="MOSYLE_MAX_RPS for the app (the production default of 10 makes large rosters slow)")
+    parser.add_argument("--out", default="bench_routes.json")
+    parser.add_argument("--compare", help="earlier --out file to compare against")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--base", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_route(args.child, args.base)
+
+    results = []
+    print(f"{'route':<36} {'students':>8} {'wall s':>8} {'peak MB':>8} {'requests':>9} {'req/s':>8} {'write KB':>9}")
+    for students in args.sizes:
+        process, base = start_fake(free_port(), students, args)
+        try:
+            for route in args.routes:
+                result = {"route": route, "students": students, **bench_route(route, base, args)}
+                results.append(result)
+                print(f"{route:<36} {students:>8,} {result['wall_seconds']:>8.2f} {result['peak_rss_mb']:>8.1f} "
+                      f"{result['requests']:>9} {result['requests_per_second'] or 0:>8.1f} {result['write_bytes'] / 1024:>9.1f}",
+                      flush=True)
+        finally:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "meta": {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": git_revision(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "options": {key: value for key, value in vars(args).items() if key not in ("child", "base")}},
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved {args.out}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Cold start: import time, first-request latency and what the app loads on the way.
+
+    python benchmarks/bench_startup.py                         # 5 cold starts
+    python benchmarks/bench_startup.py --runs 10 --out after.json --compare before.json
+    python benchmarks/bench_startup.py --gunicorn              # also time gunicorn to its first response
+
+Every run is a fresh Python process (as on a Cloud Run cold start): it
+imports app, serves GET /tenants (the cheapest route) and then one sync route
+inline against benchmarks/fake_services.py. Reported (medians over --runs):
+process start to app imported, the first request, the first sync request,
+the whole process, and which heavy modules (pandas, numpy, httpx) each step
+loaded. With --gunicorn, gunicorn is started with gunicorn.conf.py and timed
+until it answers /tenants.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from bench_routes import ROOT, FAKE_SERVICES, RESULT_PREFIX, free_port, call_fake, git_revision
+
+HEAVY_MODULES = ("pandas", "numpy", "httpx")
+STEPS = ("import_seconds", "first_request_seconds", "first_sync_seconds", "process_seconds")
+
+
+def loaded():
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def run_child(route, base):
+    """Child process: time importing the app, its first request and its first sync request."""
+    start = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    for name in ("VC_ACCOUNTS_URL", "VC_API_URL", "MOSYLE_API_URL"):
+        os.environ[name] = base
+    import app
+    imported = time.perf_counter()
+    after_import = loaded()
+
+    client = app.app.test_client()
+    client.get("/tenants")
+    first = time.perf_counter()
+    response = client.get(route + ("&" if "?" in route else "?") + "wait=1")
+    synced = time.perf_counter()
+    print(RESULT_PREFIX + json.dumps({
+        "import_seconds": round(imported - start, 4),
+        "first_request_seconds": round(first - imported, 4),
+        "first_sync_seconds": round(synced - first, 4),
+        "sync_status": response.status_code,
+        "loaded_by_import": after_import,
+        "loaded_by_sync": loaded(),
+    }), flush=True)
+
+
+def child_env(tmp):
+    return dict(os.environ,
+                VC_CLIENT_ID="bench", VC_CLIENT_SECRET="bench", MOSYLE_EMAIL="bench",
+                MOSYLE_PASSWORD="bench", MOSYLE_ACCESS_TOKEN="bench",
+                BACKGROUND_JOBS="0", JOBS_DB=os.path.join(tmp, "jobs.db"), JOURNAL_DB="",
+                SNAPSHOT_DB="", TOKEN_CACHE_FILE="", LOG_LEVEL="WARNING", MOSYLE_MAX_RPS="100")
+
+
+def cold_start(route, base):
+    call_fake(base, "/_reset", method="POST")
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        child = subprocess.run([sys.executable, __file__, "--child", route, "--base", base],
+                               env=child_env(tmp), capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+    lines = [line for line in child.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if child.returncode or not lines:
+        raise RuntimeError(f"cold start failed:\n{child.stderr[-2000:]}")
+    return {**json.loads(lines[-1][len(RESULT_PREFIX):]), "process_seconds": round(elapsed, 4)}
+
+
+def gunicorn_start(base, timeout=60):
+    """Seconds from launching gunicorn (gunicorn.conf.py) to its first /tenants response, or None if not installed."""
+    if shutil.which("gunicorn") is None:
+        return None
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(child_env(tmp), PORT=str(port), VC_ACCOUNTS_URL=base, VC_API_URL=base, MOSYLE_API_URL=base)
+        start = time.perf_counter()
+        process = subprocess.Popen(["gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"), "app:app"],
+                                   cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - start < timeout:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/tenants", timeout=1):
+                        return round(time.perf_counter() - start, 4)
+                except OSError:
+                    time.sleep(0.01)
+            raise RuntimeError("gunicorn did not answer")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def start_fake(students):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, FAKE_SERVICES, "--port", str(port), "--students", str(students)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            call_fake(base, "/_stats")
+            return process, base
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("fake services did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--route", default="/create_new_students", help="sync route timed as the first real request")
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--gunicorn", action="store_true", help="also time gunicorn to its first response")
+    parser.add_argument("--out", default="bench_startup.json")
+    parser.add_argument("--compare", help="earlier --out file to compare against")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--base", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args.child, args.base)
+
+    process, base = start_fake(args.students)
+    try:
+        runs = [cold_start(args.route, base) for _ in range(args.runs)]
+        server_seconds = gunicorn_start(base) if args.gunicorn else None
+    finally:
+        process.terminate()
+        process.wait()
+
+    summary = {step: round(statistics.median(run[step] for run in runs), 4) for step in STEPS}
+    summary["loaded_by_import"] = runs[-1]["loaded_by_import"]
+    summary["loaded_by_sync"] = runs[-1]["loaded_by_sync"]
+    summary["gunicorn_first_response_seconds"] = server_seconds
+    for step in STEPS:
+        print(f"{step:<34} {summary[step] * 1000:>9.1f} ms")
+    print(f"{'heavy modules after import':<34} {', '.join(summary['loaded_by_import']) or '-'}")
+    print(f"{'heavy modules after ' + args.route:<34} {', '.join(summary['loaded_by_sync']) or '-'}")
+    if args.gunicorn:
+        print(f"{'gunicorn first response':<34} " + (f"{server_seconds * 1000:>9.1f} ms" if server_seconds else "gunicorn not installed"))
+
+    report = {
+        "meta": {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": git_revision(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "options": {key: value for key, value in vars(args).items() if key not in ("child", "base")}},
+        "summary": summary,
+        "runs": runs,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)["summary"]
+        print(f"\nvs {args.compare}:")
+        for step in STEPS:
+            print(f"{step:<34} x{summary[step] / max(before[step], 1e-9):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Local stand-ins for the Veracross and Mosyle APIs, for offline benchmarks.
+
+    python benchmarks/fake_services.py --students 100000 --port 8765
+    python benchmarks/fake_services.py --students 10000 --latency 0.05 --throttle-every 20
+
+One server answers both APIs:
+
+    Veracross  POST /oauth/token, GET /v3/students, GET /v3/staff_faculty
+               (X-Page-Number / X-Page-Size paging; value_lists with
+               X-API-Value-Lists: include; pages and value lists carry
+               ETags and answer If-None-Match with 304)
+    Mosyle     POST /v2/login, POST /v2/listusers, POST /v2/users
+    Harness    GET /_stats (request counts and Mosyle write bytes), POST /_reset
+               (reseed, zero counters)
+
+Mosyle writes can also be refused: --max-batch answers payloads with more
+elements with 413, and --reject-every answers any batch holding an element
+whose id is a multiple of N with 400 (one bad element fails its batch).
+Gzip request bodies are accepted unless --refuse-gzip answers them with 415.
+
+Veracross rows are generated from their index, so large rosters cost no
+memory there. Every --new-every'th student has an entry_date three days
+out (the create route's window; by default all of them), the rest entered
+in 2020; on_or_after_entry_date / on_or_before_entry_date filter on it. Mosyle is seeded from the same roster with drift so /cleanup
+has work to do: 2% of students are missing (adds), 2% have a changed name
+(updates) and 2% extra stale accounts exist (deletes), plus one ADMIN.
+Writes to /v2/users change the Mosyle state, like the real API.
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+STAFF_ID_OFFSET = 10_000_000
+# The entry date of new students: vc_api's create window is three days out.
+STARTING_DATE = (date.today() + timedelta(days=3)).isoformat()
+GRADES = [{"id": i, "description": f"Grade {i}"} for i in range(1, 13)]
+FACULTY_TYPES = [{"id": 1, "description": "Teacher"}, {"id": 2, "description": "Staff"}]
+# Real Veracross returns several value lists; grade levels and faculty types
+# are not first.
+STUDENT_VALUE_LISTS = [
+    {"id": 1, "name": "Roles", "items": []},
+    {"id": 2, "name": "Grade Levels", "items": GRADES},
+]
+STAFF_VALUE_LISTS = [
+    {"id": 1, "name": "Roles", "items": []},
+    {"id": 2, "name": "Departments", "items": []},
+    {"id": 3, "name": "Campuses", "items": []},
+    {"id": 4, "name": "Faculty Types", "items": FACULTY_TYPES},
+]
+LIST_USERS_PAGE_SIZE = 500
+VALUE_LISTS_ETAG = '"' + hashlib.sha256(json.dumps([STUDENT_VALUE_LISTS, STAFF_VALUE_LISTS]).encode()).hexdigest()[:16] + '"'
+
+
+def student_row(i, new_every=1):
+    entry_date = STARTING_DATE if i % new_every == 0 else "2020-08-20"
+    return {"id": i, "first_name": f"Student{i}", "last_name": "Test",
+            "email_1": f"s{i}@acs.sch.ae", "grade_level": i % 12 + 1, "entry_date": entry_date}
+
+
+def staff_row(i, date_hired):
+    return {"id": STAFF_ID_OFFSET + i, "first_name": f"Staff{i}", "last_name": "Test",
+            "email_1": f"t{i}@acs.sch.ae", "faculty_type": 1 if i % 2 else 2, "date_hired": date_hired}
+
+
+class FakeState:
+    """Roster sizes, fault injection settings, Mosyle accounts and request counters."""
+
+    def __init__(self, students, staff, latency=0.0, throttle_every=0, max_rps=0.0, max_batch=0, reject_every=0,
+                 refuse_gzip=False, new_every=1):
+        self.students = students
+        self.new_every = new_every
+        self.staff = staff
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.max_rps = max_rps
+        self.max_batch = max_batch
+        self.reject_every = reject_every
+        self.refuse_gzip = refuse_gzip
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter()
+            self.throttled = 0
+            self.writes = 0
+            self.write_bytes = Counter()
+            self.window = []
+            self.mosyle = {}
+            for i in range(1, self.students + 1):
+                if i % 50 == 0:
+                    continue
+                name = f"Student{i} {'Renamed' if i % 50 == 1 else 'Test'}"
+                self.mosyle[str(i)] = ("STUDENT", name, f"s{i}@acs.sch.ae", f"Grade {i % 12 + 1}")
+            for i in range(self.staff):
+                self.mosyle[str(STAFF_ID_OFFSET + i)] = ("TEACHER" if i % 2 else "STAFF", f"Staff{i} Test",
+                                                         f"t{i}@acs.sch.ae", None)
+            for i in range(self.students // 50):
+                self.mosyle[f"stale{i}"] = ("STUDENT", f"Stale{i} Test", f"x{i}@acs.sch.ae", "Grade 1")
+            self.mosyle["admin"] = ("ADMIN", "Admin", "admin@acs.sch.ae", None)
+            self.mosyle_ids = None
+
+    def stats(self):
+        with self.lock:
+            return {"requests": sum(self.requests.values()), "by_path": dict(self.requests),
+                    "throttled": self.throttled, "mosyle_users": len(self.mosyle),
+                    "write_bytes": sum(self.write_bytes.values()), "write_bytes_by_encoding": dict(self.write_bytes)}
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] += 1
+
+    def count_write(self, encoding, size):
+        with self.lock:
+            self.write_bytes[encoding] += size
+
+    def should_throttle(self):
+        with self.lock:
+            self.writes += 1
+            throttle = bool(self.throttle_every) and self.writes % self.throttle_every == 0
+            if self.max_rps and not throttle:
+                now = time.monotonic()
+                self.window = [t for t in self.window if now - t < 1]
+                throttle = len(self.window) >= self.max_rps
+                if not throttle:
+                    self.window.append(now)
+            self.throttled += throttle
+            return throttle
+
+    def list_page(self, page):
+        with self.lock:
+            if self.mosyle_ids is None:
+                self.mosyle_ids = list(self.mosyle)
+            ids = self.mosyle_ids[(page - 1) * LIST_USERS_PAGE_SIZE:page * LIST_USERS_PAGE_SIZE]
+            users = []
+            for user_id in ids:
+                if user_id not in self.mosyle:
+                    continue
+                user_type, name, email, grade = self.mosyle[user_id]
+                users.append({"id": user_id, "type": user_type, "name": name, "email": email,
+                              "grades": [grade] if grade else []})
+            return users, len(self.mosyle_ids)
+
+    def refusal(self, elements):
+        """(status, message) for a write the fake refuses as a whole, or None."""
+        if self.max_batch and len(elements) > self.max_batch:
+            return 413, "Payload Too Large"
+        if self.reject_every and any(str(element.get("id")).isdigit() and int(element["id"]) % self.reject_every == 0
+                                     for element in elements):
+            return 400, "Invalid element"
+        return None
+
+    def apply(self, elements):
+        statuses = []
+        with self.lock:
+            for element in elements:
+                user_id = str(element.get("id"))
+                if element.get("operation") == "delete":
+                    self.mosyle.pop(user_id, None)
+                else:
+                    user_type = {"S": "STUDENT", "T": "TEACHER"}.get(element.get("type"), element.get("type"))
+                    locations = element.get("locations") or [{}]
+                    self.mosyle[user_id] = (user_type, element.get("name"), element.get("email"),
+                                            locations[0].get("grade_level"))
+                statuses.append({"id": element.get("id"), "status": "OK"})
+            self.mosyle_ids = None
+        return statuses
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, code, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_body(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                raw = gzip.decompress(raw)
+            return raw
+
+        def send_page(self, rows, lists):
+            if self.headers.get("X-API-Value-Lists") != "include":
+                # Pages carry an ETag of their rows, so conditional requests can be answered 304.
+                etag = '"' + hashlib.sha256(json.dumps(rows).encode()).hexdigest()[:16] + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    return self.end_headers()
+                return self.send_json(200, {"data": rows}, {"ETag": etag})
+            if self.headers.get("If-None-Match") == VALUE_LISTS_ETAG:
+                self.send_response(304)
+                self.send_header("ETag", VALUE_LISTS_ETAG)
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+            self.send_json(200, {"data": rows, "value_lists": lists}, {"ETag": VALUE_LISTS_ETAG})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/_stats":
+                return self.send_json(200, state.stats())
+            state.count(url.path)
+            if state.latency:
+                time.sleep(state.latency)
+            page = int(self.headers.get("X-Page-Number", "1"))
+            size = int(self.headers.get("X-Page-Size", "1000"))
+            first = (page - 1) * size
+            query = parse_qs(url.query)
+            if url.path.endswith("/students"):
+                after = query.get("on_or_after_entry_date", [None])[0]
+                before = query.get("on_or_before_entry_date", [None])[0]
+                if after is None and before is None:
+                    rows = [student_row(i, state.new_every) for i in range(first + 1, min(first + size, state.students) + 1)]
+                elif (after or STARTING_DATE) <= STARTING_DATE <= (before or STARTING_DATE):
+                    # Only the new students; they are every new_every'th index.
+                    last = min(first + size, state.students // state.new_every)
+                    rows = [student_row(i * state.new_every, state.new_every) for i in range(first + 1, last + 1)]
+                else:
+                    rows = []
+                return self.send_page(rows, STUDENT_VALUE_LISTS)
+            if url.path.endswith("/staff_faculty"):
+                # Echo the requested hire date so the create route's filter keeps every row.
+                date_hired = query.get("on_or_after_date_hired", ["2020-01-01"])[0]
+                rows = [staff_row(i, date_hired) for i in range(first, min(first + size, state.staff))]
+                return self.send_page(rows, STAFF_VALUE_LISTS)
+            self.send_json(404, {})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            raw = self.read_body()
+            if url.path == "/_reset":
+                state.reset()
+                return self.send_json(200, state.stats())
+            state.count(url.path)
+            if state.latency:
+                time.sleep(state.latency)
+            if url.path.endswith("/oauth/token"):
+                return self.send_json(200, {"access_token": "fake-vc-token", "expires_in": 3600})
+            body = json.loads(raw or b"{}")
+            if url.path.endswith("/login"):
+                claims = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + 3600}).encode())
+                return self.send_json(200, {}, {"Authorization": f"Bearer fake.{claims.decode().rstrip('=')}.sig"})
+            if url.path.endswith("/listusers"):
+                users, total = state.list_page(body["options"]["page"])
+                return self.send_json(200, {"status": "OK", "response": {
+                    "users": users, "total": total, "page_size": LIST_USERS_PAGE_SIZE}})
+            if url.path.endswith("/users"):
+                encoding = self.headers.get("Content-Encoding", "identity")
+                state.count_write(encoding, int(self.headers.get("Content-Length", 0)))
+                if state.refuse_gzip and encoding == "gzip":
+                    return self.send_json(415, {"status": "ERROR", "error": "Unsupported Content-Encoding"})
+                if state.should_throttle():
+                    return self.send_json(429, {"error": "Too Many Requests"}, {"Retry-After": "1"})
+                refusal = state.refusal(body.get("elements", []))
+                if refusal:
+                    return self.send_json(refusal[0], {"status": "ERROR", "error": refusal[1]})
+                return self.send_json(200, {"status": "OK", "elements": state.apply(body.get("elements", []))})
+            self.send_json(404, {})
+
+    return Handler
+
+
+def serve(state, host="127.0.0.1", port=8765):
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--staff", type=int, help="defaults to students / 10")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth Mosyle write with 429")
+    parser.add_argument("--max-rps", type=float, default=0.0, help="429 Mosyle writes beyond this rate")
+    parser.add_argument("--max-batch", type=int, default=0, help="413 Mosyle writes with more elements")
+    parser.add_argument("--reject-every", type=int, default=0, help="400 Mosyle writes holding an id divisible by this")
+    parser.add_argument("--refuse-gzip", action="store_true", help="415 gzip-encoded Mosyle writes")
+    parser.add_argument("--new-every", type=int, default=1, help="every Nth student starts in three days")
+    args = parser.parse_args()
+
+    staff = args.staff if args.staff is not None else max(1, args.students // 10)
+    state = FakeState(args.students, staff, args.latency, args.throttle_every, args.max_rps, args.max_batch, args.reject_every,
+                      args.refuse_gzip, args.new_every)
+    server = serve(state, port=args.port)
+    print(f"Fake Veracross/Mosyle on http://127.0.0.1:{args.port} ({args.students} students, {staff} staff)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from metrics import FETCH_CACHE
+from response_cache import is_bypassed
+
+# Seconds a Veracross list fetch is reused by later fetches of the same
+# endpoint and params, so routes fired close together download each source
+# once. 0 (the default) = only within a pinned() block (/sync_all): a kept
+# fetch holds a whole roster's rows in memory until it expires.
+FETCH_CACHE_TTL = float(os.getenv("VC_FETCH_CACHE_TTL", "0"))
+
+
+def fetch_key(url, params):
+    return url, json.dumps(params, sort_keys=True, default=str)
+
+
+class FetchCache:
+    """Short-lived cache of Veracross list fetches (one list of rows per page), keyed by endpoint and params.
+
+    Entries are reused for ttl seconds and do not expire while a pinned()
+    block is open, so a run longer than the ttl still fetches each source
+    once. get_or_fetch() is single-flight per key: concurrent callers wait
+    for one fetch. Inside response_cache.bypassed() nothing is served from
+    here; what is fetched is still stored.
+    """
+
+    def __init__(self, ttl=FETCH_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+        self._pins = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self, entry):
+        return entry is not None and (self._pins > 0 or time.time() - entry["fetched_at"] < self.ttl)
+
+    def storing(self):
+        """Whether fetches are kept at all (ttl > 0, or inside pinned())."""
+        return self.ttl > 0 or self._pins > 0
+
+    def get(self, url, params):
+        """The cached pages for url and params, or None."""
+        if is_bypassed():
+            return None
+        entry = self._entries.get(fetch_key(url, params))
+        if not self._fresh(entry):
+            return None
+        FETCH_CACHE.inc(result="hit")
+        return entry["pages"]
+
+    def get_or_fetch(self, url, params, fetch):
+        """The cached pages for url and params, calling fetch() for them when there are none."""
+        if not self.storing():
+            return fetch()
+        key = fetch_key(url, params)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry) and not is_bypassed():
+                FETCH_CACHE.inc(result="hit")
+                return entry["pages"]
+            pages = fetch()
+            FETCH_CACHE.inc(result="miss")
+            with self._lock:
+                self._evict()
+                self._entries[key] = {"pages": pages, "fetched_at": time.time()}
+            return pages
+
+    @contextlib.contextmanager
+    def pinned(self):
+        """Keep every entry (including ones fetched inside the block) until the block exits."""
+        with self._lock:
+            self._pins += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins -= 1
+                self._evict()
+
+    def _evict(self):
+        # Called with _lock held.
+        if self._pins > 0:
+            return
+        now = time.time()
+        self._entries = {key: entry for key, entry in self._entries.items() if now - entry["fetched_at"] < self.ttl}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fetch_cache = FetchCache()
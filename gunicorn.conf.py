@@ -0,0 +1,22 @@
+import os
+
+# Cloud Run: one container per instance, scaled to zero when idle, so a cold
+# start is on a request's critical path. One worker process imports the app
+# once and starts serving as soon as it has; threads give it concurrency, so
+# a ?wait=1 sync does not block /jobs polls and /metrics scrapes.
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# No preload: with one worker it would not save any import time, and the app
+# starts its scheduler threads at import, which must run in the worker, not
+# in the master that forks it.
+preload_app = False
+
+# Syncs run inline (the default, BACKGROUND_JOBS=0) can take minutes; keep
+# Cloud Run's request timeout at least this long.
+timeout = 300
+graceful_timeout = 300
+# Cloud Run's front end keeps connections to the container open.
+keepalive = 75
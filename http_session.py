@@ -0,0 +1,102 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Largest number of concurrent calls we expect against one host: two
+# Veracross role passes with 5 page workers each, for a background job and an
+# inline (?wait=1) run at the same time.
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+# Outbound requests in flight at once across every pool in this process, so
+# syncing more tenants in parallel cannot open unbounded sockets (0 = no cap).
+OUTBOUND_MAX_CONCURRENCY = int(os.getenv("OUTBOUND_MAX_CONCURRENCY", "32"))
+
+# Name of the connection pool get_session() hands out; tenants.Tenant.activate()
+# sets it so each tenant keeps its own keep-alive connections.
+current_pool = contextvars.ContextVar("http_pool", default="default")
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+_outbound = threading.BoundedSemaphore(OUTBOUND_MAX_CONCURRENCY) if OUTBOUND_MAX_CONCURRENCY > 0 else None
+
+
+class CappedAdapter(HTTPAdapter):
+    """HTTPAdapter whose sends share the process-wide OUTBOUND_MAX_CONCURRENCY slots."""
+
+    def send(self, request, **kwargs):
+        if _outbound is None:
+            return super().send(request, **kwargs)
+        with _outbound:
+            return super().send(request, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def outbound_slot():
+    """One OUTBOUND_MAX_CONCURRENCY slot for a request not sent through a CappedAdapter (httpx)."""
+    if _outbound is None:
+        yield
+        return
+    while not _outbound.acquire(blocking=False):
+        await asyncio.sleep(0.01)
+    try:
+        yield
+    finally:
+        _outbound.release()
+
+
+def _mount(session, pool_size):
+    adapter = CappedAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def _build_session(pool_size):
+    session = requests.Session()
+    _mount(session, pool_size)
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+@contextlib.contextmanager
+def use_pool(name):
+    """Route get_session() calls in this context (and contexts copied from it) to pool name."""
+    token = current_pool.set(name)
+    try:
+        yield
+    finally:
+        current_pool.reset(token)
+
+
+def get_session(pool_size=POOL_MAXSIZE):
+    """Return the keep-alive session of the current pool, shared by the Veracross and Mosyle calls.
+
+    Sessions are built lazily in each process (so gunicorn workers never share
+    sockets inherited across a fork), one per pool name (see use_pool), and a
+    pool grows to pool_size if a caller runs more concurrent workers than it
+    was built for.
+    """
+    global _sessions_pid
+    name = current_pool.get()
+    pid = os.getpid()
+    entry = _sessions.get(name)
+    if entry is not None and _sessions_pid == pid and pool_size <= entry[1]:
+        return entry[0]
+    with _lock:
+        if _sessions_pid != pid:
+            _sessions.clear()
+            _sessions_pid = pid
+        entry = _sessions.get(name)
+        if entry is None:
+            size = max(pool_size, POOL_MAXSIZE)
+            entry = _sessions[name] = (_build_session(size), size)
+        elif pool_size > entry[1]:
+            _mount(entry[0], pool_size)
+            entry = _sessions[name] = (entry[0], pool_size)
+    return entry[0]
@@ -0,0 +1,307 @@
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("Mosyle Integration")
+
+# Shared by every gunicorn worker so /jobs/<id> works whichever worker answers.
+JOBS_DB = os.getenv("JOBS_DB", "/tmp/mosyle_jobs.db")
+# Seconds between progress writes while a job runs.
+PROGRESS_FLUSH_INTERVAL = 1.0
+# A new run of the same job within this many seconds of the last finished one
+# is coalesced onto that run's result instead of starting.
+MIN_RUN_INTERVAL = float(os.getenv("MIN_RUN_INTERVAL", "0"))
+# Running jobs refresh a heartbeat this often; one silent for JOB_STALE_AFTER
+# seconds (its worker died) no longer blocks new runs.
+HEARTBEAT_INTERVAL = 15.0
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "120"))
+
+# The job the calling code runs for. A context variable, not an attribute of
+# the runner: a background job and ?wait=1 runs on gunicorn threads each see
+# their own. Worker pools submit with contextvars.copy_context().run so their
+# threads count toward the job that started them.
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class JobStore:
+    """SQLite table of job records: status, progress counters and final result."""
+
+    def __init__(self, path=JOBS_DB):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, name TEXT, status TEXT, progress TEXT, result TEXT, "
+                "error TEXT, created REAL, started REAL, finished REAL, heartbeat REAL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def claim(self, name, min_interval=MIN_RUN_INTERVAL):
+        """Single-flight: return (job_id, created) for name across every process sharing the DB.
+
+        Inside one IMMEDIATE transaction, an active job of the same name (or one
+        finished less than min_interval seconds ago) is returned instead of
+        creating a new one.
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = self._active(conn, name, now)
+            if row is None and min_interval:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE name = ? AND status = 'done' AND finished > ? "
+                    "ORDER BY finished DESC LIMIT 1",
+                    (name, now - min_interval),
+                ).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return row[0], False
+            job_id = uuid.uuid4().hex
+            # Like week-old plans and journal runs, week-old jobs (and their results) are dropped here.
+            conn.execute("DELETE FROM jobs WHERE created < ?", (now - 7 * 24 * 3600,))
+            conn.execute("INSERT INTO jobs (id, name, status, progress, created, heartbeat) "
+                         "VALUES (?, ?, 'queued', '{}', ?, ?)", (job_id, name, now, now))
+            conn.execute("COMMIT")
+            return job_id, True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _active(self, conn, name, now):
+        return conn.execute(
+            "SELECT id FROM jobs WHERE name = ? AND status IN ('queued', 'running') "
+            "AND COALESCE(heartbeat, created) > ? ORDER BY created DESC LIMIT 1",
+            (name, now - JOB_STALE_AFTER),
+        ).fetchone()
+
+    def active(self, name):
+        """The id of a queued or running job of name (in any process), or None."""
+        with self._connect() as conn:
+            row = self._active(conn, name, time.time())
+        return row[0] if row else None
+
+    def start(self, job_id):
+        """Move a queued job to running; False if it was already started (by this process or another)."""
+        now = time.time()
+        with self._connect() as conn:
+            return conn.execute("UPDATE jobs SET status = 'running', started = ?, heartbeat = ? "
+                                "WHERE id = ? AND status = 'queued'", (now, now, job_id)).rowcount == 1
+
+    def abandon(self, job_id, stale_after):
+        """Fail a queued or running job whose heartbeat is older than stale_after seconds (its worker died)."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'failed', error = 'Job worker stopped responding', finished = ? "
+                         "WHERE id = ? AND status IN ('queued', 'running') AND COALESCE(heartbeat, created) < ?",
+                         (now, job_id, now - stale_after))
+
+    def update(self, job_id, **fields):
+        for key in ("progress", "result"):
+            if key in fields:
+                fields[key] = json.dumps(fields[key], default=str)
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["progress"] = json.loads(job["progress"] or "{}")
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+class Job:
+    def __init__(self, job_id, name, store):
+        self.id = job_id
+        self.name = name
+        self.store = store
+        self.progress = {"pages_fetched": 0, "batches_sent": 0, "failures": 0, "bytes_sent": 0}
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.progress[counter] = self.progress.get(counter, 0) + n
+            if time.monotonic() - self._flushed < PROGRESS_FLUSH_INTERVAL:
+                return
+            self._flushed = time.monotonic()
+            progress = dict(self.progress)
+        self.store.update(self.id, progress=progress)
+
+    def time(self, phase, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(phase, {"count": 0, "seconds": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["seconds"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    def timing_summary(self):
+        with self._lock:
+            return {phase: {"count": t["count"], "seconds": round(t["seconds"], 3), "max": round(t["max"], 3)}
+                    for phase, t in self.timings.items()}
+
+
+class JobQueue:
+    """In-process job runner; queued jobs run one at a time on a background thread.
+
+    Subclass and override submit() to hand jobs to an external queue instead.
+    current is the job of the calling context, so count_progress() and
+    record_timing() attribute work to it from any thread that inherited that
+    context, while inline runs proceed alongside the background one. Claims go through
+    JobStore.claim, so overlapping requests (in any gunicorn worker) attach to
+    the run already in progress.
+    """
+
+    def __init__(self, store=None):
+        self._store = store
+        self._executor = None
+        self._heartbeat = None
+        self._lock = threading.Lock()
+        self._owned = set()
+
+    @property
+    def current(self):
+        return _current_job.get()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = JobStore()
+        return self._store
+
+    def submit(self, name, fn, min_interval=MIN_RUN_INTERVAL):
+        """Queue fn (returning (result_dict, http_code)); returns (job_id, created).
+
+        created is False when the request was attached to an active or recent run.
+        """
+        job_id, created = self.store.claim(name, min_interval)
+        if not created:
+            logger.info("%s already running or recently finished; attached to job %s", name, job_id)
+            return job_id, False
+        self._start()
+        self._owned.add(job_id)
+        self._executor.submit(self._run, Job(job_id, name, self.store), fn)
+        return job_id, True
+
+    def run_inline(self, name, fn, min_interval=MIN_RUN_INTERVAL):
+        """Run fn in the calling thread (or attach to the active run) and return the finished job record."""
+        job_id, created = self.store.claim(name, min_interval)
+        if created:
+            self._start()
+            self._owned.add(job_id)
+            self._run(Job(job_id, name, self.store), fn)
+        return self.wait(job_id)
+
+    def run_attached(self, name, fn):
+        """Claim name and run fn in the calling thread as part of the current job; returns the finished record.
+
+        The run gets its own single-flight record (attaching to a running run
+        of name instead, like run_inline), but current is left alone: progress
+        and timings count toward the job that called this, which may be running
+        several of these at once (app.sync_all_tenants). A run of name still
+        queued is taken over and run here: it may be queued behind the very job
+        calling this, and its runner skips it once started.
+        """
+        job_id, _ = self.store.claim(name)
+        if not self.store.start(job_id):
+            return self.wait(job_id)
+        self._start()
+        self._owned.add(job_id)
+        try:
+            result, code = fn()
+            self.store.update(job_id, status="done" if code < 500 else "failed", result=result, finished=time.time())
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job_id, name)
+            self.store.update(job_id, status="failed", error=str(e), finished=time.time())
+        finally:
+            self._owned.discard(job_id)
+        return self.get(job_id)
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+                self._heartbeat = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+                self._heartbeat.start()
+
+    def wait(self, job_id, poll=1.0):
+        """Block until the job finishes and return its record; a job whose heartbeat went stale is failed."""
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in ("done", "failed"):
+                return job
+            if time.time() - (job["heartbeat"] or job["created"]) > JOB_STALE_AFTER:
+                self.store.abandon(job_id, JOB_STALE_AFTER)
+                continue
+            time.sleep(poll)
+
+    def _beat(self):
+        # Covers queued jobs too, so a run waiting behind another is not taken for dead.
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            for job_id in list(self._owned):
+                try:
+                    self.store.update(job_id, heartbeat=time.time())
+                except sqlite3.Error as e:
+                    logger.warning("Job heartbeat failed: %s", e)
+
+    def _run(self, job, fn):
+        if not self.store.start(job.id):
+            # Taken over by run_attached while it waited here.
+            logger.info("Job %s (%s) was already started elsewhere", job.id, job.name)
+            self._owned.discard(job.id)
+            return
+        token = _current_job.set(job)
+        try:
+            result, code = fn()
+            status = "done" if code < 500 else "failed"
+            if isinstance(result, dict):
+                result["timings"] = job.timing_summary()
+            self.store.update(job.id, status=status, result=result, progress=job.progress, finished=time.time())
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job.id, job.name)
+            self.store.update(job.id, status="failed", error=str(e), progress=job.progress, finished=time.time())
+        finally:
+            _current_job.reset(token)
+            self._owned.discard(job.id)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+
+job_queue = JobQueue()
+
+
+def count_progress(counter, n=1):
+    """Add n to a progress counter of the running job, if any."""
+    job = job_queue.current
+    if job is not None:
+        job.count(counter, n)
+
+
+def record_timing(phase, seconds):
+    """Add a timed span to the running job's per-phase timings, if any."""
+    job = job_queue.current
+    if job is not None:
+        job.time(phase, seconds)
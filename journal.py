@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from mosyle_api import frame_elements, delete_elements, DEFAULT_LOCATION
+
+# Write-ahead journal of Mosyle writes (set JOURNAL_DB="" to turn it off).
+JOURNAL_DB = os.getenv("JOURNAL_DB", "/tmp/mosyle_journal.db")
+# A running run records a heartbeat with every batch; one silent this long
+# (its worker died) may be resumed by another.
+JOURNAL_STALE_AFTER = float(os.getenv("JOURNAL_STALE_AFTER", "600"))
+
+
+def element_key(element):
+    """Idempotency key of a Mosyle element: the same write always gets the same key."""
+    return hashlib.sha256(json.dumps(element, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+class Recorders:
+    """Fan a batch's statuses out to several recorders (a JournalRun, the snapshot mirror); None entries are skipped."""
+
+    def __init__(self, *recorders):
+        self.recorders = [recorder for recorder in recorders if recorder]
+
+    def __bool__(self):
+        return bool(self.recorders)
+
+    def record(self, elements, statuses):
+        for recorder in self.recorders:
+            recorder.record(elements, statuses)
+
+
+class Journal:
+    """SQLite journal of every element a sync means to send to Mosyle, with its acknowledged status.
+
+    A run's elements are written (status pending) before the first batch is
+    sent, and each batch's per-element statuses from the Mosyle response are
+    recorded as it returns. A run that ends partial, or whose worker died, can
+    be resumed: only elements not acknowledged "ok" are sent again.
+    """
+
+    def __init__(self, path=JOURNAL_DB, stale_after=JOURNAL_STALE_AFTER):
+        self.path = path
+        self.stale_after = stale_after
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "id TEXT PRIMARY KEY, name TEXT, mode TEXT, status TEXT, created REAL, updated REAL, tenant TEXT)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(runs)")}
+            if "tenant" not in columns:
+                conn.execute("ALTER TABLE runs ADD COLUMN tenant TEXT")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS elements ("
+                "run_id TEXT, key TEXT, seq INTEGER, operation TEXT, element TEXT, "
+                "status TEXT, detail TEXT, attempts INTEGER, updated REAL, PRIMARY KEY (run_id, key))"
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        # WAL makes the per-batch status commits cheap; a crash loses at most
+        # the last acknowledgements, which resume then resends.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self, name, mode=None, run_id=None, tenant=None):
+        """Open a new run (status running) for tenant (a key) and return its JournalRun."""
+        run_id = run_id or uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            # Finished or not, week-old runs are only history; keep the file small.
+            old = [row[0] for row in conn.execute("SELECT id FROM runs WHERE created < ?", (now - 7 * 24 * 3600,))]
+            conn.executemany("DELETE FROM elements WHERE run_id = ?", ((old_id,) for old_id in old))
+            conn.executemany("DELETE FROM runs WHERE id = ?", ((old_id,) for old_id in old))
+            conn.execute("INSERT INTO runs (id, name, mode, status, created, updated, tenant) "
+                         "VALUES (?, ?, ?, 'running', ?, ?, ?)", (run_id, name, mode, now, now, tenant))
+        return JournalRun(self, run_id)
+
+    def summary(self, run_id):
+        """Run status and element counts by operation and status, or None if unknown."""
+        with self._connect() as conn:
+            run = conn.execute("SELECT id, name, mode, status, created, updated, tenant FROM runs WHERE id = ?",
+                               (run_id,)).fetchone()
+            if run is None:
+                return None
+            counts = conn.execute("SELECT operation, status, COUNT(*) FROM elements WHERE run_id = ? "
+                                  "GROUP BY operation, status", (run_id,)).fetchall()
+        elements = {}
+        for operation, status, count in counts:
+            elements.setdefault(operation, {})[status] = count
+        pending = sum(count for _, status, count in counts if status != "ok")
+        return {"run_id": run[0], "name": run[1], "mode": run[2], "status": run[3], "created": run[4],
+                "updated": run[5], "tenant": run[6], "pending": pending, "elements": elements}
+
+    def unusable(self, summary):
+        """Why a run cannot be resumed now (a message), or None if it can."""
+        if summary["status"] == "running" and time.time() - summary["updated"] < self.stale_after:
+            return "Run is still being applied"
+        if not summary["pending"]:
+            return "Run has nothing left to send"
+        return None
+
+    def claim(self, run_id):
+        """Mark a finished (or stale) run as running again; returns its JournalRun.
+
+        Raises ValueError if the run is unknown, still running, or complete.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            claimed = conn.execute(
+                "UPDATE runs SET status = 'running', updated = ? WHERE id = ? "
+                "AND (status != 'running' OR updated < ?)", (now, run_id, now - self.stale_after)).rowcount
+        summary = self.summary(run_id)
+        if summary is None:
+            raise ValueError("Unknown run id")
+        if not claimed:
+            raise ValueError("Run is still being applied")
+        if not summary["pending"]:
+            JournalRun(self, run_id).finish()
+            raise ValueError("Run has nothing left to send")
+        return JournalRun(self, run_id)
+
+
+class JournalRun:
+    """One run's handle, passed to create_users/delete_users as recorder=."""
+
+    def __init__(self, journal, run_id):
+        self.journal = journal
+        self.run_id = run_id
+
+    def add(self, elements):
+        """Journal elements as pending before any is sent (repeated keys are kept once)."""
+        now = time.time()
+        with self.journal._connect() as conn:
+            start = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM elements WHERE run_id = ?",
+                                 (self.run_id,)).fetchone()[0]
+            conn.executemany(
+                "INSERT OR IGNORE INTO elements (run_id, key, seq, operation, element, status, attempts, updated) "
+                "VALUES (?, ?, ?, ?, ?, 'pending', 0, ?)",
+                ((self.run_id, element_key(element), start + i, element.get("operation"), json.dumps(element, default=str), now)
+                 for i, element in enumerate(elements, 1)),
+            )
+
+    def plan(self, to_add, to_update, to_delete, location=DEFAULT_LOCATION):
+        """Journal a /cleanup plan (Rosters or DataFrames) in the order it is applied."""
+        self.add(
+            (frame_elements(to_update, "update", location) if not to_update.empty else [])
+            + (frame_elements(to_add, "save", location) if not to_add.empty else [])
+            + (delete_elements(to_delete) if not to_delete.empty else [])
+        )
+
+    def record(self, elements, statuses):
+        """Store each element's outcome: statuses are (status, detail) pairs aligned with elements."""
+        now = time.time()
+        with self.journal._connect() as conn:
+            conn.executemany(
+                "UPDATE elements SET status = ?, detail = ?, attempts = attempts + 1, updated = ? "
+                "WHERE run_id = ? AND key = ?",
+                ((status, detail, now, self.run_id, element_key(element))
+                 for element, (status, detail) in zip(elements, statuses)),
+            )
+            conn.execute("UPDATE runs SET updated = ? WHERE id = ?", (now, self.run_id))
+
+    def pending(self):
+        """Elements not yet acknowledged, as {operation: [element, ...]} in journal (= apply) order."""
+        with self.journal._connect() as conn:
+            rows = conn.execute("SELECT operation, element FROM elements WHERE run_id = ? AND status != 'ok' "
+                                "ORDER BY seq", (self.run_id,)).fetchall()
+        pending = {}
+        for operation, element in rows:
+            pending.setdefault(operation, []).append(json.loads(element))
+        return pending
+
+    def finish(self):
+        """Close the run: done when every element is acknowledged, else partial. Returns the status."""
+        with self.journal._connect() as conn:
+            left = conn.execute("SELECT COUNT(*) FROM elements WHERE run_id = ? AND status != 'ok'",
+                                (self.run_id,)).fetchone()[0]
+            status = "partial" if left else "done"
+            conn.execute("UPDATE runs SET status = ?, updated = ? WHERE id = ?", (status, time.time(), self.run_id))
+        return status
+
+
+class StreamedRun:
+    """Recorder for stream_users: there is no plan up front, so each batch is journaled as it returns."""
+
+    def __init__(self, run):
+        self.run = run
+
+    def record(self, elements, statuses):
+        self.run.add(elements)
+        self.run.record(elements, statuses)
+
+
+def open_journal():
+    """Return the Journal configured by JOURNAL_DB, or None when journaling is off."""
+    return Journal(JOURNAL_DB) if JOURNAL_DB else None
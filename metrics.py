@@ -0,0 +1,111 @@
+import threading
+import time
+from contextlib import contextmanager
+from jobs import record_timing
+
+# Per-process, like every in-memory Prometheus registry: with several gunicorn
+# workers each scrape sees the worker that answered it.
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_label_text(key)} {value}" for key, value in sorted(self.values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self.series.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.series[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+PHASE_SECONDS = REGISTRY.histogram("sync_phase_seconds", "Wall time of each sync phase, page and batch.")
+HTTP_REQUESTS = REGISTRY.counter("sync_http_requests_total", "Outbound API requests by api and HTTP status.")
+RETRIES = REGISTRY.counter("sync_retries_total", "API request attempts beyond the first, by operation.")
+BATCH_SPLITS = REGISTRY.counter("sync_batch_splits_total", "Failed Mosyle batches split in half to isolate bad elements.")
+THROTTLED = REGISTRY.counter("sync_throttled_total", "429 responses received, by api.")
+RESPONSE_CACHE = REGISTRY.counter("sync_response_cache_total", "Veracross pages by response cache outcome (hit, revalidated, miss, bypass, evicted).")
+FETCH_CACHE = REGISTRY.counter("sync_fetch_cache_total", "Veracross list fetches served from (hit) or added to (miss) the fetch cache.")
+REQUEST_BYTES = REGISTRY.counter("sync_request_bytes_total", "Request body bytes sent, by api and Content-Encoding (identity, gzip).")
+
+
+@contextmanager
+def span(phase, **labels):
+    """Time a block into sync_phase_seconds and the running job's timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PHASE_SECONDS.observe(elapsed, phase=phase, **labels)
+        record_timing(phase, elapsed)
+
+
+def observe_response(api, response):
+    HTTP_REQUESTS.inc(api=api, status=response.status_code)
+    if response.status_code == 429:
+        THROTTLED.inc(api=api)
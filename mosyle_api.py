@@ -1,15 +1,21 @@
-import requests
 import logging
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import math
-import pandas as pd
-import os
-logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+from http_session import get_session
+from token_cache import token_cache,cache_key,jwt_expiry
+from rate_limit import mosyle_limiter
+from jobs import count_progress
+from metrics import span, observe_response, RETRIES, BATCH_SPLITS
+from roster import Roster
+from request_body import RequestBody
+import threading
+import contextvars
+import queue
 logger = logging.getLogger("Mosyle Integration")
 import time
 
 
-def get_token(AUTH_URL,EMAIL,PASSWORD,TOKEN):
+def get_token(AUTH_URL,EMAIL,PASSWORD,TOKEN,stale_token=None):
     if not all([AUTH_URL,EMAIL,PASSWORD,TOKEN]):
         raise ValueError("Missing required parameters for auth token!")
     
@@ -20,19 +26,279 @@ def get_token(AUTH_URL,EMAIL,PASSWORD,TOKEN):
     }
     headers = {"Content-Type": "application/json"}
 
-    response = requests.post(AUTH_URL, json=data, headers=headers)
+    def fetch():
+        with span("token_fetch", api="mosyle"):
+            response = get_session().post(AUTH_URL, json=data, headers=headers)
+        observe_response("mosyle", response)
 
 
-    if response.status_code == 200:
-        return response.headers.get("Authorization")
+        if response.status_code == 200:
+            jwt_token = response.headers.get("Authorization")
+            return jwt_token, jwt_expiry(jwt_token) if jwt_token else None
 
-    else:
-        print("Error fetching access token:", response.text)
-        return None
+        else:
+            print("Error fetching access token:", response.text)
+            return None, None
+
+    return token_cache.get(cache_key(AUTH_URL, EMAIL, PASSWORD, TOKEN), fetch, stale_token=stale_token)
+
+
+class JwtAuth:
+    """Mosyle request headers shared by a call's worker threads.
+
+    On a 401, refresh() swaps in a new JWT from refresh_jwt (called with the
+    rejected token) once for all threads that saw the same stale token.
+    """
+
+    def __init__(self, jwt_token, refresh_jwt=None):
+        self.jwt_token = jwt_token
+        self.refresh_jwt = refresh_jwt
+        self._lock = threading.Lock()
+
+    def headers(self, body_headers=None):
+        """Authorization plus body_headers (Content-Type: application/json by default)."""
+        return {"Authorization": self.jwt_token, **(body_headers or {"Content-Type": "application/json"})}
+
+    def refresh(self, stale_token):
+        if self.refresh_jwt is None:
+            return False
+        with self._lock:
+            if self.jwt_token == stale_token:
+                new_token = self.refresh_jwt(stale_token)
+                if not new_token:
+                    return False
+                self.jwt_token = new_token
+        logger.info("Mosyle JWT refreshed after 401")
+        return True
     
 
 
-def create_users(MOSYLE_USERS_URL, accessToken, jwt_token, users, operation, max_workers=5, batch_size=20):
+def run_batches(elements, send_batch, limiter, max_workers, batch_size):
+    """Feed slices of the prebuilt elements list to send_batch on max_workers threads and return every batch result.
+
+    Batches are cut as workers become free, each sized by limiter.batch_size()
+    (at most batch_size), so the size tracks the limiter's current state.
+    """
+    cursor = 0
+    cursor_lock = threading.Lock()
+
+    def next_batch():
+        nonlocal cursor
+        with cursor_lock:
+            if cursor >= len(elements):
+                return None
+            start = cursor
+            cursor += limiter.batch_size(batch_size)
+            return elements[start:cursor]
+
+    def worker():
+        results = []
+        while (batch := next_batch()) is not None:
+            results.append(send_batch(batch))
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, worker) for _ in range(max_workers)]
+        return [result for future in futures for result in future.result()]
+
+
+# Mosyle location of the default tenant; others pass their own (tenants.Tenant.location).
+DEFAULT_LOCATION = "ACS Abu Dhabi"
+
+# location -> the list shared by every non-student element there; never mutated.
+STAFF_LOCATIONS = {}
+
+
+def user_element(operation, user_id, name, user_type, email, grade_level, location=DEFAULT_LOCATION):
+    element = {
+        "operation": operation,
+        "id": user_id,
+        "name": name,
+        "type": user_type,
+        "email": email,
+        "welcome_email": 0
+    }
+
+    if user_type == "S":
+        element["locations"] = [{"name": location, "grade_level": grade_level}]
+    else:
+        element["locations"] = STAFF_LOCATIONS.get(location) or STAFF_LOCATIONS.setdefault(location, [{"name": location}])
+    return element
+
+
+def user_elements(rows, operation, location=DEFAULT_LOCATION):
+    """Mosyle save/update elements for row mappings with id, full_name, type, email_1 and grade_level."""
+    return [
+        user_element(operation, user_row["id"], user_row["full_name"], user_row["type"],
+                     user_row["email_1"], user_row.get("grade_level"), location)
+        for user_row in rows
+    ]
+
+
+def frame_elements(users, operation, location=DEFAULT_LOCATION):
+    """Mosyle save/update elements for a whole users DataFrame (or Roster), built column-wise in one pass."""
+    if isinstance(users, Roster):
+        return [user_element(operation, user.id, user.full_name, user.type, user.email_1, user.grade_level, location)
+                for user in users]
+    grade_levels = users["grade_level"].tolist() if "grade_level" in users.columns else [None] * len(users)
+    return [
+        user_element(operation, *values, location)
+        for values in zip(users["id"].tolist(), users["full_name"].tolist(), users["type"].tolist(),
+                          users["email_1"].tolist(), grade_levels)
+    ]
+
+
+def delete_elements(users):
+    """Mosyle delete elements for a users DataFrame or Roster."""
+    user_ids = users.ids() if isinstance(users, Roster) else users["id"].tolist()
+    return [{"operation": "delete", "id": str(user_id)} for user_id in user_ids]
+
+
+def element_roster(elements):
+    """Roster of the users written by save/update elements (the inverse of frame_elements)."""
+    return Roster.from_columns(
+        [element["id"] for element in elements],
+        [element.get("name") for element in elements],
+        [element.get("email") for element in elements],
+        [(element.get("locations") or [{}])[0].get("grade_level") for element in elements],
+        [element.get("type") for element in elements],
+    )
+
+
+# Attempts per half when a failed batch is split (see send_elements); the
+# whole batch already used post_elements' full five.
+SPLIT_ATTEMPTS = 2
+# Statuses that reject the payload itself, so a split can isolate the bad
+# elements (413: the batch was too large). A 5xx fails the batch unsplit.
+SPLIT_STATUSES = (400, 413, 422)
+# 429s a batch may get on top of its attempts: the limiter already paces every
+# worker after one, so throttling is not a strike against the batch.
+THROTTLED_RETRIES = 10
+
+
+def post_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list, attempts=5):
+    """POST one batch of elements to the Mosyle users endpoint, retrying up to attempts times.
+
+    Returns {"success": True, "response": <json>} or {"success": False,
+    "error": <last error>, "status_code": <last HTTP status, None if Mosyle
+    never answered>}. A 413 or another 4xx rejects the payload itself, so it
+    is not retried; a 413 also lowers the limiter's batch-size ceiling. The
+    body is encoded once (see request_body.RequestBody) and, with
+    MOSYLE_GZIP=1 and when large, gzipped; a 400/415 to a gzip body is
+    resent plain before it counts.
+    """
+    # Serialized once for every attempt; only a JWT refresh or a gzip refusal rebuilds the headers.
+    body = RequestBody(MOSYLE_USERS_URL, {"accessToken": accessToken, "elements": elements_list})
+    headers = auth.headers(body.headers)
+    refreshed = False
+    last_error = "429 Too Many Requests"
+    status_code = None
+    operation = elements_list[0].get("operation", "") if elements_list else ""
+
+    # Retry through the shared limiter; 429s pause every worker, other errors back off with jitter
+    attempt = throttled = 0
+    with span("mosyle_batch", operation=operation):
+        while attempt < attempts:
+            if attempt or throttled:
+                RETRIES.inc(operation=operation)
+            attempt += 1
+            try:
+                resp = limiter.call(lambda: session.post(MOSYLE_USERS_URL, data=body.data, headers=headers, timeout=15))
+                body.sent()
+                observe_response("mosyle", resp)
+                if resp.status_code == 401 and not refreshed and auth.refresh(headers["Authorization"]):
+                    refreshed = True
+                    headers = auth.headers(body.headers)
+                    continue
+                if resp.status_code == 429:
+                    if throttled < THROTTLED_RETRIES:
+                        throttled += 1
+                        attempt -= 1
+                    continue
+                if body.refused(resp.status_code):
+                    headers = auth.headers(body.headers)
+                    continue
+                status_code = resp.status_code
+                if resp.status_code == 413:
+                    limiter.too_large(len(elements_list))
+                if 400 <= resp.status_code < 500 and resp.status_code != 401:
+                    last_error = f"{resp.status_code} {resp.reason}: {resp.text[:200]}"
+                    break
+                resp.raise_for_status()
+                body.accepted()
+                try:
+                    resp_json = resp.json()
+                except ValueError:
+                    resp_json = {}
+                count_progress("batches_sent")
+                return {"success": True, "response": resp_json}
+            except Exception as e:
+                last_error = str(e)
+                time.sleep(limiter.backoff(attempt - 1))
+    count_progress("failures")
+    return {"success": False, "error": last_error, "status_code": status_code}
+
+
+def batch_statuses(elements_list, result):
+    """(status, detail) per element of a post_elements result: "ok" or "failed".
+
+    This is what create_users, delete_users and stream_users pass to their
+    recorder= hook (a journal run, the snapshot mirror) after every batch.
+
+    A response whose top-level status is present and not "OK" fails the
+    whole batch. When the response lists elements, each is matched by id and
+    only status "OK" counts as acknowledged (an id missing from it too is
+    failed); a successful response without an element list acknowledges the
+    whole batch.
+    """
+    if not result["success"]:
+        return [("failed", result["error"])] * len(elements_list)
+    status = result["response"].get("status")
+    if status is not None and status != "OK":
+        detail = result["response"].get("error") or result["response"].get("message") or status
+        return [("failed", str(detail))] * len(elements_list)
+    response_elements = result["response"].get("elements")
+    if not isinstance(response_elements, list):
+        return [("ok", None)] * len(elements_list)
+    by_id = {str(el.get("id")): el.get("status") for el in response_elements}
+    statuses = []
+    for element in elements_list:
+        status = by_id.get(str(element.get("id")))
+        statuses.append(("ok", None) if status == "OK" else ("failed", status or "no status in response"))
+    return statuses
+
+
+def send_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list, attempts=5):
+    """post_elements one batch and return its batch_statuses, splitting batches Mosyle rejects.
+
+    When Mosyle rejects a batch's payload (400, 422, or 413 for its size; one
+    malformed element can fail a whole save), each half is sent again, down
+    to single elements, so only the bad elements fail. Batches that got no
+    answer (timeouts, resets) or a 5xx are not split: the next batch would
+    most likely fail the same way.
+    """
+    result = post_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list, attempts)
+    if result["success"] or result["status_code"] not in SPLIT_STATUSES or len(elements_list) == 1:
+        return batch_statuses(elements_list, result)
+    BATCH_SPLITS.inc(operation=elements_list[0].get("operation", ""))
+    middle = len(elements_list) // 2
+    return (send_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list[:middle], SPLIT_ATTEMPTS)
+            + send_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list[middle:], SPLIT_ATTEMPTS))
+
+
+def tally(elements_list, statuses):
+    """(acknowledged count, [{"id", "error"} per failed element]) for a batch's statuses."""
+    failures = [{"id": element.get("id"), "error": detail}
+                for element, (status, detail) in zip(elements_list, statuses) if status != "ok"]
+    return len(elements_list) - len(failures), failures
+
+
+def create_users(MOSYLE_USERS_URL, accessToken, jwt_token, users, operation, max_workers=5, batch_size=None, refresh_jwt=None, limiter=None, recorder=None, location=DEFAULT_LOCATION):
+    """Save or update users (a DataFrame or Roster) in Mosyle, in batches sized by the limiter (at most batch_size).
+
+    Each element is counted from Mosyle's per-element statuses: "updated" is
+    the number acknowledged, "failures" lists the others by id.
+    """
     if users.empty:
         print("No users available to " + operation)
         return {
@@ -45,61 +311,93 @@ def create_users(MOSYLE_USERS_URL, accessToken, jwt_token, users, operation, max
 
     updated_count = 0
     failures = []
+    session = get_session(max_workers)
+    auth = JwtAuth(jwt_token, refresh_jwt)
+    limiter = limiter or mosyle_limiter
+
+    def post_user_batch(elements_list):
+        statuses = send_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list)
+        if recorder:
+            recorder.record(elements_list, statuses)
+        acknowledged, batch_failures = tally(elements_list, statuses)
+        logger.info(f"{operation} done for {acknowledged}/{len(elements_list)} users in batch")
+        return acknowledged, batch_failures
+
+    elements = frame_elements(users, operation, location)
+    for acknowledged, batch_failures in run_batches(elements, post_user_batch, limiter, max_workers, batch_size):
+        updated_count += acknowledged
+        failures.extend(batch_failures)
 
-    def post_user_batch(batch_df):
-        elements_list = []
-        for _, user_row in batch_df.iterrows():
-            element = {
-                "operation": operation,
-                "id": user_row["id"],
-                "name": user_row["full_name"],
-                "type": user_row["type"],
-                "email": user_row["email_1"],
-                "welcome_email": 0
-            }
-
-            if user_row["type"] == "S":
-                element["locations"] = [{"name": "ACS Abu Dhabi", "grade_level": user_row["grade_level"]}]
-            else:
-                element["locations"] = [{"name": "ACS Abu Dhabi"}]
-
-            elements_list.append(element)
+    return {
+        "status": "OK" if not failures else "partial",
+        "updated": updated_count,
+        "failed": len(failures),
+        "failures": failures[:20],
+    }
 
-        user_data = {
-            "accessToken": accessToken,
-            "elements": elements_list
-        }
 
-        headers = {"Authorization": jwt_token, "Content-Type": "application/json"}
+def stream_users(MOSYLE_USERS_URL, accessToken, jwt_token, pages, operation, max_workers=5, batch_size=None, refresh_jwt=None, limiter=None, queue_depth=None, recorder=None, location=DEFAULT_LOCATION):
+    """create_users for an iterable of row-list pages, writing while pages are still arriving.
 
-        # Retry logic with exponential backoff
-        for attempt in range(5):
-            try:
-                resp = requests.post(MOSYLE_USERS_URL, json=user_data, headers=headers, timeout=15)
-                if resp.status_code == 429:
-                    wait = 2 ** attempt
-                    logger.warning("429 Too Many Requests. Sleeping %s seconds", wait)
-                    time.sleep(wait)
-                    continue
-                resp.raise_for_status()
-                logger.info(f"{operation} done for batch of {len(batch_df)} users")
-                return {"success": True, "count": len(batch_df)}
-            except Exception as e:
-                last_error = str(e)
-                time.sleep(1)
-        return {"success": False, "error": last_error, "count": len(batch_df)}
+    A producer thread pulls pages (e.g. vc_api.iter_student_rows), drops repeated
+    ids and cuts batches into a bounded queue that max_workers writers drain, so
+    the first batch is sent as soon as the first page lands and at most
+    queue_depth batches are held in memory. Returns the create_users result shape.
+    """
+    if not all([MOSYLE_USERS_URL, accessToken, jwt_token]):
+        raise ValueError("Missing required parameters for create user!")
 
-    # Split users into batches
-    batches = [users.iloc[i:i+batch_size] for i in range(0, len(users), batch_size)]
+    session = get_session(max_workers)
+    auth = JwtAuth(jwt_token, refresh_jwt)
+    limiter = limiter or mosyle_limiter
+    batches = queue.Queue(maxsize=queue_depth or 2 * max_workers)
+    failures = []
 
+    def produce():
+        seen = set()
+        batch = []
+        try:
+            for rows in pages:
+                for user_row in rows:
+                    if user_row["id"] in seen:
+                        continue
+                    seen.add(user_row["id"])
+                    batch.append(user_row)
+                    if len(batch) >= limiter.batch_size(batch_size):
+                        batches.put(batch)
+                        batch = []
+            if batch:
+                batches.put(batch)
+        except Exception as e:
+            logger.exception("Streaming fetch failed")
+            failures.append({"error": f"fetch failed: {e}", "count": 0})
+        finally:
+            for _ in range(max_workers):
+                batches.put(None)
+
+    def write():
+        results = []
+        while (batch := batches.get()) is not None:
+            elements_list = user_elements(batch, operation, location)
+            statuses = send_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list)
+            if recorder:
+                recorder.record(elements_list, statuses)
+            acknowledged, batch_failures = tally(elements_list, statuses)
+            logger.info(f"{operation} done for {acknowledged}/{len(batch)} users in batch")
+            results.append((acknowledged, batch_failures))
+        return results
+
+    # The producer pulls the Veracross pages, so it runs in the caller's context (its tenant's pool).
+    producer = threading.Thread(target=contextvars.copy_context().run, args=(produce,), name="mosyle-stream-producer", daemon=True)
+    producer.start()
+    updated_count = 0
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(post_user_batch, batch) for batch in batches]
-        for future in as_completed(futures):
-            result = future.result()
-            if result["success"]:
-                updated_count += result["count"]
-            else:
-                failures.append({"error": result["error"], "count": result["count"]})
+        futures = [executor.submit(contextvars.copy_context().run, write) for _ in range(max_workers)]
+        for future in futures:
+            for acknowledged, batch_failures in future.result():
+                updated_count += acknowledged
+                failures.extend(batch_failures)
+    producer.join()
 
     return {
         "status": "OK" if not failures else "partial",
@@ -115,16 +413,26 @@ def create_users(MOSYLE_USERS_URL, accessToken, jwt_token, users, operation, max
 
 
 
-def list_users(MOSYLE_LIST_USERS_URL, accessToken, jwt_token, max_workers=5):
+# fetch_user_pages' keys for Roster.from_rows: id, full_name, email_1, grade_level, type.
+LIST_USER_KEYS = ("id", "name", "email", "grade", "type")
+
+
+def fetch_user_pages(MOSYLE_LIST_USERS_URL, accessToken, jwt_token, max_workers=5, refresh_jwt=None, limiter=None, transform=None):
+    """Every listusers page's users, with types mapped (S, T) and grade taken from grades.
+
+    Returns a list with one entry per page, in page order (the page's users,
+    or transform(users) as the page arrives). A failing page is retried with
+    backoff; if any page still fails, returns None rather than a partial
+    listing, whose missing users would be planned as adds.
+    """
     if not all([MOSYLE_LIST_USERS_URL, accessToken, jwt_token]):
         raise ValueError("Missing required parameters for list user!")
 
-    headers = {
-        "Authorization": jwt_token,
-        "Content-Type": "application/json"
-    }
+    session = get_session(max_workers)
+    auth = JwtAuth(jwt_token, refresh_jwt)
+    limiter = limiter or mosyle_limiter
 
-    # Helper to fetch one page
+    # Helper to fetch one page; (None, None) once its retries are exhausted
     def fetch_page(page):
         data = {
             "accessToken": accessToken,
@@ -133,61 +441,94 @@ def list_users(MOSYLE_LIST_USERS_URL, accessToken, jwt_token, max_workers=5):
                 "page": page
             }
         }
-        try:
-            resp = requests.post(MOSYLE_LIST_USERS_URL, json=data, headers=headers, timeout=15)
-            resp.raise_for_status()
-            resp_json = resp.json()
-            users = resp_json["response"]["users"]
-
-            # for entry in users:
-            #     if entry["type"] == "STUDENT":
-            #         entry["grade"] = entry.get("grades", [None])[0]
-            #         entry["type"] = "S"
-            #     elif entry["type"] == "TEACHER":
-            #         entry["type"] = "T"
-            for entry in users:
-                grades = entry.get("grades")
-                if isinstance(grades, list) and grades:
-                    entry["grade"] = grades[0]
-                else:
-                    entry["grade"] = None
+        refreshed = False
+        last_error = "429 Too Many Requests"
+        with span("mosyle_list_page"):
+            for attempt in range(5):
+                if attempt:
+                    RETRIES.inc(operation="listusers")
+                try:
+                    headers = auth.headers()
+                    resp = limiter.call(lambda: session.post(MOSYLE_LIST_USERS_URL, json=data, headers=headers, timeout=15))
+                    observe_response("mosyle", resp)
+                    if resp.status_code == 401 and not refreshed and auth.refresh(headers["Authorization"]):
+                        refreshed = True
+                        continue
+                    if resp.status_code == 429:
+                        continue
+                    resp.raise_for_status()
+                    resp_json = resp.json()
+                    users = resp_json["response"]["users"]
+                    break
+                except Exception as e:
+                    last_error = str(e)
+                    time.sleep(limiter.backoff(attempt))
+            else:
+                print(f"Failed to fetch page {page}: {last_error}")
+                return None, None
+        count_progress("pages_fetched")
+
+        # for entry in users:
+        #     if entry["type"] == "STUDENT":
+        #         entry["grade"] = entry.get("grades", [None])[0]
+        #         entry["type"] = "S"
+        #     elif entry["type"] == "TEACHER":
+        #         entry["type"] = "T"
+        for entry in users:
+            grades = entry.get("grades")
+            if isinstance(grades, list) and grades:
+                entry["grade"] = grades[0]
+            else:
+                entry["grade"] = None
 
-                # Map type
-                if entry["type"] == "STUDENT":
-                    entry["type"] = "S"
-                elif entry["type"] == "TEACHER":
-                    entry["type"] = "T"
+            # Map type
+            if entry["type"] == "STUDENT":
+                entry["type"] = "S"
+            elif entry["type"] == "TEACHER":
+                entry["type"] = "T"
 
 
-            return users, resp_json
-        except Exception as e:
-            print(f"Failed to fetch page {page}: {e}")
-            return [], None
+        return (transform(users) if transform else users), resp_json
 
     # First page to get total_pages
     first_page_users, first_resp = fetch_page(1)
     if not first_resp:
-        return pd.DataFrame()  # Failed first request
+        return None  # Failed first request
 
     total_records = first_resp["response"]["total"]
     page_size = first_resp["response"]["page_size"]
     total_pages = math.ceil(int(total_records) / page_size)
 
-    all_users = first_page_users
+    pages = [first_page_users] + [None] * (total_pages - 1)
+    failed = []
 
     # Fetch remaining pages concurrently
     if total_pages > 1:
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(fetch_page, page): page for page in range(2, total_pages + 1)}
+            futures = {executor.submit(contextvars.copy_context().run, fetch_page, page): page for page in range(2, total_pages + 1)}
             for future in as_completed(futures):
-                users_page, _ = future.result()
-                all_users.extend(users_page)
+                users_page, resp_json = future.result()
+                if resp_json is None:
+                    failed.append(futures[future])
+                else:
+                    pages[futures[future] - 1] = users_page
+
+    # One more sequential pass once the concurrent load is gone
+    for page in sorted(failed):
+        users_page, resp_json = fetch_page(page)
+        if resp_json is None:
+            logger.error("listusers page %d failed after retries; not returning a partial listing", page)
+            return None
+        pages[page - 1] = users_page
+    return pages
 
-    df = pd.DataFrame(all_users)
-    if "grades" in df.columns:
-        df = df.drop(columns=["grades"])
 
-    return df
+def list_roster(MOSYLE_LIST_USERS_URL, accessToken, jwt_token, max_workers=5, refresh_jwt=None, limiter=None):
+    """Every Mosyle user as a Roster (Veracross field names), built page by page without a DataFrame."""
+    pages = fetch_user_pages(MOSYLE_LIST_USERS_URL, accessToken, jwt_token, max_workers=max_workers,
+                             refresh_jwt=refresh_jwt, limiter=limiter,
+                             transform=lambda users: Roster.from_rows(users, keys=LIST_USER_KEYS))
+    return Roster.concat(pages or [])
 
 
 
@@ -195,7 +536,7 @@ def list_users(MOSYLE_LIST_USERS_URL, accessToken, jwt_token, max_workers=5):
 
 
 
-def delete_users(MOSYLE_USERS_URL, accessToken, jwt_token, users, max_workers=5, batch_size=20):
+def delete_users(MOSYLE_USERS_URL, accessToken, jwt_token, users, max_workers=5, batch_size=None, refresh_jwt=None, limiter=None, recorder=None):
     if users.empty:
         print("No users available to delete")
         return {"message": "No users to delete", "status": "OK"}
@@ -205,62 +546,67 @@ def delete_users(MOSYLE_USERS_URL, accessToken, jwt_token, users, max_workers=5,
 
     deleted_count = 0
     failures = []
+    session = get_session(max_workers)
+    auth = JwtAuth(jwt_token, refresh_jwt)
+    limiter = limiter or mosyle_limiter
 
-    def delete_user_batch(batch_df):
-        elements_list = [{"operation": "delete", "id": str(user_id)} for user_id in batch_df["id"]]
-        user_data = {
-            "accessToken": accessToken,
-            "elements": elements_list
-        }
-        headers = {"Authorization": jwt_token, "Content-Type": "application/json"}
+    def delete_user_batch(elements_list):
+        statuses = send_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list)
+        if recorder:
+            recorder.record(elements_list, statuses)
 
-        # Retry with exponential backoff
-        for attempt in range(5):
-            try:
-                resp = requests.post(MOSYLE_USERS_URL, json=user_data, headers=headers, timeout=15)
-                if resp.status_code == 429:
-                    wait = 2 ** attempt
-                    logger.warning("429 Too Many Requests. Sleeping %s seconds", wait)
-                    time.sleep(wait)
-                    continue
+        # Count only elements with status "OK" as success
+        acknowledged, batch_failures = tally(elements_list, statuses)
+        logger.info(f"Deleted {acknowledged}/{len(elements_list)} users in batch")
+        return acknowledged, batch_failures
 
-                resp.raise_for_status()
-                resp_json = resp.json()
+    elements = delete_elements(users)
+    for acknowledged, batch_failures in run_batches(elements, delete_user_batch, limiter, max_workers, batch_size):
+        deleted_count += acknowledged
+        failures.extend(batch_failures)
 
-                # Count only elements with status "OK" as success
-                batch_success_count = sum(1 for el in resp_json.get("elements", []) if el.get("status") == "OK")
-                batch_failures = [
-                    {"id": el.get("id"), "status": el.get("status")}
-                    for el in resp_json.get("elements", [])
-                    if el.get("status") != "OK"
-                ]
+    return {
+        "status": "OK" if not failures else "partial",
+        "deleted": deleted_count,
+        "failed": len(failures),
+        "failures": failures[:20],
+    }
 
-                deleted_count_local = batch_success_count
-                logger.info(f"Deleted {deleted_count_local}/{len(batch_df)} users in batch")
-                return {"success": True, "count": deleted_count_local, "failures": batch_failures}
 
-            except Exception as e:
-                last_error = str(e)
-                time.sleep(1)
+def replay_elements(MOSYLE_USERS_URL, accessToken, jwt_token, pending, recorder, max_workers=5, batch_size=None, refresh_jwt=None, limiter=None):
+    """Resend journaled elements ({operation: [element, ...]}, e.g. JournalRun.pending()) one operation at a time.
 
-        # If all retries fail
-        return {"success": False, "error": last_error, "count": len(batch_df)}
+    Every batch's per-element statuses are passed to recorder.record. Returns
+    {"status", "replayed", "acknowledged", "failed", "failures"}.
+    """
+    if not all([MOSYLE_USERS_URL, accessToken, jwt_token]):
+        raise ValueError("Missing required parameters for replay!")
 
-    batches = [users.iloc[i:i+batch_size] for i in range(0, len(users), batch_size)]
+    session = get_session(max_workers)
+    auth = JwtAuth(jwt_token, refresh_jwt)
+    limiter = limiter or mosyle_limiter
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(delete_user_batch, batch) for batch in batches]
-        for future in as_completed(futures):
-            result = future.result()
-            if result["success"]:
-                deleted_count += result.get("count", 0)
-                failures.extend(result.get("failures", []))
-            else:
-                failures.append({"error": result["error"], "count": result["count"]})
+    def replay_batch(elements_list):
+        statuses = send_elements(session, MOSYLE_USERS_URL, accessToken, auth, limiter, elements_list)
+        recorder.record(elements_list, statuses)
+        return [(element.get("id"), status, detail) for element, (status, detail) in zip(elements_list, statuses)]
+
+    replayed = acknowledged = 0
+    failures = []
+    for operation, elements in pending.items():
+        for statuses in run_batches(elements, replay_batch, limiter, max_workers, batch_size):
+            for user_id, status, detail in statuses:
+                replayed += 1
+                if status == "ok":
+                    acknowledged += 1
+                else:
+                    failures.append({"id": user_id, "operation": operation, "error": detail})
+        logger.info(f"Replayed {len(elements)} journaled {operation} elements")
 
     return {
         "status": "OK" if not failures else "partial",
-        "deleted": deleted_count,
+        "replayed": replayed,
+        "acknowledged": acknowledged,
         "failed": len(failures),
         "failures": failures[:20],
     }
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from roster import Roster
+
+# Where /cleanup?dry_run=1 keeps its plans, and how long one may be applied
+# without re-fetching (Veracross and Mosyle drift while it waits).
+PLANS_DB = os.getenv("PLANS_DB", "/tmp/mosyle_plans.db")
+PLAN_MAX_AGE = float(os.getenv("PLAN_MAX_AGE", "900"))
+
+PHASES = ("to_add", "to_update", "to_delete")
+
+
+def plan_hash(frames):
+    """sha256 of the plan's rows, independent of row order."""
+    digest = hashlib.sha256()
+    for phase in PHASES:
+        digest.update(phase.encode())
+        for row in sorted(json.dumps(record, sort_keys=True) for record in frames[phase]):
+            digest.update(row.encode())
+    return digest.hexdigest()
+
+
+class PlanStore:
+    """SQLite table of reviewed /cleanup plans: the add/update/delete rows and their content hash.
+
+    A plan is applied at most once; claim() marks it atomically so a repeated
+    call cannot replay the same writes.
+    """
+
+    def __init__(self, path=PLANS_DB, max_age=PLAN_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "id TEXT PRIMARY KEY, hash TEXT, mode TEXT, created REAL, applied REAL, frames TEXT, tenant TEXT)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(plans)")}
+            if "tenant" not in columns:
+                conn.execute("ALTER TABLE plans ADD COLUMN tenant TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, to_add, to_update, to_delete, mode, tenant=None):
+        """Store a plan of three Rosters for tenant (a key); returns its summary (id, hash, counts, expiry)."""
+        frames = {
+            phase: [user._asdict() for user in users]
+            for phase, users in zip(PHASES, (to_add, to_update, to_delete))
+        }
+        plan_id = uuid.uuid4().hex
+        content_hash = plan_hash(frames)
+        created = time.time()
+        with self._connect() as conn:
+            # Applied or not, week-old plans are only history; keep the file small.
+            conn.execute("DELETE FROM plans WHERE created < ?", (created - 7 * 24 * 3600,))
+            conn.execute("INSERT INTO plans (id, hash, mode, created, frames, tenant) VALUES (?, ?, ?, ?, ?, ?)",
+                         (plan_id, content_hash, mode, created, json.dumps(frames), tenant))
+        return self._summary(plan_id, content_hash, mode, created, None, tenant, frames)
+
+    def _summary(self, plan_id, content_hash, mode, created, applied, tenant, frames):
+        return {
+            "plan_id": plan_id,
+            "hash": content_hash,
+            "mode": mode,
+            "tenant": tenant,
+            "created": created,
+            "expires": created + self.max_age,
+            "applied": applied,
+            **{phase: len(frames[phase]) for phase in PHASES},
+        }
+
+    def get(self, plan_id):
+        """Return (summary, frames) for plan_id, or None if unknown."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT id, hash, mode, created, applied, tenant, frames FROM plans WHERE id = ?",
+                               (plan_id,)).fetchone()
+        if row is None:
+            return None
+        frames = json.loads(row[6])
+        return self._summary(*row[:6], frames), frames
+
+    def unusable(self, summary):
+        """Why a plan cannot be applied (a message), or None if it can."""
+        if summary["applied"]:
+            return "Plan was already applied"
+        if time.time() > summary["expires"]:
+            return "Plan is stale; run /cleanup?dry_run=1 again"
+        return None
+
+    def claim(self, plan_id):
+        """Mark a fresh, unapplied plan as applied; returns (summary, to_add, to_update, to_delete) Rosters.
+
+        Raises ValueError if the plan is unknown, applied, stale, or its rows no
+        longer match the stored hash.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            claimed = conn.execute("UPDATE plans SET applied = ? WHERE id = ? AND applied IS NULL AND created >= ?",
+                                   (now, plan_id, now - self.max_age)).rowcount
+        found = self.get(plan_id)
+        if found is None:
+            raise ValueError("Unknown plan id")
+        summary, frames = found
+        if not claimed:
+            raise ValueError(self.unusable(summary) or "Plan cannot be applied")
+        if plan_hash(frames) != summary["hash"]:
+            raise ValueError("Plan content does not match its hash")
+        return (summary, *(Roster.from_rows(frames[phase]) for phase in PHASES))
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+
+logger = logging.getLogger("Mosyle Integration")
+
+# Ceiling for Mosyle requests per second; the limiter backs off below it on 429s.
+MOSYLE_MAX_RPS = float(os.getenv("MOSYLE_MAX_RPS", "10"))
+# Batches slower than this (seconds) shrink concurrency instead of growing it.
+MOSYLE_TARGET_LATENCY = float(os.getenv("MOSYLE_TARGET_LATENCY", "5"))
+# Elements per Mosyle write: batches start at MOSYLE_START_BATCH_SIZE and
+# double on fast responses up to MOSYLE_MAX_BATCH_SIZE, until a slow response,
+# timeout or 413 shows where Mosyle's limit is.
+MOSYLE_START_BATCH_SIZE = int(os.getenv("MOSYLE_START_BATCH_SIZE", "20"))
+MOSYLE_MAX_BATCH_SIZE = int(os.getenv("MOSYLE_MAX_BATCH_SIZE", "200"))
+
+
+def retry_after_seconds(response, default):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def jittered(seconds):
+    return seconds * random.uniform(0.8, 1.2)
+
+
+class AdaptiveLimiter:
+    """Token bucket plus AIMD concurrency/batch-size control shared by all callers of an API.
+
+    Every request goes through call(): it waits for a bucket token and a free
+    concurrency slot, and the outcome feeds back into the limits. A 429 cuts
+    the rate and concurrency multiplicatively and pauses every caller for the
+    Retry-After period (with jitter); responses slower than target_latency
+    (or timing out) shrink concurrency and batch size; fast successes grow
+    them back additively. Until the first slow response the batch size is
+    probed upwards by doubling, and too_large() (a 413) lowers its ceiling.
+    """
+
+    def __init__(self, max_rps=MOSYLE_MAX_RPS, max_concurrency=5, max_batch_size=MOSYLE_MAX_BATCH_SIZE,
+                 min_batch_size=5, target_latency=MOSYLE_TARGET_LATENCY, start_batch_size=MOSYLE_START_BATCH_SIZE):
+        self.max_rps = max_rps
+        self.rate = max_rps
+        self.tokens = 1.0
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min_batch_size
+        self.current_batch_size = float(min(start_batch_size, max_batch_size))
+        self.probing = True
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._decreased_at = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self):
+        """Take a token and a concurrency slot if both are free: (True, 0), else (False, seconds to wait or None)."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = self.paused_until - now
+        if wait <= 0:
+            if self.in_flight < max(1, int(self.concurrency)) and self.tokens >= 1:
+                self.tokens -= 1
+                self.in_flight += 1
+                self.requests += 1
+                return True, 0
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else None
+        return False, wait
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                taken, wait = self._take()
+                if taken:
+                    return
+                self._cond.wait(timeout=wait)
+
+    async def acquire_async(self):
+        """acquire() for coroutines: sleeps on the event loop instead of blocking it."""
+        while True:
+            with self._cond:
+                taken, wait = self._take()
+            if taken:
+                return
+            # Without a token deadline the wait is for a release, which cannot wake a coroutine.
+            await asyncio.sleep(wait if wait is not None else 0.01)
+
+    def release(self, latency=None, throttled=False, retry_after=None, started=None):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                pause = jittered(retry_after if retry_after is not None else 1.0)
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+                # Requests already in flight when we last backed off report the
+                # same congestion; only decrease once per episode.
+                if started is None or started >= self._decreased_at:
+                    self._decreased_at = time.monotonic()
+                    self.rate = max(0.5, self.rate * 0.7)
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                logger.warning("429 Too Many Requests. Pausing %.1fs; rate=%.1f/s concurrency=%d",
+                               pause, self.rate, int(self.concurrency))
+            elif latency is not None and latency > self.target_latency:
+                # Slow but accepted: smaller payloads and fewer in flight.
+                self.probing = False
+                self.concurrency = max(1.0, self.concurrency - 1)
+                self.current_batch_size = max(self.min_batch_size, self.current_batch_size * 0.75)
+            elif latency is not None:
+                self.rate = min(self.max_rps, self.rate + 0.1 * self.max_rps / max(1.0, self.rate))
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                grown = self.current_batch_size * 2 if self.probing else self.current_batch_size + 1
+                self.current_batch_size = min(self.max_batch_size, grown)
+            self._cond.notify_all()
+
+    def too_large(self, size):
+        """Mosyle refused a size-element payload (413): cap batches well below it from now on."""
+        with self._cond:
+            self.probing = False
+            self.max_batch_size = max(self.min_batch_size, min(self.max_batch_size, size // 2))
+            self.current_batch_size = min(self.current_batch_size, self.max_batch_size)
+        logger.warning("Mosyle refused a %d-element batch; batch size now at most %d", size, self.max_batch_size)
+
+    def _record(self, response, start):
+        if response.status_code == 429:
+            self.release(throttled=True, retry_after=retry_after_seconds(response, None), started=start)
+        else:
+            self.release(latency=time.monotonic() - start)
+
+    def call(self, send):
+        """Run send() (which returns a requests.Response) under the limiter and record the outcome."""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            response = send()
+        except requests.Timeout:
+            # No answer within the timeout counts as the slowest response.
+            self.release(latency=float("inf"))
+            raise
+        except Exception:
+            self.release()
+            raise
+        self._record(response, start)
+        return response
+
+    async def call_async(self, send, timeouts=()):
+        """call() for a coroutine function send (e.g. an httpx request); timeouts are its timeout exceptions."""
+        await self.acquire_async()
+        start = time.monotonic()
+        try:
+            response = await send()
+        except timeouts:
+            self.release(latency=float("inf"))
+            raise
+        except Exception:
+            self.release()
+            raise
+        self._record(response, start)
+        return response
+
+    def set_max_rps(self, max_rps):
+        """Change the rate ceiling (and restart the rate from it)."""
+        with self._cond:
+            self.max_rps = max_rps
+            self.rate = max_rps
+            self._cond.notify_all()
+
+    def batch_size(self, cap=None):
+        with self._cond:
+            size = int(self.current_batch_size)
+        return min(size, cap) if cap else size
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retrying a failed (non-429) request."""
+        return jittered(min(30, 2 ** attempt))
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "rate": round(self.rate, 2),
+                "concurrency": int(self.concurrency),
+                "batch_size": int(self.current_batch_size),
+                "max_batch_size": self.max_batch_size,
+                "requests": self.requests,
+                "throttled": self.throttled,
+            }
+
+
+mosyle_limiter = AdaptiveLimiter()
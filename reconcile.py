@@ -0,0 +1,20 @@
+import hashlib
+from collections import namedtuple
+
+FIELDS = ("full_name", "email_1", "grade_level", "type")
+COLUMNS = ("id",) + FIELDS
+
+Plan = namedtuple("Plan", ["to_add", "to_update", "to_delete"])
+
+
+def _clean(value):
+    # None and NaN both mean "not set", as fillna("") did in the old reconcile.
+    if value is None or value != value:
+        return ""
+    return str(value)
+
+
+def row_hash(full_name, email_1, grade_level, user_type):
+    """Content hash of the fields compared between Veracross and Mosyle."""
+    raw = "\x1f".join(_clean(v) for v in (full_name, email_1, grade_level, user_type))
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
@@ -0,0 +1,155 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from metrics import RESPONSE_CACHE
+
+# On-disk cache of Veracross list pages (off unless VC_RESPONSE_CACHE_DB is set).
+VC_RESPONSE_CACHE_DB = os.getenv("VC_RESPONSE_CACHE_DB", "")
+# Pages served with an ETag or Last-Modified are revalidated on every use;
+# pages without either are reused for this many seconds.
+VC_RESPONSE_CACHE_TTL = float(os.getenv("VC_RESPONSE_CACHE_TTL", "600"))
+# Compressed bytes kept before the least recently used pages are evicted.
+VC_RESPONSE_CACHE_MAX_MB = float(os.getenv("VC_RESPONSE_CACHE_MAX_MB", "512"))
+# Serve every cached page as is, without revalidating or expiring it (to
+# replay a copied production cache locally, e.g. for profiling).
+VC_RESPONSE_CACHE_REPLAY = os.getenv("VC_RESPONSE_CACHE_REPLAY", "0") == "1"
+# Skip cached pages (still storing what is fetched); per request with bypassed().
+VC_RESPONSE_CACHE_BYPASS = os.getenv("VC_RESPONSE_CACHE_BYPASS", "0") == "1"
+
+_bypass = contextvars.ContextVar("response_cache_bypass", default=VC_RESPONSE_CACHE_BYPASS)
+
+
+@contextlib.contextmanager
+def bypassed():
+    """Fetch every page in this context from Veracross, refreshing the cache with the answers."""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def is_bypassed():
+    return _bypass.get()
+
+
+def page_key(url, params, page, page_size):
+    return hashlib.sha256(json.dumps([url, params, page, page_size], sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    """SQLite cache of Veracross page bodies (zlib-compressed JSON), keyed by URL, params and page.
+
+    lookup() returns the stored entry for a page; fresh() says whether it can
+    be used without a request, and validators() gives the conditional headers
+    to revalidate it with (a 304 then costs no body). Past max_bytes the least
+    recently used pages are evicted.
+    """
+
+    def __init__(self, path, ttl=VC_RESPONSE_CACHE_TTL, max_bytes=VC_RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+                 replay=VC_RESPONSE_CACHE_REPLAY):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "key TEXT PRIMARY KEY, url TEXT, body BLOB, etag TEXT, last_modified TEXT, "
+                "fetched_at REAL, used_at REAL, size INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS pages_used_at ON pages (used_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def lookup(self, key):
+        """The stored entry for key ({"body", "etag", "last_modified", "fetched_at"}), or None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT body, etag, last_modified, fetched_at FROM pages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return {"body": json.loads(zlib.decompress(row[0])), "etag": row[1], "last_modified": row[2], "fetched_at": row[3]}
+
+    def fresh(self, entry):
+        """Whether entry can be used without asking Veracross."""
+        if self.replay:
+            return True
+        if entry["etag"] or entry["last_modified"]:
+            return False
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def validators(self, entry):
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def hit(self, key, revalidated=False):
+        """Mark key used (and, after a 304, verified now)."""
+        RESPONSE_CACHE.inc(result="revalidated" if revalidated else "hit")
+        now = time.time()
+        with self._connect() as conn:
+            if revalidated:
+                conn.execute("UPDATE pages SET used_at = ?, fetched_at = ? WHERE key = ?", (now, now, key))
+            else:
+                conn.execute("UPDATE pages SET used_at = ? WHERE key = ?", (now, key))
+
+    def store(self, key, url, body, headers, bypassed=False):
+        RESPONSE_CACHE.inc(result="bypass" if bypassed else "miss")
+        blob = zlib.compress(json.dumps(body, separators=(",", ":")).encode())
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (key, url, blob, headers.get("ETag"), headers.get("Last-Modified"), now, now, len(blob)))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Down to 90% of the cap, so eviction does not run on every store.
+        excess = total - 0.9 * self.max_bytes
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM pages ORDER BY used_at"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        conn.executemany("DELETE FROM pages WHERE key = ?", evicted)
+        RESPONSE_CACHE.inc(len(evicted), result="evicted")
+
+    def stats(self):
+        with self._connect() as conn:
+            pages, size, oldest = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(fetched_at) FROM pages").fetchone()
+        return {"pages": pages, "bytes": size, "max_bytes": int(self.max_bytes),
+                "oldest_age": round(time.time() - oldest, 1) if oldest else None,
+                "ttl": self.ttl, "replay": self.replay}
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM pages")
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_response_cache():
+    """The ResponseCache configured by VC_RESPONSE_CACHE_DB (one per process), or None when it is off."""
+    if not VC_RESPONSE_CACHE_DB:
+        return None
+    with _caches_lock:
+        if VC_RESPONSE_CACHE_DB not in _caches:
+            _caches[VC_RESPONSE_CACHE_DB] = ResponseCache(VC_RESPONSE_CACHE_DB)
+        return _caches[VC_RESPONSE_CACHE_DB]
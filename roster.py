@@ -0,0 +1,133 @@
+import sys
+from collections import namedtuple
+from reconcile import COLUMNS, Plan
+
+# One user, as yielded when iterating a Roster (and stored in plans).
+User = namedtuple("User", COLUMNS)
+
+ID, FULL_NAME, EMAIL, GRADE_LEVEL, TYPE = range(len(COLUMNS))
+
+
+def _text(value):
+    # None and NaN both mean "not set", as in reconcile._clean.
+    if value.__class__ is str:
+        return value
+    if value is None or value != value:
+        return ""
+    return str(value)
+
+
+def _shared(value):
+    # grade_level and type repeat across the roster: keep one str object per value.
+    return sys.intern(_text(value))
+
+
+class Roster:
+    """Users of one system as five parallel str columns (COLUMNS order).
+
+    Shared by the Veracross fetch (vc_api.student_roster/staff_roster),
+    mosyle_api.list_roster and plan_rosters. Columns are plain lists of
+    normalized values (missing values "", ids str, grade and type interned),
+    so a roster costs one reference per field, is never copied by
+    fillna/astype/rename, and pages can be appended as they arrive.
+    """
+
+    __slots__ = ("columns",)
+
+    def __init__(self, columns=None):
+        self.columns = columns if columns is not None else tuple([] for _ in COLUMNS)
+
+    @classmethod
+    def from_columns(cls, ids, full_names, emails, grade_levels, types):
+        return cls((
+            [_text(value) for value in ids],
+            [_text(value) for value in full_names],
+            [_text(value) for value in emails],
+            [_shared(value) for value in grade_levels],
+            [_shared(value) for value in types],
+        ))
+
+    @classmethod
+    def from_rows(cls, rows, keys=COLUMNS):
+        """From row mappings; keys names the id, full_name, email_1, grade_level and type keys."""
+        return cls.from_columns(*([row.get(key) for row in rows] for key in keys))
+
+    @classmethod
+    def from_tuples(cls, rows):
+        """From COLUMNS-ordered tuples (e.g. SQLite rows)."""
+        columns = list(zip(*rows)) or [()] * len(COLUMNS)
+        return cls.from_columns(*columns)
+
+    @classmethod
+    def concat(cls, rosters):
+        roster = cls()
+        for other in rosters:
+            roster.extend(other)
+        return roster
+
+    def __len__(self):
+        return len(self.columns[ID])
+
+    def __iter__(self):
+        return map(User._make, zip(*self.columns))
+
+    def __add__(self, other):
+        return Roster(tuple(mine + theirs for mine, theirs in zip(self.columns, other.columns)))
+
+    @property
+    def empty(self):
+        return not self.columns[ID]
+
+    def ids(self):
+        return self.columns[ID]
+
+    def extend(self, other):
+        for mine, theirs in zip(self.columns, other.columns):
+            mine.extend(theirs)
+
+    def take(self, positions):
+        return Roster(tuple([column[i] for i in positions] for column in self.columns))
+
+    def unique(self):
+        """Drop exact duplicate users (one returned by two fetch passes), keeping order."""
+        seen = set()
+        keep = [i for i, row in enumerate(zip(*self.columns)) if not (row in seen or seen.add(row))]
+        return self if len(keep) == len(self) else self.take(keep)
+
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame(dict(zip(COLUMNS, self.columns)))
+
+
+def plan_rosters(vc, mosyle, include_deletes=True):
+    """The add/update/delete plan for two Rosters, column-wise; returns a Plan of Rosters.
+
+    Mosyle is indexed once as id -> position (the last row wins for a repeated
+    id); Veracross rows are compared field by field in place, so no per-row
+    tuples or hashes are built. ADMIN accounts are never updated or deleted;
+    only the first Veracross row for a repeated id is used.
+    """
+    index = {user_id: i for i, user_id in enumerate(mosyle.columns[ID])}
+    admin = {user_type for user_type in set(mosyle.columns[TYPE]) if user_type.upper() == "ADMIN"}
+    _, names, emails, grades, types = mosyle.columns
+    _, vc_names, vc_emails, vc_grades, vc_types = vc.columns
+
+    to_add, to_update = [], []
+    seen = set()
+    for j, user_id in enumerate(vc.columns[ID]):
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        i = index.get(user_id)
+        if i is None:
+            to_add.append(j)
+        elif types[i] not in admin and (
+            vc_names[j] != names[i] or vc_emails[j] != emails[i]
+            or vc_grades[j] != grades[i] or vc_types[j] != types[i]
+        ):
+            to_update.append(j)
+
+    to_delete = []
+    if include_deletes:
+        to_delete = [i for user_id, i in index.items() if user_id not in seen and types[i] not in admin]
+    return Plan(vc.take(to_add), vc.take(to_update), mosyle.take(to_delete))
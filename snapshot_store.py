@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from reconcile import row_hash
+from roster import Roster
+from mosyle_api import element_roster, LIST_USER_KEYS
+
+SNAPSHOT_COLUMNS = ["id", "full_name", "email_1", "grade_level", "type"]
+
+
+def page_checksum(users):
+    """Checksum of one listusers page's users, to tell unchanged pages on refresh."""
+    return hashlib.sha256(json.dumps(users, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class SnapshotStore:
+    """SQLite mirror of the users Mosyle holds.
+
+    Rows use the Veracross column names (id, full_name, email_1, grade_level,
+    type) and load as a Roster, so they can stand in for list_roster() in cleanup().
+    Our own acknowledged writes are applied as they return (record(), the
+    create_users/delete_users recorder= hook), and refresh() verifies the
+    whole mirror against a listusers listing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "id TEXT PRIMARY KEY, full_name TEXT, email_1 TEXT, grade_level TEXT, "
+                "type TEXT, hash TEXT, synced_at REAL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS pages (page INTEGER PRIMARY KEY, checksum TEXT, users INTEGER)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_meta(self, key, default=None):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def last_sync(self):
+        value = self.get_meta("last_sync")
+        return float(value) if value else None
+
+    def full_reconcile_due(self, every_hours):
+        value = self.get_meta("last_full")
+        return not value or time.time() - float(value) >= every_hours * 3600
+
+    def mirror_age(self):
+        """Seconds since refresh() last verified the mirror (infinite if never)."""
+        value = self.get_meta("mirror_verified")
+        return time.time() - float(value) if value else float("inf")
+
+    def load(self):
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM users").fetchall()
+        return Roster.from_tuples(rows)
+
+    def _rows(self, users, synced_at):
+        # Rosters are already all-str; DataFrames are normalized here.
+        if not isinstance(users, Roster):
+            users = users[SNAPSHOT_COLUMNS].fillna("").astype(str).itertuples(index=False)
+        for user in users:
+            yield (*user, row_hash(user.full_name, user.email_1, user.grade_level, user.type), synced_at)
+
+    def upsert(self, users, synced_at=None):
+        if users.empty:
+            return
+        synced_at = synced_at or time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)", self._rows(users, synced_at))
+
+    def delete(self, ids):
+        with self._lock, self._connect() as conn:
+            conn.executemany("DELETE FROM users WHERE id = ?", ((str(i),) for i in ids))
+
+    def replace_all(self, users, synced_at=None):
+        synced_at = synced_at or time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM users")
+            if users.empty:
+                return
+            conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?)", self._rows(users, synced_at))
+
+    def record(self, elements, statuses):
+        """Write-through: apply a Mosyle batch's acknowledged elements (see mosyle_api.batch_statuses)."""
+        acknowledged = [element for element, (status, _) in zip(elements, statuses) if status == "ok"]
+        if not acknowledged:
+            return
+        saved = [element for element in acknowledged if element.get("operation") != "delete"]
+        self.upsert(element_roster(saved))
+        self.delete(element["id"] for element in acknowledged if element.get("operation") == "delete")
+        # Mirrored rows no longer match what listusers returned for their
+        # pages; the next refresh must not skip any of them.
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM pages")
+
+    def refresh(self, pages, verified_at=None):
+        """Verify the mirror against a complete listusers listing (fetch_user_pages of (checksum, users) pairs).
+
+        Pages whose checksum matches the one stored by the previous refresh are
+        skipped; the users of every other page are upserted, and mirrored users
+        no page lists any more are removed. Returns counts of what changed.
+        """
+        verified_at = verified_at or time.time()
+        with self._connect() as conn:
+            stored = dict(conn.execute("SELECT page, checksum FROM pages"))
+        changed = [(number, checksum, users) for number, (checksum, users) in enumerate(pages, 1)
+                   if stored.get(number) != checksum]
+        ids = [(str(user["id"]),) for _, users in pages for user in users]
+        with self._lock, self._connect() as conn:
+            for number, checksum, users in changed:
+                roster = Roster.from_rows(users, keys=LIST_USER_KEYS)
+                conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)", self._rows(roster, verified_at))
+                conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (number, checksum, len(users)))
+            conn.execute("DELETE FROM pages WHERE page > ?", (len(pages),))
+            conn.execute("CREATE TEMP TABLE listed (id TEXT PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO listed VALUES (?)", ids)
+            removed = conn.execute("DELETE FROM users WHERE id NOT IN (SELECT id FROM listed)").rowcount
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('mirror_verified', ?)", (str(verified_at),))
+        return {"pages": len(pages), "changed_pages": len(changed), "users": len(ids), "removed": removed}
+
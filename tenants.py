@@ -0,0 +1,127 @@
+import json
+import os
+from http_session import use_pool
+from mosyle_api import get_token, DEFAULT_LOCATION
+from rate_limit import AdaptiveLimiter, mosyle_limiter, MOSYLE_MAX_RPS
+from snapshot_store import SnapshotStore
+from vc_api import get_access_token, VeracrossAuth
+
+
+class Tenant:
+    """One school: its Veracross instance, Mosyle account, location and email domain.
+
+    Each tenant has its own Mosyle rate limiter (Mosyle throttles per
+    account), its own HTTP connection pool (activate()) and its own mirror
+    database; tokens are cached per tenant because the token cache is keyed
+    by credentials.
+    """
+
+    def __init__(self, key, school, location, email_domain, vc_client_id, vc_client_secret,
+                 mosyle_email, mosyle_password, mosyle_token, snapshot_db=None, mosyle_max_rps=MOSYLE_MAX_RPS,
+                 limiter=None, vc_accounts_url="https://accounts.veracross.com",
+                 vc_api_url="https://api.veracross.com", mosyle_api_url="https://managerapi.mosyle.com"):
+        self.key = key
+        self.school = school
+        self.location = location
+        # Veracross users without an address in this domain are not managed.
+        self.email_domain = email_domain
+        self.vc_client_id = vc_client_id
+        self.vc_client_secret = vc_client_secret
+        self.mosyle_email = mosyle_email
+        self.mosyle_password = mosyle_password
+        self.mosyle_token = mosyle_token
+        self.snapshot_db = snapshot_db
+        self.limiter = limiter or AdaptiveLimiter(max_rps=mosyle_max_rps)
+
+        self.vc_token_url = f"{vc_accounts_url}/{school.lower()}/oauth/token"
+        self.vc_students_url = f"{vc_api_url}/{school}/v3/students"
+        self.vc_staff_url = f"{vc_api_url}/{school}/v3/staff_faculty"
+        self.mosyle_auth_url = f"{mosyle_api_url}/v2/login?"
+        self.mosyle_users_url = f"{mosyle_api_url}/v2/users"
+        self.mosyle_list_users_url = f"{mosyle_api_url}/v2/listusers"
+
+    def __repr__(self):
+        return f"Tenant({self.key!r})"
+
+    def activate(self):
+        """Context in which this tenant's HTTP calls use its own connection pool."""
+        return use_pool(self.key)
+
+    def vc_token(self):
+        return get_access_token(url=self.vc_token_url, vc_client_id=self.vc_client_id,
+                                vc_client_secret=self.vc_client_secret)
+
+    def refresh_vc_token(self, stale_token):
+        return get_access_token(url=self.vc_token_url, vc_client_id=self.vc_client_id,
+                                vc_client_secret=self.vc_client_secret, stale_token=stale_token)
+
+    def vc_auth(self):
+        """The Veracross token as a VeracrossAuth, refreshed once on a 401 for every page thread."""
+        return VeracrossAuth(self.vc_token(), self.refresh_vc_token)
+
+    def mosyle_jwt(self, stale_token=None):
+        return get_token(AUTH_URL=self.mosyle_auth_url, EMAIL=self.mosyle_email, PASSWORD=self.mosyle_password,
+                         TOKEN=self.mosyle_token, stale_token=stale_token)
+
+    def refresh_mosyle_jwt(self, stale_token):
+        return self.mosyle_jwt(stale_token=stale_token)
+
+    def snapshot(self):
+        """This tenant's Mosyle mirror, or None when it has no snapshot_db."""
+        return SnapshotStore(self.snapshot_db) if self.snapshot_db else None
+
+    def describe(self):
+        """Public settings (no credentials)."""
+        return {"key": self.key, "school": self.school, "location": self.location,
+                "email_domain": self.email_domain, "mirror": bool(self.snapshot_db)}
+
+
+def load_tenants():
+    """Tenants by key, in configured order; the first is the default for routes without ?tenant=.
+
+    TENANTS_FILE is a JSON list of {"key", "school", "location",
+    "email_domain", "env_prefix"}; credentials come from the environment as
+    <env_prefix>VC_CLIENT_ID, <env_prefix>VC_CLIENT_SECRET,
+    <env_prefix>MOSYLE_EMAIL, <env_prefix>MOSYLE_PASSWORD,
+    <env_prefix>MOSYLE_ACCESS_TOKEN, and optionally <env_prefix>SNAPSHOT_DB
+    and <env_prefix>MOSYLE_MAX_RPS. Without TENANTS_FILE there is one
+    tenant, ACS Abu Dhabi, configured by the unprefixed variables.
+    VC_ACCOUNTS_URL, VC_API_URL and MOSYLE_API_URL point every tenant at
+    other hosts (e.g. benchmarks/fake_services.py).
+    """
+    path = os.getenv("TENANTS_FILE")
+    if path:
+        with open(path) as f:
+            configs = json.load(f)
+    else:
+        configs = [{"key": "acsad", "school": "ACSAD", "location": DEFAULT_LOCATION,
+                    "email_domain": "@acs.sch.ae", "env_prefix": ""}]
+    hosts = {
+        "vc_accounts_url": os.getenv("VC_ACCOUNTS_URL", "https://accounts.veracross.com"),
+        "vc_api_url": os.getenv("VC_API_URL", "https://api.veracross.com"),
+        "mosyle_api_url": os.getenv("MOSYLE_API_URL", "https://managerapi.mosyle.com"),
+    }
+
+    tenants = {}
+    for i, config in enumerate(configs):
+        prefix = config.get("env_prefix", "")
+        max_rps = float(os.getenv(f"{prefix}MOSYLE_MAX_RPS", MOSYLE_MAX_RPS))
+        if i == 0:
+            # The first tenant keeps the module-wide limiter other callers share, at its own rate.
+            mosyle_limiter.set_max_rps(max_rps)
+        tenants[config["key"]] = Tenant(
+            key=config["key"],
+            school=config["school"],
+            location=config["location"],
+            email_domain=config["email_domain"],
+            vc_client_id=os.getenv(f"{prefix}VC_CLIENT_ID"),
+            vc_client_secret=os.getenv(f"{prefix}VC_CLIENT_SECRET"),
+            mosyle_email=os.getenv(f"{prefix}MOSYLE_EMAIL"),
+            mosyle_password=os.getenv(f"{prefix}MOSYLE_PASSWORD"),
+            mosyle_token=os.getenv(f"{prefix}MOSYLE_ACCESS_TOKEN"),
+            snapshot_db=os.getenv(f"{prefix}SNAPSHOT_DB"),
+            mosyle_max_rps=max_rps,
+            limiter=mosyle_limiter if i == 0 else None,
+            **hosts,
+        )
+    return tenants
@@ -0,0 +1,140 @@
+import json
+import httpx
+from async_engine import apply_changes
+from rate_limit import AdaptiveLimiter
+from roster import Roster
+
+URL = "https://mosyle.test/v2/users"
+
+
+def users(*user_ids, user_type="S"):
+    return Roster.from_tuples([(str(i), f"User {i}", f"u{i}@x", "Grade 1", user_type) for i in user_ids])
+
+
+def mosyle(handler):
+    """An httpx client whose requests go to handler(elements, request) -> httpx.Response."""
+    requests = []
+
+    def respond(request):
+        requests.append(request)
+        return handler(json.loads(request.content)["elements"], request)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(respond)), requests
+
+
+def ok(elements, request=None):
+    return httpx.Response(200, json={"status": "OK", "elements": [{"id": el["id"], "status": "OK"} for el in elements]})
+
+
+def run(client, to_add=Roster(), to_update=Roster(), to_delete=Roster(), **kwargs):
+    kwargs.setdefault("limiter", AdaptiveLimiter(max_rps=1000))
+    return apply_changes(URL, "token", "jwt", to_add, to_update, to_delete, client=client, **kwargs)
+
+
+def test_applies_every_phase():
+    client, requests = mosyle(ok)
+    result = run(client, to_add=users(1, 2, 3), to_update=users(4), to_delete=users(5, 6), batch_size=2)
+    assert result["status"] == "OK"
+    assert result["updated"] == 4 and result["deleted"] == 2 and result["failed"] == 0
+    operations = sorted(el["operation"] for r in requests for el in json.loads(r.content)["elements"])
+    assert operations == ["delete", "delete", "save", "save", "save", "update"]
+    assert {r.headers["Authorization"] for r in requests} == {"jwt"}
+
+
+def test_rejected_batch_is_split_down_to_the_bad_element():
+    def handler(elements, request):
+        if any(el["id"] == "7" for el in elements):
+            return httpx.Response(400, json={"status": "ERROR", "error": "bad element"})
+        return ok(elements)
+
+    client, _ = mosyle(handler)
+    result = run(client, to_add=users(*range(1, 9)), batch_size=8)
+    assert result["status"] == "partial"
+    assert result["updated"] == 7
+    assert [failure["id"] for failure in result["failures"]] == ["7"]
+
+
+def test_elements_missing_from_the_response_fail():
+    def handler(elements, request):
+        return httpx.Response(200, json={"status": "OK", "elements": [{"id": elements[0]["id"], "status": "OK"}]})
+
+    client, _ = mosyle(handler)
+    result = run(client, to_add=users(1, 2), batch_size=2)
+    assert result["updated"] == 1 and result["failed"] == 1
+
+
+def test_an_error_status_fails_the_whole_batch():
+    def handler(elements, request):
+        return httpx.Response(200, json={"status": "ERROR", "error": "Invalid accessToken"})
+
+    client, _ = mosyle(handler)
+    result = run(client, to_add=users(1, 2), batch_size=2)
+    assert result["updated"] == 0 and result["failed"] == 2
+    assert {failure["error"] for failure in result["failures"]} == {"Invalid accessToken"}
+
+
+def test_401_refreshes_the_jwt_once():
+    refreshed = []
+
+    def handler(elements, request):
+        if request.headers["Authorization"] == "jwt":
+            return httpx.Response(401, json={"status": "ERROR"})
+        return ok(elements)
+
+    def refresh(stale):
+        refreshed.append(stale)
+        return "jwt2"
+
+    client, requests = mosyle(handler)
+    result = run(client, to_add=users(1), refresh_jwt=refresh)
+    assert result["status"] == "OK"
+    assert refreshed == ["jwt"]
+    assert requests[-1].headers["Authorization"] == "jwt2"
+
+
+def test_429_is_retried_after_retry_after():
+    answers = [httpx.Response(429, headers={"Retry-After": "0"})]
+
+    def handler(elements, request):
+        return answers.pop() if answers else ok(elements)
+
+    client, requests = mosyle(handler)
+    result = run(client, to_add=users(1, 2))
+    assert result["status"] == "OK" and result["updated"] == 2
+    assert len(requests) == 2
+
+
+def test_server_errors_fail_the_batch_unsplit():
+    client, requests = mosyle(lambda elements, request: httpx.Response(503, json={"status": "ERROR"}))
+    limiter = AdaptiveLimiter(max_rps=1000)
+    limiter.backoff = lambda attempt: 0
+    result = run(client, to_add=users(*range(1, 9)), batch_size=8, limiter=limiter)
+    assert result["status"] == "partial" and result["failed"] == 8
+    assert len(requests) == 5
+    assert {len(json.loads(r.content)["elements"]) for r in requests} == {8}
+
+
+def test_throttling_does_not_use_up_the_attempts():
+    answers = [httpx.Response(429, headers={"Retry-After": "0"}) for _ in range(7)]
+
+    def handler(elements, request):
+        return answers.pop() if answers else ok(elements)
+
+    client, requests = mosyle(handler)
+    result = run(client, to_add=users(1, 2))
+    assert result["status"] == "OK" and result["updated"] == 2
+    assert len(requests) == 8
+
+
+def test_batches_follow_the_limiter():
+    def handler(elements, request):
+        if len(elements) > 10:
+            return httpx.Response(413, json={"status": "ERROR", "error": "too large"})
+        return ok(elements)
+
+    limiter = AdaptiveLimiter(max_rps=1000, start_batch_size=16)
+    client, requests = mosyle(handler)
+    result = run(client, to_add=users(*range(1, 41)), limiter=limiter)
+    assert result["status"] == "OK" and result["updated"] == 40
+    assert limiter.max_batch_size == 8
+    assert limiter.requests == len(requests)
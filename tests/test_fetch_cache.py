@@ -0,0 +1,20 @@
+from fetch_cache import FetchCache
+from response_cache import bypassed
+
+URL = "https://api.veracross.test/school/v3/students"
+
+
+def test_bypassed_fetches_skip_the_cache_but_refresh_it():
+    cache = FetchCache(ttl=300)
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return [[{"id": len(fetches)}]]
+
+    assert cache.get_or_fetch(URL, {}, fetch) == [[{"id": 1}]]
+    with bypassed():
+        assert cache.get(URL, {}) is None
+        assert cache.get_or_fetch(URL, {}, fetch) == [[{"id": 2}]]
+    assert cache.get(URL, {}) == [[{"id": 2}]]
+    assert len(fetches) == 2
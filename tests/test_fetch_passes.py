@@ -0,0 +1,49 @@
+import importlib.util
+import os
+import threading
+import pytest
+from fetch_cache import fetch_cache
+from vc_api import student_roster, student_spec, student_passes, cached_pages
+
+spec = importlib.util.spec_from_file_location(
+    "fake_services", os.path.join(os.path.dirname(__file__), "..", "benchmarks", "fake_services.py"))
+fake_services = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fake_services)
+
+
+@pytest.fixture
+def veracross():
+    state = fake_services.FakeState(students=2500, staff=10, new_every=3)
+    server = fake_services.serve(state, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield state, f"http://127.0.0.1:{server.server_address[1]}/school/v3/students"
+    server.shutdown()
+
+
+def test_sync_all_new_students_match_the_create_route(veracross):
+    state, url = veracross
+    # /create_new_students on its own: Veracross filters on entry_date.
+    created = student_roster(access_token="token", students_url=url, params_required=True)
+    create_requests = state.requests["/school/v3/students"]
+
+    # /sync_all: the cleanup's full listing is pinned, then the create step filters it locally.
+    with fetch_cache.pinned():
+        everyone = student_roster(access_token="token", students_url=url, params_required=False)
+        before = state.requests["/school/v3/students"]
+        from_listing = student_roster(access_token="token", students_url=url, params_required=True)
+        step_requests = state.requests["/school/v3/students"] - before
+
+    assert len(everyone) == 2500 and len(created) == 2500 // 3
+    assert sorted(from_listing.ids()) == sorted(created.ids())
+    # Of its two passes, only the future-students (role 7) one went to Veracross.
+    assert step_requests == create_requests // 2
+
+
+def test_a_listing_without_the_filtered_field_is_not_filtered_locally():
+    url = "https://api.veracross.test/school/v3/students"
+    spec = student_spec(params_required=True)
+    params = student_passes(spec, params_required=True)[0]
+    with fetch_cache.pinned():
+        # Rows as stored_rows keeps them when Veracross does not return entry_date.
+        fetch_cache.get_or_fetch(url, spec.wide(params), lambda: [[{"id": 1, "entry_date": None}]])
+        assert cached_pages(url, params, spec) is None
@@ -0,0 +1,92 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import jobs as jobs_module
+from jobs import JobQueue, JobStore, count_progress
+
+
+def queue(tmp_path):
+    return JobQueue(JobStore(str(tmp_path / "jobs.db")))
+
+
+def test_inline_runs_count_toward_their_own_job(tmp_path):
+    jobs = queue(tmp_path)
+    both_started = threading.Barrier(2)
+
+    def job(n):
+        def fn():
+            both_started.wait(timeout=5)
+            for _ in range(n):
+                count_progress("batches_sent")
+            return {"status": "OK"}, 200
+        return fn
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        first = pool.submit(jobs.run_inline, "first", job(3))
+        second = pool.submit(jobs.run_inline, "second", job(5))
+        records = first.result(timeout=10), second.result(timeout=10)
+
+    assert [record["progress"]["batches_sent"] for record in records] == [3, 5]
+    assert jobs.current is None
+
+
+def test_worker_threads_count_toward_the_job_that_started_them(tmp_path):
+    jobs = queue(tmp_path)
+
+    def fn():
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(contextvars.copy_context().run, count_progress, "pages_fetched") for _ in range(8)]
+            for future in futures:
+                future.result()
+        return {"status": "OK"}, 200
+
+    record = jobs.run_inline("paged", fn)
+    assert record["progress"]["pages_fetched"] == 8
+
+
+def test_attached_run_takes_over_a_run_queued_behind_its_caller(tmp_path):
+    jobs = queue(tmp_path)
+    runs = []
+
+    def cleanup():
+        runs.append("cleanup")
+        return {"status": "OK"}, 200
+
+    def cleanup_all():
+        # A /cleanup queued while /cleanup_all holds the only runner thread.
+        queued_id, _ = jobs.submit("cleanup:default", cleanup)
+        record = jobs.run_attached("cleanup:default", cleanup)
+        return {"status": record["status"], "same_job": record["id"] == queued_id}, 200
+
+    job_id, _ = jobs.submit("cleanup_all", cleanup_all)
+    finished = ThreadPoolExecutor(max_workers=1).submit(jobs.wait, job_id, 0.01)
+
+    result = finished.result(timeout=10)["result"]
+    assert (result["status"], result["same_job"]) == ("done", True)
+    jobs._executor.shutdown(wait=True)
+    assert runs == ["cleanup"]
+
+
+def test_waiting_on_a_job_whose_worker_died_fails_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs_module, "JOB_STALE_AFTER", 0.5)
+    jobs = queue(tmp_path)
+    # Claimed and started by a worker that then died: nothing beats for it.
+    job_id, _ = jobs.store.claim("cleanup:acsad")
+    jobs.store.start(job_id)
+
+    ran = []
+    attached = ThreadPoolExecutor(max_workers=1).submit(jobs.run_inline, "cleanup:acsad", lambda: ran.append(1))
+    record = attached.result(timeout=10)
+
+    assert record["id"] == job_id and record["status"] == "failed"
+    assert record["error"] == "Job worker stopped responding"
+    assert ran == []
+
+
+def test_claims_prune_week_old_jobs(tmp_path):
+    jobs = queue(tmp_path)
+    old = jobs.run_inline("cleanup:acsad", lambda: ({"status": "OK"}, 200))
+    jobs.store.update(old["id"], created=old["created"] - 8 * 24 * 3600)
+
+    jobs.run_inline("cleanup:acsad", lambda: ({"status": "OK"}, 200))
+    assert jobs.get(old["id"]) is None
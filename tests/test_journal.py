@@ -0,0 +1,17 @@
+from journal import Journal, StreamedRun
+
+
+def save(user_id):
+    return {"operation": "save", "id": user_id}
+
+
+def test_streamed_batches_leave_failures_pending(tmp_path):
+    journal = Journal(str(tmp_path / "journal.db"))
+    run = journal.start("create_new_students", mode="stream", tenant="default")
+    recorder = StreamedRun(run)
+    recorder.record([save(1), save(2)], [("ok", None), ("failed", "Invalid grade")])
+    recorder.record([save(3)], [("ok", None)])
+
+    assert run.pending() == {"save": [save(2)]}
+    assert run.finish() == "partial"
+    assert journal.summary(run.run_id)["pending"] == 1
@@ -0,0 +1,59 @@
+from roster import Roster, plan_rosters
+
+
+def roster(*rows):
+    return Roster.from_tuples(rows)
+
+
+def ids(users):
+    return sorted(users.ids())
+
+
+def test_adds_updates_and_deletes():
+    vc = roster(("1", "Ann A", "a@x", "Grade 1", "S"),
+                ("2", "Bob B", "b@x", "Grade 2", "S"),
+                ("3", "Cy C", "c@x", "", "T"))
+    mosyle = roster(("2", "Bob B", "b@x", "Grade 1", "S"),
+                    ("3", "Cy C", "c@x", "", "T"),
+                    ("4", "Old O", "o@x", "Grade 5", "S"))
+    plan = plan_rosters(vc, mosyle)
+    assert ids(plan.to_add) == ["1"]
+    assert ids(plan.to_update) == ["2"]
+    assert list(plan.to_update)[0].grade_level == "Grade 2"
+    assert ids(plan.to_delete) == ["4"]
+
+
+def test_unchanged_users_are_left_alone():
+    users = roster(("1", "Ann A", "a@x", "Grade 1", "S"), ("2", "Cy C", "c@x", "", "STAFF"))
+    plan = plan_rosters(users, roster(*users))
+    assert plan.to_add.empty and plan.to_update.empty and plan.to_delete.empty
+
+
+def test_admins_are_never_updated_or_deleted():
+    vc = roster(("1", "Renamed Admin", "a@x", "", "STAFF"))
+    mosyle = roster(("1", "Admin", "a@x", "", "ADMIN"), ("9", "Other Admin", "z@x", "", "admin"))
+    plan = plan_rosters(vc, mosyle)
+    assert plan.to_update.empty
+    assert plan.to_delete.empty
+
+
+def test_without_deletes():
+    plan = plan_rosters(roster(), roster(("4", "Old O", "o@x", "Grade 5", "S")), include_deletes=False)
+    assert plan.to_delete.empty
+
+
+def test_duplicate_ids():
+    # The first Veracross row for an id is used; the last Mosyle row for an id wins.
+    vc = roster(("1", "Ann A", "a@x", "Grade 1", "S"), ("1", "Ann Later", "a@x", "Grade 1", "S"))
+    mosyle = roster(("1", "Stale", "a@x", "Grade 1", "S"), ("1", "Ann A", "a@x", "Grade 1", "S"))
+    plan = plan_rosters(vc, mosyle)
+    assert plan.to_add.empty and plan.to_update.empty and plan.to_delete.empty
+
+    plan = plan_rosters(roster(("2", "Bo", "b@x", "", "T"), ("2", "Bo", "b@x", "", "T")), roster())
+    assert ids(plan.to_add) == ["2"]
+
+
+def test_missing_values_compare_as_empty():
+    vc = Roster.from_rows([{"id": 5, "full_name": "Dee D", "email_1": "d@x", "grade_level": None, "type": "T"}])
+    plan = plan_rosters(vc, roster(("5", "Dee D", "d@x", "", "T")))
+    assert plan.to_add.empty and plan.to_update.empty
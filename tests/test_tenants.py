@@ -0,0 +1,20 @@
+import json
+import tenants
+from rate_limit import mosyle_limiter, MOSYLE_MAX_RPS
+
+
+def test_every_tenant_limiter_uses_its_own_max_rps(tmp_path, monkeypatch):
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps([
+        {"key": "a", "school": "A", "location": "A", "email_domain": "@a.test", "env_prefix": "A_"},
+        {"key": "b", "school": "B", "location": "B", "email_domain": "@b.test", "env_prefix": "B_"},
+    ]))
+    monkeypatch.setenv("TENANTS_FILE", str(path))
+    monkeypatch.setenv("A_MOSYLE_MAX_RPS", "3")
+    monkeypatch.setenv("B_MOSYLE_MAX_RPS", "7")
+    try:
+        loaded = tenants.load_tenants()
+        assert loaded["a"].limiter is mosyle_limiter
+        assert (loaded["a"].limiter.max_rps, loaded["b"].limiter.max_rps) == (3.0, 7.0)
+    finally:
+        mosyle_limiter.set_max_rps(MOSYLE_MAX_RPS)
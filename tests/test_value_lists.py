@@ -0,0 +1,54 @@
+import json
+import pytest
+import requests
+import value_lists
+from value_lists import ValueListCache, ValueListError, GRADE_LEVELS, FACULTY_TYPES
+
+URL = "https://api.veracross.test/school/v3/students"
+
+
+def answer(status, lists=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({"data": [], "value_lists": lists or []}).encode()
+    return response
+
+
+@pytest.fixture
+def veracross(monkeypatch):
+    """Set .answers to the responses the value-list requests get, in order."""
+    class Session:
+        answers = []
+
+        def get(self, url, headers):
+            return self.answers.pop(0)
+
+    session = Session()
+    monkeypatch.setattr(value_lists, "get_session", lambda: session)
+    return session
+
+
+def test_lookup_by_name(veracross):
+    veracross.answers = [answer(200, [{"id": 1, "name": "Roles", "items": []},
+                                      {"id": 2, "name": "Grade Levels", "items": [{"id": 9, "description": "Grade 9"}]}])]
+    assert ValueListCache().lookup(URL, "token", GRADE_LEVELS) == {9: "Grade 9"}
+
+
+def test_failed_fetch_raises_instead_of_an_empty_lookup(veracross):
+    veracross.answers = [answer(503)]
+    with pytest.raises(ValueListError):
+        ValueListCache().lookup(URL, "token", GRADE_LEVELS)
+
+
+def test_missing_list_raises(veracross):
+    veracross.answers = [answer(200, [{"id": 1, "name": "Roles", "items": []}])]
+    with pytest.raises(ValueListError):
+        ValueListCache().lookup(URL, "token", FACULTY_TYPES)
+
+
+def test_failed_refresh_keeps_the_cached_lists(veracross):
+    veracross.answers = [answer(200, [{"id": 4, "name": "Faculty Types", "items": [{"id": 1, "description": "Teacher"}]}]),
+                         answer(500)]
+    cache = ValueListCache(ttl=0)
+    assert cache.lookup(URL, "token", FACULTY_TYPES) == {1: "Teacher"}
+    assert cache.lookup(URL, "token", FACULTY_TYPES) == {1: "Teacher"}
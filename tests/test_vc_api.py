@@ -0,0 +1,42 @@
+import json
+import threading
+import requests
+import vc_api
+from vc_api import VeracrossAuth, iter_pages
+
+URL = "https://api.veracross.test/school/v3/students"
+
+
+def answer(status, data=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({"data": data or []}).encode()
+    return response
+
+
+def test_a_401_refreshes_the_token_once_for_every_page(monkeypatch):
+    class Session:
+        lock = threading.Lock()
+        tokens = []
+
+        def get(self, url, headers, params):
+            with self.lock:
+                self.tokens.append(headers["Authorization"])
+            if headers["Authorization"] != "Bearer new":
+                return answer(401)
+            page = int(headers["X-Page-Number"])
+            return answer(200, [{"id": page}] if page <= 3 else [])
+
+    refreshed = []
+
+    def refresh(stale):
+        refreshed.append(stale)
+        return "new"
+
+    session = Session()
+    monkeypatch.setattr(vc_api, "get_session", lambda max_workers=None: session)
+    monkeypatch.setattr(vc_api, "open_response_cache", lambda: None)
+    pages = list(iter_pages(URL, VeracrossAuth("old", refresh), {}, "students"))
+
+    assert [page["data"] for page in pages] == [[{"id": 1}], [{"id": 2}], [{"id": 3}]]
+    assert refreshed == ["old"]
@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("Mosyle Integration")
+
+# Refresh this many seconds before a token's reported expiry.
+REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "120"))
+# Lifetime assumed when the issuer does not report one.
+DEFAULT_TTL = int(os.getenv("TOKEN_DEFAULT_TTL", "900"))
+
+
+def cache_key(*credentials):
+    """Hash credentials into a cache key so secrets never land in the cache file."""
+    return hashlib.sha256("\0".join(str(c) for c in credentials).encode()).hexdigest()
+
+
+def jwt_expiry(token):
+    """Return the exp claim of a (possibly "Bearer "-prefixed) JWT, or None."""
+    try:
+        payload = token.split(" ")[-1].split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+class TokenCache:
+    """In-process token cache, optionally mirrored to a JSON file shared by workers.
+
+    fetch callables return (token, expires_at); expires_at may be None. Each key
+    has its own lock so concurrent callers wait on a single refresh.
+    """
+
+    def __init__(self, path=None, refresh_margin=REFRESH_MARGIN):
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _fresh(self, entry):
+        return entry is not None and entry["expires_at"] - self.refresh_margin > time.time()
+
+    def _load_file(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_file(self, key, entry):
+        if not self.path:
+            return
+        entries = self._load_file()
+        entries = {k: v for k, v in entries.items() if self._fresh(v)}
+        entries[key] = entry
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(entries, f)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("Could not write token cache %s: %s", self.path, e)
+
+    def get(self, key, fetch, stale_token=None):
+        """Return a live token for key, calling fetch() only when needed.
+
+        Passing stale_token (e.g. after a 401) forces a refresh unless another
+        caller already replaced that token.
+        """
+        entry = self._tokens.get(key)
+        if self._fresh(entry) and entry["token"] != stale_token:
+            return entry["token"]
+
+        with self._key_lock(key):
+            entry = self._tokens.get(key)
+            if not self._fresh(entry):
+                entry = self._load_file().get(key)
+            if self._fresh(entry) and entry["token"] != stale_token:
+                self._tokens[key] = entry
+                return entry["token"]
+
+            token, expires_at = fetch()
+            if not token:
+                return token
+            entry = {"token": token, "expires_at": expires_at or time.time() + DEFAULT_TTL}
+            self._tokens[key] = entry
+            self._save_file(key, entry)
+            logger.info("Refreshed token, valid for %ds", entry["expires_at"] - time.time())
+            return token
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache(path=os.getenv("TOKEN_CACHE_FILE"))
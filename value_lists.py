@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from http_session import get_session
+from metrics import span, observe_response
+
+# Value lists (grade levels, faculty types) change a few times a year; refetch
+# them at most this often, revalidating with If-None-Match when the server
+# sent an ETag.
+VALUE_LISTS_TTL = int(os.getenv("VC_VALUE_LISTS_TTL", "86400"))
+
+# (list name, position in value_lists) for the lists the sync reads. The name
+# is matched first; the position is the order Veracross has always returned
+# them in, used only if no list carries that name.
+GRADE_LEVELS = (os.getenv("VC_GRADE_LEVEL_LIST", "Grade Levels"), 1)
+FACULTY_TYPES = (os.getenv("VC_FACULTY_TYPE_LIST", "Faculty Types"), 3)
+
+
+class ValueListError(Exception):
+    """A value list the sync needs could not be loaded or found.
+
+    Never mapped to an empty lookup: raw grade ids would be written as grade
+    levels and every teacher would become STAFF.
+    """
+
+
+class ValueListCache:
+    """Per-endpoint cache of Veracross value_lists, so list pages can be fetched without them.
+
+    The lists are read from a one-row page requested with X-API-Value-Lists
+    and kept keyed by list id for VALUE_LISTS_TTL seconds.
+    """
+
+    def __init__(self, ttl=VALUE_LISTS_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, url, access_token, entry):
+        headers = {
+            "X-Page-Number": "1",
+            "X-Page-Size": "1",
+            "X-API-Value-Lists": "include",
+        }
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        for _ in range(2):
+            token = str(access_token)
+            with span("value_lists"):
+                response = get_session().get(url, headers={"Authorization": f"Bearer {token}", **headers})
+            observe_response("veracross", response)
+            # A vc_api.VeracrossAuth gets one refresh on a 401, as its list pages do.
+            if response.status_code != 401 or not hasattr(access_token, "refresh") or not access_token.refresh(token):
+                break
+        if response.status_code == 304 and entry:
+            return {**entry, "fetched_at": time.time()}
+        if response.status_code != 200:
+            if entry:
+                # The lists we have are stale, not wrong; keep them until the next try.
+                print("Error refreshing value lists, keeping the cached ones:", response.text)
+                return entry
+            raise ValueListError(f"Value lists from {url} failed: {response.status_code} {response.text[:200]}")
+        lists = {value_list.get("id", position): value_list
+                 for position, value_list in enumerate(response.json().get("value_lists") or [])}
+        return {"lists": lists, "etag": response.headers.get("ETag"), "fetched_at": time.time()}
+
+    def lists(self, url, access_token):
+        """Return {list id: value list} for a Veracross list endpoint, fetching it when stale.
+
+        Raises ValueListError when nothing could be loaded.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or time.time() - entry["fetched_at"] >= self.ttl:
+                entry = self._fetch(url, access_token, entry)
+                self._entries[url] = entry
+        return entry["lists"]
+
+    def lookup(self, url, access_token, value_list):
+        """Return {item id: description} for value_list, a (name, fallback position) pair.
+
+        Raises ValueListError if the list is missing or has no items.
+        """
+        name, position = value_list
+        lists = list(self.lists(url, access_token).values())
+        match = next((vl for vl in lists if str(vl.get("name") or vl.get("description") or "").lower() == name.lower()), None)
+        if match is None and position < len(lists):
+            match = lists[position]
+        items = (match or {}).get("items") or []
+        if not items:
+            raise ValueListError(f"Value list {name!r} not found (or empty) at {url}")
+        return {item["id"]: item["description"] for item in items}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+value_lists = ValueListCache()
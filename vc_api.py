@@ -1,13 +1,38 @@
-import requests
-import pandas as pd
+import logging
+import os
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime,timedelta
+import requests
+from http_session import get_session
+from token_cache import token_cache,cache_key
+from jobs import count_progress
+from metrics import span, observe_response, RETRIES
+from rate_limit import retry_after_seconds, jittered
+from value_lists import value_lists, GRADE_LEVELS, FACULTY_TYPES
+from fetch_cache import fetch_cache
+from response_cache import open_response_cache, is_bypassed, page_key
+from roster import Roster
+
+logger = logging.getLogger("Mosyle Integration")
 
 today = datetime.today().date()
 tomorrow = today + timedelta(days=3)
 
+PAGE_SIZE = 1000
+# Attempts per Veracross page: 429s wait out Retry-After, 5xx answers and
+# connection errors back off; a page still failing fails the whole listing.
+VC_PAGE_ATTEMPTS = int(os.getenv("VC_PAGE_ATTEMPTS", "5"))
+
+
+class VeracrossError(Exception):
+    """A Veracross list page could not be fetched, so the listing would be incomplete."""
+
 
-def get_access_token(url,vc_client_id,vc_client_secret):
-    """Fetch the access token from Veracross API."""
+def get_access_token(url,vc_client_id,vc_client_secret,stale_token=None):
+    """Fetch the access token from Veracross API, reusing a cached one until it nears expiry."""
     data = {
         "grant_type": "client_credentials",
         "client_id": vc_client_id,
@@ -16,233 +41,376 @@ def get_access_token(url,vc_client_id,vc_client_secret):
     }
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
-    try:
-
-        response = requests.post(url, data=data, headers=headers)
+    def fetch():
+        with span("token_fetch", api="veracross"):
+            response = get_session().post(url, data=data, headers=headers)
+        observe_response("veracross", response)
 
         if response.status_code == 200:
-            return response.json().get("access_token")
+            body = response.json()
+            expires_in = body.get("expires_in")
+            return body.get("access_token"), time.time() + int(expires_in) if expires_in else None
         else:
             print("Error fetching access token:", response.text)
-            return None
+            return None, None
+
+    try:
+        return token_cache.get(cache_key(url, vc_client_id, vc_client_secret), fetch, stale_token=stale_token)
     except Exception as e:
         return str(e)
-    
-
-    
-def get_students(access_token,students_url,params_required):
-    """Fetch all student data using pagination via headers."""
-    access_token = access_token
-    if not access_token:
-        print("No access token")
-        return
 
-    all_students = []
-    page = 1
-    page_size = 1000 
 
-    while True:
+class VeracrossAuth:
+    """Veracross bearer token shared by a fetch's page threads (like mosyle_api.JwtAuth).
+
+    On a 401, refresh() swaps in a new token from refresh_token (called with
+    the rejected token) once for all threads that saw the same stale token.
+    str() is the current token, so it can be passed wherever a plain access
+    token is taken.
+    """
+
+    def __init__(self, access_token, refresh_token=None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return str(self.access_token)
+
+    def __bool__(self):
+        return bool(self.access_token)
+
+    def refresh(self, stale_token):
+        if self.refresh_token is None:
+            return False
+        with self._lock:
+            if self.access_token == stale_token:
+                new_token = self.refresh_token(stale_token)
+                if not new_token:
+                    return False
+                self.access_token = new_token
+        logger.info("Veracross access token refreshed after 401")
+        return True
+
+
+def iter_pages(url,access_token,params,label,page_size=PAGE_SIZE,max_workers=5):
+    """Yield every page of a Veracross list endpoint, fetching max_workers pages at a time.
+
+    Pages are requested in windows of max_workers; the walk stops at the first
+    empty page and the page bodies are yielded in page order. A page that
+    still fails after VC_PAGE_ATTEMPTS (or gets another 4xx) raises
+    VeracrossError rather than ending the walk early: a cut-short roster
+    would turn the missing users into Mosyle deletes.
+    With VC_RESPONSE_CACHE_DB set, pages come from the response cache when it
+    holds them fresh (or Veracross answers 304 to its validators). A 401 is
+    retried once with a refreshed token when access_token is a VeracrossAuth.
+    """
+    session = get_session(max_workers)
+    auth = access_token if isinstance(access_token, VeracrossAuth) else VeracrossAuth(access_token)
+    cache = open_response_cache()
+    # Read once for the whole walk.
+    use_cached = cache is not None and not is_bypassed()
+
+    def fetch_page(page):
         headers = {
-            "Authorization": f"Bearer {access_token}",
             "X-Page-Number": str(page),
             "X-Page-Size": str(page_size),
-            "X-API-Value-Lists" : "include"
+            # Value lists come from the value_lists cache, not every page.
 
             # "X-API-Revision": "latest"  # Optional: Ensures the latest API version
         }
-        params = {}
-        if params_required:
-            params = {
-                "on_or_after_entry_date": tomorrow,
-                "on_or_before_entry_date": tomorrow
-            }
-
-        response = requests.get(students_url, headers=headers,params=params)
-        # print("got response for student list")
-
-        if response.status_code == 200:
-            students = response.json()
-            if students["data"] == []:
-                break
-
-            grade_level = {item["id"] : item["description"] for item in students["value_lists"][1]["items"]}
-            # print("grade_level",grade_level)
-
-            for entry in students["data"]:
-
-                if entry["grade_level"] in grade_level:
-                    entry["grade_level"] = grade_level[entry["grade_level"]]
-                entry["full_name"] = entry["first_name"] + " " + entry["last_name"]
-
-
-            all_students.extend(students["data"])
-            page += 1 
-        else:
-            print("Error fetching students:", response.text)
-            break
-    if params_required:
-        page = 1
-        while True:
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "X-Page-Number": str(page),
-                "X-Page-Size": str(page_size),
-                "X-API-Value-Lists" : "include"
-
-                # "X-API-Revision": "latest"  # Optional: Ensures the latest API version
-            }
-            params = {}
-            if params_required:
-                params = {
-                    "on_or_after_entry_date": tomorrow,
-                    "on_or_before_entry_date": tomorrow,
-                    "role": 7 #for future students
-                }
-
-            response = requests.get(students_url, headers=headers,params=params)
-            # print("got response for student list")
-
+        key = page_key(url, params, page, page_size) if cache else None
+        entry = cache.lookup(key) if use_cached else None
+        if entry and cache.fresh(entry):
+            cache.hit(key)
+            return entry["body"]
+        if entry:
+            headers.update(cache.validators(entry))
+        last_error = None
+        refreshed = False
+        for attempt in range(VC_PAGE_ATTEMPTS):
+            if attempt:
+                RETRIES.inc(operation=label)
+            token = auth.access_token
+            try:
+                with span("veracross_page", endpoint=label):
+                    response = session.get(url, headers={"Authorization": f"Bearer {token}", **headers},params=params)
+            except requests.RequestException as e:
+                last_error = str(e)
+                time.sleep(jittered(min(30, 2 ** attempt)))
+                continue
+            observe_response("veracross", response)
+            if response.status_code == 304 and entry:
+                cache.hit(key, revalidated=True)
+                return entry["body"]
             if response.status_code == 200:
-                students = response.json()
-                if students["data"] == []:
-                    break
-
-                grade_level = {item["id"] : item["description"] for item in students["value_lists"][1]["items"]}
-                # print("grade_level",grade_level)
-
-                for entry in students["data"]:
-
-                    if entry["grade_level"] in grade_level:
-                        entry["grade_level"] = grade_level[entry["grade_level"]]
-                    entry["full_name"] = entry["first_name"] + " " + entry["last_name"]
-                    
-
-                all_students.extend(students["data"])
-                page += 1 
+                body = response.json()
+                if cache:
+                    cache.store(key, url, body, response.headers, bypassed=not use_cached)
+                return body
+            last_error = f"{response.status_code} {response.reason}: {response.text[:200]}"
+            if response.status_code == 401 and not refreshed and auth.refresh(token):
+                refreshed = True
+                continue
+            if response.status_code == 429:
+                time.sleep(jittered(retry_after_seconds(response, 2 ** attempt)))
+            elif response.status_code >= 500:
+                time.sleep(jittered(min(30, 2 ** attempt)))
             else:
-                print("Error fetching students:", response.text)
                 break
-        
-
-
-    df = pd.DataFrame(all_students)
-    if df.empty:
-        return df
-    df = df[["id","full_name","email_1","grade_level"]]
-
-    df = df.drop_duplicates()
-    print(f"Total students fetched: {len(df)}")
-
-    # print(df)
-    return df
-    # df.to_csv("yaseen samples")
+        raise VeracrossError(f"Veracross {label} page {page} failed: {last_error}")
 
-
-def get_staff_faculty(VC_STAFF_URL,access_token,params_required):
-    """Fetch all student data using pagination via headers."""
-    print("calling staff list.....")
-    access_token = access_token
-    if not access_token:
-        print("No access token")
-        return
-
-    all_staff = []
     page = 1
-    page_size = 1000  
-    while True:
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "X-Page-Number": str(page),
-            "X-Page-Size": str(page_size),
-            "X-API-Value-Lists" : "include"
-
-            # "X-API-Revision": "latest"  # Optional: Ensures the latest API version
-        }
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            window = [executor.submit(contextvars.copy_context().run, fetch_page, n) for n in range(page, page + max_workers)]
+            for body in (future.result() for future in window):
+                if body["data"] == []:
+                    return
+                count_progress("pages_fetched")
+                yield body
+            page += max_workers
+
+
+def fetch_pages(url,access_token,params,label,page_size=PAGE_SIZE,max_workers=5,transform=None):
+    """List of every page of a Veracross list endpoint, in page order.
+
+    With transform, each page body is replaced by transform(body) as it
+    arrives, so only what the caller keeps is retained.
+    """
+    pages = iter_pages(url, access_token, params, label, page_size=page_size, max_workers=max_workers)
+    return [transform(body) for body in pages] if transform else list(pages)
+
+
+def cached_pages(url, params, spec):
+    """One pass's pages (lists of rows) from fetch_cache, or None.
+
+    A pass whose filters were pushed down into params is also served from a
+    cached fetch of the same pass without them (e.g. /cleanup's full listing),
+    by applying those filters here, provided its rows carry the filtered
+    fields. None inside response_cache.bypassed().
+    """
+    if is_bypassed():
+        return None
+    pages = fetch_cache.get(url, params)
+    if pages is not None:
+        return pages
+    wide = spec.wide(params)
+    if wide != params:
+        pages = fetch_cache.get(url, wide)
+        if pages is not None and spec.filterable(pages):
+            return [spec.pushed_rows(rows) for rows in pages]
+    return None
+
+
+def fetch_pass(url,access_token,params,label,spec,max_workers=5,transform=None):
+    """Every page of one pass as transform(rows) (or the rows), through fetch_cache."""
+    transform = transform or (lambda rows: rows)
+    if not fetch_cache.storing():
+        return fetch_pages(url, access_token, params, label, max_workers=max_workers,
+                           transform=lambda body: transform(body["data"]))
+    pages = cached_pages(url, params, spec)
+    if pages is None:
+        pages = fetch_cache.get_or_fetch(url, params, lambda: fetch_pages(
+            url, access_token, params, label, max_workers=max_workers, transform=spec.stored_rows))
+    return [transform(rows) for rows in pages]
+
+
+def fetch_passes(url,access_token,passes,label,spec,max_workers=5,transform=None):
+    """Run fetch_pass for each params dict in passes concurrently, keeping pass order."""
+    get_session(max_workers * len(passes))
+    # Each pass runs in a copy of the caller's context, so it uses the caller's (tenant's) pool.
+    contexts = [contextvars.copy_context() for _ in passes]
+    with ThreadPoolExecutor(max_workers=len(passes)) as executor:
+        results = executor.map(lambda context, params: context.run(fetch_pass, url, access_token, params, label, spec, max_workers=max_workers, transform=transform), contexts, passes)
+        return [page for pages in results for page in pages]
+
+
+# Row filter operators for FetchSpec.where: (field, op, argument).
+FILTER_OPS = {
+    "eq": lambda value, arg: value == arg,
+    "contains": lambda value, arg: arg in str(value or ""),
+    "date_eq": lambda value, arg: str(value or "")[:10] == arg.isoformat(),
+}
+
+# Filters Veracross applies itself: (field, op) -> query params for the argument.
+PUSHDOWN = {
+    ("entry_date", "date_eq"): lambda d: {"on_or_after_entry_date": d, "on_or_before_entry_date": d},
+    ("date_hired", "date_eq"): lambda d: {"on_or_before_date_hired": d, "on_or_after_date_hired": d},
+}
+# Pushed-down filters the API does not apply exactly; rows are re-checked.
+RECHECK = {("date_hired", "date_eq")}
+
+# Query parameter asking Veracross for only some fields (a comma-separated
+# list), if the API accepts one; unset, unused fields are dropped per page.
+VC_FIELDS_PARAM = os.getenv("VC_FIELDS_PARAM")
+
+STUDENT_FIELDS = ("id", "first_name", "last_name", "email_1", "grade_level", "entry_date")
+STAFF_FIELDS = ("id", "first_name", "last_name", "email_1", "faculty_type", "date_hired")
+
+
+class FetchSpec:
+    """Which fields to read from a Veracross list endpoint and which rows to keep.
+
+    Filters in PUSHDOWN become query params; the rest (and those in RECHECK)
+    are checked per page, so discarded rows are dropped before anything is
+    built from them. fields includes every field a filter reads, so cached
+    pages (stored_rows) can be filtered again for another spec.
+    """
+
+    def __init__(self, fields, where=()):
+        self.fields = tuple(fields)
+        self.where = tuple(where)
+        self.checks = [(field, FILTER_OPS[op], arg) for field, op, arg in self.where
+                       if (field, op) not in PUSHDOWN or (field, op) in RECHECK]
+        self.pushed = [(field, FILTER_OPS[op], arg) for field, op, arg in self.where if (field, op) in PUSHDOWN]
+
+    def pushed_params(self):
         params = {}
-        if params_required:
-            params = {
-                "on_or_before_date_hired": tomorrow,
-                "on_or_after_date_hired": tomorrow
-            }
-        response = requests.get(VC_STAFF_URL, headers=headers,params=params)
-        # print("got response for student list")
-
-        if response.status_code == 200:
-            staffs = response.json()
-            if staffs["data"] == []:
-                break
-
-
-            faculty_type = {item["id"] : item["description"] for item in staffs["value_lists"][3]["items"]}
-
-            for entry in staffs["data"]:
-
-                if entry["faculty_type"] in faculty_type:
-                    entry["faculty_type"] = faculty_type[entry["faculty_type"]]
-                entry["full_name"] = entry["first_name"] + " " + entry["last_name"]
-
-
-            all_staff.extend(staffs["data"])
-            page += 1 
-        else:
-            print("Error fetching staff:", response.text)
-            break
+        for field, op, arg in self.where:
+            if (field, op) in PUSHDOWN:
+                params.update(PUSHDOWN[field, op](arg))
+        return params
+
+    def params(self):
+        params = self.pushed_params()
+        if VC_FIELDS_PARAM:
+            params[VC_FIELDS_PARAM] = ",".join(self.fields)
+        return params
+
+    def wide(self, params):
+        """params without the pushed-down filters: the pass that lists every row."""
+        pushed = self.pushed_params()
+        return {key: value for key, value in params.items() if key not in pushed}
+
+    def keep(self, row):
+        return all(check(row.get(field), arg) for field, check, arg in self.checks)
+
+    def rows(self, rows):
+        if not self.checks:
+            return rows
+        return [row for row in rows if self.keep(row)]
+
+    def filterable(self, pages):
+        """Whether pushed_rows can stand in for Veracross on these pages: every pushed field is set on some row.
+
+        A field Veracross does not return (or names differently) would
+        otherwise filter out every row without a sign.
+        """
+        rows = [row for page in pages for row in page[:1]]
+        if not rows:
+            return True
+        return all(any(row.get(field) is not None for row in rows) for field, _, _ in self.pushed)
+
+    def pushed_rows(self, rows):
+        """rows Veracross would have returned with the pushed-down filters applied."""
+        return [row for row in rows if all(check(row.get(field), arg) for field, check, arg in self.pushed)]
+
+    def stored_rows(self, body):
+        """A page's rows cut down to fields, as fetch_cache keeps them."""
+        return [{field: row.get(field) for field in self.fields} for row in body["data"]]
+
+
+def student_spec(params_required,where=()):
+    where = list(where)
     if params_required:
-        page = 1
-        while True:
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "X-Page-Number": str(page),
-                "X-Page-Size": str(page_size),
-                "X-API-Value-Lists" : "include"
-
-                # "X-API-Revision": "latest"  # Optional: Ensures the latest API version
-            }
-            params = {}
-            if params_required:
-                params = {
-                    "on_or_before_date_hired": tomorrow,
-                    "on_or_after_date_hired": tomorrow,
-                    "role":27
-                }
-
-            response = requests.get(VC_STAFF_URL, headers=headers,params=params)
-            # print("got response for student list")
-
-            if response.status_code == 200:
-                staffs = response.json()
-                if staffs["data"] == []:
-                    break
-
+        where.append(("entry_date", "date_eq", tomorrow))
+    return FetchSpec(STUDENT_FIELDS, where)
 
-                faculty_type = {item["id"] : item["description"] for item in staffs["value_lists"][3]["items"]}
-
-                for entry in staffs["data"]:
-
-                    if entry["faculty_type"] in faculty_type:
-                        entry["faculty_type"] = faculty_type[entry["faculty_type"]]
-                    entry["full_name"] = entry["first_name"] + " " + entry["last_name"]
 
+def staff_spec(params_required,where=()):
+    where = list(where)
+    if params_required:
+        where.append(("date_hired", "date_eq", tomorrow))
+    return FetchSpec(STAFF_FIELDS, where)
 
-                all_staff.extend(staffs["data"])
-                page += 1 
-            else:
-                print("Error fetching staff:", response.text)
-                break
-    print(f"Total staffs fetched: {len(all_staff)}")
 
-    df = pd.DataFrame(all_staff)
-    print(len(df))
-    if df.empty:
-        return df,df
+def student_passes(spec,params_required,extra_params=None):
+    params = {**spec.params(), **(extra_params or {})}
     if params_required:
-        df["date_hired"] = pd.to_datetime(df["date_hired"]).dt.date
-        df = df[df["date_hired"] == tomorrow]
-    df = df[["id","full_name","email_1","faculty_type"]]
-    df = df.drop_duplicates()
-    teacher_df = df[df["faculty_type"].str.contains("teacher", case=False, na=False)]
-    staff_df = df[~df["faculty_type"].str.contains("teacher", case=False, na=False)]
-
+        return [params, {**params, "role": 7}] #role 7 for future students
+    return [params]
 
 
-    return staff_df,teacher_df
+def staff_passes(spec,params_required,extra_params=None):
+    params = {**spec.params(), **(extra_params or {})}
+    if params_required:
+        return [params, {**params, "role": 27}]
+    return [params]
+
+
+def student_rows(students, spec, grade_level):
+    """Mosyle-shaped rows for the students on one page that pass spec, with grade levels resolved."""
+    return [
+        {"id": entry["id"], "full_name": entry["first_name"] + " " + entry["last_name"], "email_1": entry["email_1"],
+         "grade_level": grade_level.get(entry["grade_level"], entry["grade_level"]), "type": "S"}
+        for entry in spec.rows(students)
+    ]
+
+
+def staff_rows(staffs, spec, faculty_type):
+    """Mosyle-shaped rows for the staff and teachers on one page that pass spec."""
+    rows = []
+    for entry in spec.rows(staffs):
+        faculty = faculty_type.get(entry["faculty_type"], entry["faculty_type"])
+        is_teacher = "teacher" in str(faculty or "").lower()
+        rows.append({"id": entry["id"], "full_name": entry["first_name"] + " " + entry["last_name"],
+                     "email_1": entry["email_1"], "grade_level": None, "type": "T" if is_teacher else "STAFF"})
+    return rows
+
+
+def iter_pass_rows(url,access_token,params,label,spec,max_workers=5):
+    """Yield a pass's pages of rows from fetch_cache if it holds them, else as they arrive (without caching them)."""
+    pages = cached_pages(url, params, spec)
+    if pages is not None:
+        yield from pages
+        return
+    for body in iter_pages(url, access_token, params, label, max_workers=max_workers):
+        yield body["data"]
+
+
+def iter_student_rows(access_token,students_url,params_required,max_workers=5,extra_params=None,where=()):
+    """Yield one list of Mosyle-shaped student rows per Veracross page, as pages arrive."""
+    spec = student_spec(params_required, where)
+    grade_level = value_lists.lookup(students_url, access_token, GRADE_LEVELS)
+    for params in student_passes(spec, params_required, extra_params):
+        for students in iter_pass_rows(students_url, access_token, params, "students", spec, max_workers=max_workers):
+            yield student_rows(students, spec, grade_level)
+
+
+def iter_staff_rows(VC_STAFF_URL,access_token,params_required,max_workers=5,extra_params=None,where=()):
+    """Yield one list of Mosyle-shaped staff/teacher rows per Veracross page, as pages arrive."""
+    spec = staff_spec(params_required, where)
+    faculty_type = value_lists.lookup(VC_STAFF_URL, access_token, FACULTY_TYPES)
+    for params in staff_passes(spec, params_required, extra_params):
+        for staffs in iter_pass_rows(VC_STAFF_URL, access_token, params, "staff", spec, max_workers=max_workers):
+            yield staff_rows(staffs, spec, faculty_type)
+
+
+def student_roster(access_token,students_url,params_required,max_workers=5,extra_params=None,where=()):
+    """Every student the passes list, as a Roster of type "S" users; each page becomes User records as it arrives.
+
+    where adds FetchSpec filters, e.g. [("email_1", "contains", "@school")].
+    """
+    spec = student_spec(params_required, where)
+    passes = student_passes(spec, params_required, extra_params)
+    grade_level = value_lists.lookup(students_url, access_token, GRADE_LEVELS)
+
+    pages = fetch_passes(students_url, access_token, passes, "students", spec, max_workers=max_workers,
+                         transform=lambda students: Roster.from_rows(student_rows(students, spec, grade_level)))
+    roster = Roster.concat(pages).unique()
+    print(f"Total students fetched: {len(roster)}")
+    return roster
+
+
+def staff_roster(VC_STAFF_URL,access_token,params_required,max_workers=5,extra_params=None,where=()):
+    """Every staff member and teacher the passes list, as one Roster of "T" and "STAFF" users."""
+    spec = staff_spec(params_required, where)
+    passes = staff_passes(spec, params_required, extra_params)
+    faculty_type = value_lists.lookup(VC_STAFF_URL, access_token, FACULTY_TYPES)
+
+    pages = fetch_passes(VC_STAFF_URL, access_token, passes, "staff", spec, max_workers=max_workers,
+                         transform=lambda staffs: Roster.from_rows(staff_rows(staffs, spec, faculty_type)))
+    roster = Roster.concat(pages).unique()
+    print(f"Total staffs fetched: {len(roster)}")
+    return roster